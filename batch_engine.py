@@ -0,0 +1,848 @@
+"""
+NumPy による一括対戦シミュレーション。
+
+N 試合分のファイター・攻撃判定・飛び道具の状態を配列（struct-of-arrays）で持ち、
+全試合を同時に1フレームずつ進める。ルールは kakutou_koukaton.BattleSim と同じで、
+cross_check() で1試合分をオブジェクト版と毎フレーム突き合わせられる。
+
+    python batch_engine.py --lanes 4096 --frames 3600
+    python batch_engine.py --check --frames 5000
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+import pygame as pg
+
+import kakutou_koukaton as game
+
+
+# =====================
+# 定数（kakutou_koukaton と同じ値）
+# =====================
+F = 2  # 1試合あたりのファイター数
+
+GRAVITY = 1
+JUMP_VY = -20
+WALK_SPEED = 6
+GUARD_SPEED = WALK_SPEED // 2
+HURTBOX_SIZE = (60, 180)
+
+THROW_RANGE = 70
+THROW_HEIGHT = 20
+THROW_DAMAGE = 20
+THROW_KNOCK = 140
+THROW_VY = -15
+THROW_ENERGY = 10
+THROW_COOL = 40
+
+# ポーズ番号
+POSES = ("idle", "punch", "kick", "crouch")
+IDLE, PUNCH, KICK, CROUCH = 0, 1, 2, 3
+
+# 打撃技の番号
+STRIKES = ("punch", "kick")
+
+# 飛び道具の種類番号
+KINDS = ("beam", "bomb", "rasensyuriken")
+BEAM, BOMB, RASEN = 0, 1, 2
+
+# ビット番号
+BIT = {name: np.uint16(bit) for name, bit in game.ACTION_BIT.items()}
+
+
+def _projectile_specs(char_name: str):
+    """
+    Projectile を実際に作って飛び道具の性能と回転後のサイズ表を得る。
+    （Projectile 側の値を変えてもここを直す必要がないようにする）
+    """
+    dummy = game.Fighter(0, game.P1_KEYS, char_name, headless=True)
+    size = np.zeros((len(KINDS), 2), np.int32)
+    hitbox = np.zeros((len(KINDS), 2), np.int32)
+    speed = np.zeros(len(KINDS), np.int32)
+    damage = np.zeros(len(KINDS), np.int32)
+    rotate = np.zeros(len(KINDS), np.int32)
+    rot_w = np.zeros((len(KINDS), 360), np.int32)
+    rot_h = np.zeros((len(KINDS), 360), np.int32)
+
+    for k, kind in enumerate(KINDS):
+        proj = game.Projectile(dummy, kind)
+        size[k] = proj.rect.size
+        hitbox[k] = proj.hitbox_size
+        speed[k] = proj.speed
+        damage[k] = proj.damage
+        rotate[k] = proj.rotate_speed
+        rot_w[k], rot_h[k] = size[k]
+        if proj.rotate_speed:
+            # 回転後のサイズは画像の中身によらず元のサイズと角度だけで決まる
+            blank = pg.Surface(tuple(size[k]), pg.SRCALPHA)
+            for angle in range(0, 360, math.gcd(proj.rotate_speed, 360)):
+                rot_w[k, angle], rot_h[k, angle] = pg.transform.rotate(blank, angle).get_size()
+    return size, hitbox, speed, damage, rotate, rot_w, rot_h
+
+
+def _strike_specs(moves):
+    """
+    技の表から打撃技の配列を作る。
+    攻撃判定（startup の間は判定なし）とくらい判定は (技, フレーム) で引ける表にする。
+    """
+    ids = [moves.index[name] for name in STRIKES]
+    pose = np.array([POSES.index(moves.pose[m]) for m in ids], np.int8)
+    duration = np.array([moves.duration[m] for m in ids], np.int32)
+    cooldown = np.array([moves.cooldown[m] for m in ids], np.int32)
+    life = np.array([moves.startup[m] + moves.active[m] for m in ids], np.int32)
+    damage = np.array([moves.damage[m] for m in ids], np.int32)
+    hitbox = np.zeros((len(ids), life.max(), 4), np.int32)
+    hurtbox = np.zeros((len(ids), duration.max(), 4), np.int32)
+    for k, m in enumerate(ids):
+        start = moves.hitbox_start[m]
+        hitbox[k, :life[k]] = moves.hitbox[start:start + life[k]]
+        start = moves.hurtbox_start[m]
+        hurtbox[k, :duration[k]] = moves.hurtbox[start:start + duration[k]]
+    return pose, duration, cooldown, life, damage, hitbox, hurtbox
+
+
+def _collide(ax, ay, aw, ah, bx, by, bw, bh):
+    """pg.Rect.colliderect と同じ判定を配列で行う"""
+    return ((aw > 0) & (ah > 0) & (bw > 0) & (bh > 0) &
+            (ax < bx + bw) & (bx < ax + aw) & (ay < by + bh) & (by < ay + ah))
+
+
+# =====================
+# 一括シミュレーション
+# =====================
+class BatchEngine:
+    """
+    N 試合を配列でまとめて進めるシミュレーション。
+    配列の形は ファイター (N, 2)、攻撃判定 (N, 2)、飛び道具 (N, 2, 最大数)。
+    """
+
+    def __init__(self, lanes: int, max_projectiles: int = 16,
+                 match_frames: int = game.MATCH_TIME * game.FPS,
+                 characters: tuple[str, str] = ("man", "woman")) -> None:
+        """
+        Args:
+            lanes: 同時に進める試合数
+            max_projectiles: ファイター1人あたりの飛び道具の最大数
+            match_frames: 制限時間(フレーム数)
+            characters: P1, P2 のキャラクター名
+
+        Raises:
+            ValueError: 2人の技の表が違う（キャラクターごとの違いは扱わない）
+        """
+        self.n = lanes
+        self.p = max_projectiles
+        self.match_frames = match_frames
+        self.characters = tuple(characters)
+
+        tables = [game.move_table(name) for name in self.characters]
+        if any(vars(t) != vars(tables[0]) for t in tables[1:]):
+            raise ValueError(f"{' and '.join(self.characters)} have different moves "
+                             f"(the batch engine uses one move table for both fighters)")
+        (self.proj_size, self.proj_hitbox, self.proj_speed, self.proj_damage,
+         self.proj_rotate, self.rot_w, self.rot_h) = _projectile_specs(self.characters[0])
+        moves = tables[0]
+        (self.atk_pose, self.atk_frames, self.atk_cooldown, self.atk_life, self.atk_damage,
+         self.atk_hitbox, self.atk_hurtbox) = _strike_specs(moves)
+        self.pose_size = np.array([game.Fighter.POSE_SIZE[k]
+                                   for k in ("idle", "punch", "kick", "crouch")], np.int32)
+        self.energy_cost = np.array([moves.energy[moves.index[k]] for k in ("beam", "bomb")])
+
+        self.reset()
+
+    # ---------------------
+    # 状態の初期化
+    # ---------------------
+    def reset(self, mask: np.ndarray | None = None) -> None:
+        """
+        試合開始時の状態にする。
+
+        Args:
+            mask: (N,) の真偽配列。指定した試合だけを初期化する（None なら全試合）
+        """
+        n, p = self.n, self.p
+        if mask is None:
+            self._alloc(n, p)
+            mask = np.ones(n, bool)
+
+        starts = game.BattleSim.START
+        w, h = self.pose_size[IDLE]
+        for i, (x, facing) in enumerate(starts):
+            self.x[mask, i] = x
+            self.y[mask, i] = game.FLOOR - h
+            self.facing[mask, i] = facing
+            # くらい判定は Fighter 作成時の位置で計算される
+            self.hbx[mask, i] = x + w // 2 - HURTBOX_SIZE[0] // 2
+            self.hby[mask, i] = game.FLOOR - HURTBOX_SIZE[1]
+
+        for arr, value in ((self.w, w), (self.h, h), (self.vy, 0), (self.hp, 100),
+                           (self.energy, 100.0), (self.on_ground, True), (self.crouch, False),
+                           (self.attacking, False), (self.guarding, False), (self.pose, IDLE),
+                           (self.atk_timer, 0), (self.rec_timer, 0), (self.throw_cool, 0),
+                           (self.ahb_valid, False), (self.a_alive, False), (self.p_alive, False)):
+            arr[mask] = value
+
+        self.frame[mask] = 0
+        self.done[mask] = False
+        self.winner[mask] = -1
+        self.ko[mask] = False
+
+    def _alloc(self, n: int, p: int) -> None:
+        i32 = np.int32
+        # ファイター
+        self.x = np.zeros((n, F), i32)
+        self.y = np.zeros((n, F), i32)
+        self.w = np.zeros((n, F), i32)
+        self.h = np.zeros((n, F), i32)
+        self.vy = np.zeros((n, F), i32)
+        self.hp = np.zeros((n, F), i32)
+        self.energy = np.zeros((n, F), np.float64)
+        self.facing = np.zeros((n, F), i32)
+        self.on_ground = np.zeros((n, F), bool)
+        self.crouch = np.zeros((n, F), bool)
+        self.attacking = np.zeros((n, F), bool)
+        self.guarding = np.zeros((n, F), bool)
+        self.pose = np.zeros((n, F), np.int8)
+        self.move = np.zeros((n, F), np.int8)
+        self.atk_timer = np.zeros((n, F), i32)
+        self.rec_timer = np.zeros((n, F), i32)
+        self.throw_cool = np.zeros((n, F), i32)
+        self.hbx = np.zeros((n, F), i32)
+        self.hby = np.zeros((n, F), i32)
+        self.ahb_valid = np.zeros((n, F), bool)
+        self.ahx = np.zeros((n, F), i32)
+        self.ahy = np.zeros((n, F), i32)
+        self.ahw = np.zeros((n, F), i32)
+        self.ahh = np.zeros((n, F), i32)
+
+        # 攻撃判定（攻撃中は次の攻撃を出せないので1人1つ）
+        self.a_alive = np.zeros((n, F), bool)
+        self.ax = np.zeros((n, F), i32)
+        self.ay = np.zeros((n, F), i32)
+        self.aw = np.zeros((n, F), i32)
+        self.ah = np.zeros((n, F), i32)
+        self.a_life = np.zeros((n, F), i32)
+        self.a_damage = np.zeros((n, F), i32)
+        self.a_move = np.zeros((n, F), np.int8)
+        self.a_cx = np.zeros((n, F), i32)  # 技を出した瞬間のファイターの中心
+        self.a_cy = np.zeros((n, F), i32)
+        self.a_facing = np.zeros((n, F), i32)
+
+        # 飛び道具（持ち主ごとにスロットを持つ）
+        self.p_alive = np.zeros((n, F, p), bool)
+        self.p_kind = np.zeros((n, F, p), np.int8)
+        self.px = np.zeros((n, F, p), i32)
+        self.py = np.zeros((n, F, p), i32)
+        self.pw = np.zeros((n, F, p), i32)
+        self.ph = np.zeros((n, F, p), i32)
+        self.phx = np.zeros((n, F, p), i32)
+        self.phy = np.zeros((n, F, p), i32)
+        self.p_angle = np.zeros((n, F, p), i32)
+        self.p_facing = np.zeros((n, F, p), i32)
+        self.p_seq = np.zeros((n, F, p), np.int64)  # 発生順（融合判定の順番に使う）
+        self.next_seq = 0
+        self.overflow = 0  # スロット不足で出せなかった飛び道具の数
+
+        # 試合の進行
+        self.frame = np.zeros(n, i32)
+        self.done = np.zeros(n, bool)
+        self.winner = np.full(n, -1, np.int8)  # 0:P1 1:P2 2:引き分け
+        self.ko = np.zeros(n, bool)
+        self.lanes = np.arange(n)
+
+    # ---------------------
+    # 1フレーム
+    # ---------------------
+    def step(self, held: np.ndarray, pressed: np.ndarray) -> None:
+        """
+        全試合を1フレーム進める（BattleSim.step と同じ順番で処理する）。
+
+        Args:
+            held: (N, 2) の押しっぱなし操作ビットマスク
+            pressed: (N, 2) のこのフレームで押された操作ビットマスク
+        """
+        held = held.astype(np.uint16, copy=False)
+        pressed = pressed.astype(np.uint16, copy=False)
+
+        def bit(arr, name):
+            return (arr & BIT[name]) != 0
+
+        # パンチ・キック
+        for i in range(F):
+            for k, atk in enumerate(STRIKES):
+                self._do_attack(i, k, bit(pressed[:, i], atk))
+
+        # 飛び道具
+        for i in range(F):
+            for kind in (BEAM, BOMB):
+                cost = self.energy_cost[kind]
+                want = bit(pressed[:, i], KINDS[kind]) & (self.energy[:, i] >= cost)
+                self._spawn(want, i, kind)
+                self.energy[want, i] -= cost
+
+        # 投げ技
+        self._throw(0, 1, bit(pressed[:, 0], "throw"))
+        self._throw(1, 0, bit(pressed[:, 1], "throw"))
+
+        # ファイター更新（P2 は更新後の P1 を見て防御方向を決める）
+        for i in range(F):
+            self._update_fighter(i, 1 - i, held[:, i])
+
+        # 攻撃判定の寿命と、そのフレームの判定の位置
+        self.a_life -= self.a_alive
+        self.a_alive &= self.a_life > 0
+        self._place_attacks(self.a_alive)
+
+        self._update_projectiles()
+        self._fuse_projectiles()
+        self._resolve_hits()
+
+        # 決着判定（決着済みの試合は結果を固定する）
+        self.frame += 1
+        ko = (self.hp <= 0).any(axis=1)
+        over = ~self.done & (ko | (self.frame >= self.match_frames))
+        if over.any():
+            hp1, hp2 = self.hp[:, 0], self.hp[:, 1]
+            result = np.where(hp1 > hp2, 0, np.where(hp2 > hp1, 1, 2))
+            self.winner[over] = result[over]
+            self.ko[over] = ko[over]
+            self.done |= over
+
+    def _do_attack(self, i, k, want):
+        """Fighter.do_attack と Attack の生成（k は STRIKES の番号）"""
+        want = want & (self.atk_timer[:, i] == 0) & (self.rec_timer[:, i] == 0)
+        if not want.any():
+            return
+        self.move[want, i] = k
+        self.pose[want, i] = self.atk_pose[k]
+        self.atk_timer[want, i] = self.atk_frames[k]
+        self.attacking[want, i] = True
+
+        self.a_alive[want, i] = True
+        self.a_move[want, i] = k
+        self.a_cx[want, i] = self.x[want, i] + self.w[want, i] // 2
+        self.a_cy[want, i] = self.y[want, i] + self.h[want, i] // 2
+        self.a_facing[want, i] = self.facing[want, i]
+        self.a_life[want, i] = self.atk_life[k]
+        self.a_damage[want, i] = self.atk_damage[k]
+        mask = np.zeros((self.n, F), bool)
+        mask[want, i] = True
+        self._place_attacks(mask)
+
+    def _place_attacks(self, mask):
+        """Attack.place と同じく、技の表のそのフレームの攻撃判定を置く（mask は (N, 2)）"""
+        lanes, owner = np.nonzero(mask)
+        if lanes.size == 0:
+            return
+        k = self.a_move[lanes, owner]
+        frame = self.atk_life[k] - self.a_life[lanes, owner]
+        w, h, ox, oy = self.atk_hitbox[k, frame].T
+        self.ax[lanes, owner] = self.a_cx[lanes, owner] + ox * self.a_facing[lanes, owner] - w // 2
+        self.ay[lanes, owner] = self.a_cy[lanes, owner] - oy - h // 2
+        self.aw[lanes, owner] = w
+        self.ah[lanes, owner] = h
+
+    def _alloc_slot(self, lanes, owner):
+        """
+        指定した試合で空いている飛び道具スロットを探す。
+
+        Returns:
+            (空きがあった行の真偽配列, その行のスロット番号)
+        """
+        free = ~self.p_alive[lanes, owner]
+        ok = free.any(axis=1)
+        self.overflow += int((~ok).sum())
+        return ok, free[ok].argmax(axis=1)
+
+    def _spawn(self, want, owner, kind):
+        """Projectile の生成（持ち主の横に出す）"""
+        lanes = np.flatnonzero(want)
+        if lanes.size == 0:
+            return
+        ok, slots = self._alloc_slot(lanes, owner)
+        lanes = lanes[ok]
+        w, h = self.proj_size[kind]
+        fx, fy = self.x[lanes, owner], self.y[lanes, owner]
+        fw, fh = self.w[lanes, owner], self.h[lanes, owner]
+        facing = self.facing[lanes, owner]
+
+        x = np.where(facing == 1, fx + fw, fx - w)
+        y = fy + fh // 2 - h // 2
+        self._place(lanes, owner, slots, kind, x, y, facing)
+
+    def _place(self, lanes, owner, slots, kind, x, y, facing):
+        w, h = self.proj_size[kind]
+        hw, hh = self.proj_hitbox[kind]
+        self.p_alive[lanes, owner, slots] = True
+        self.p_kind[lanes, owner, slots] = kind
+        self.px[lanes, owner, slots] = x
+        self.py[lanes, owner, slots] = y
+        self.pw[lanes, owner, slots] = w
+        self.ph[lanes, owner, slots] = h
+        self.phx[lanes, owner, slots] = x + w // 2 - hw // 2
+        self.phy[lanes, owner, slots] = y + h // 2 - hh // 2
+        self.p_angle[lanes, owner, slots] = 0
+        self.p_facing[lanes, owner, slots] = facing
+        count = len(lanes)
+        self.p_seq[lanes, owner, slots] = np.arange(self.next_seq, self.next_seq + count)
+        self.next_seq += count
+
+    def _throw(self, a, d, want):
+        """try_throw と同じ条件・効果"""
+        cx_a = self.x[:, a] + self.w[:, a] // 2
+        cx_d = self.x[:, d] + self.w[:, d] // 2
+        bottom_a = self.y[:, a] + self.h[:, a]
+        bottom_d = self.y[:, d] + self.h[:, d]
+        ok = (want & (self.throw_cool[:, a] <= 0) &
+              (np.abs(cx_a - cx_d) < THROW_RANGE) & (np.abs(bottom_a - bottom_d) < THROW_HEIGHT))
+        if not ok.any():
+            return
+        self.hp[ok, d] -= THROW_DAMAGE
+        self.x[ok, d] += THROW_KNOCK * self.facing[ok, a]
+        self.vy[ok, d] = THROW_VY
+        self.on_ground[ok, d] = False
+        self.energy[ok, a] = np.minimum(100, self.energy[ok, a] + THROW_ENERGY)
+        self.throw_cool[ok, a] = THROW_COOL
+
+    def _set_pose_size(self, mask, i, pose):
+        """Fighter.set_pose と同じく足元中央を保ったまま矩形サイズを変える"""
+        w, h = self.pose_size[pose]
+        cx = self.x[mask, i] + self.w[mask, i] // 2
+        bottom = self.y[mask, i] + self.h[mask, i]
+        self.pose[mask, i] = pose
+        self.w[mask, i] = w
+        self.h[mask, i] = h
+        self.x[mask, i] = cx - w // 2
+        self.y[mask, i] = bottom - h
+
+    def _update_fighter(self, i, e, held):
+        """Fighter.update と同じ処理"""
+        left = (held & BIT["left"]) != 0
+        right = (held & BIT["right"]) != 0
+        vx = np.zeros(self.n, np.int32)
+
+        # 攻撃・硬直中フレーム管理
+        atk = self.atk_timer[:, i]
+        rec = self.rec_timer[:, i]
+        in_attack = atk > 0
+        in_recover = ~in_attack & (rec > 0)
+        atk -= in_attack
+        rec -= in_recover
+        ended = in_attack & (atk == 0)
+        rec[ended] = self.atk_cooldown[self.move[ended, i]]
+        self.attacking[~in_attack & ~in_recover, i] = False
+
+        # 投げクールダウン・エネルギー回復
+        self.throw_cool[:, i] -= self.throw_cool[:, i] > 0
+        regen = self.energy[:, i] < 100
+        self.energy[regen, i] += 0.1
+
+        can_move = (atk == 0) & (rec == 0)
+
+        # しゃがみ
+        want_crouch = ((held & BIT["down"]) != 0) & self.on_ground[:, i] & can_move
+        start = want_crouch & ~self.crouch[:, i]
+        end = ~want_crouch & self.crouch[:, i]
+        self.crouch[start, i] = True
+        self.crouch[end, i] = False
+        self._set_pose_size(start, i, CROUCH)
+        self._set_pose_size(end, i, IDLE)
+        crouch = self.crouch[:, i]
+
+        # 防御
+        cx = self.x[:, i] + self.w[:, i] // 2
+        enemy_cx = self.x[:, e] + self.w[:, e] // 2
+        back_left = enemy_cx > cx
+        guard = (~self.attacking[:, i] & ~crouch & can_move &
+                 np.where(back_left, left, right))
+        self.guarding[:, i] = guard
+        vx[guard] = np.where(back_left[guard], -GUARD_SPEED, GUARD_SPEED)
+
+        # 通常移動
+        move = ~guard & ~crouch & can_move
+        ml = move & left
+        mr = move & right
+        vx[ml] = -WALK_SPEED
+        self.facing[ml, i] = -1
+        vx[mr] = WALK_SPEED
+        self.facing[mr, i] = 1
+
+        # ジャンプ
+        jump = ((held & BIT["jump"]) != 0) & self.on_ground[:, i] & ~crouch & can_move
+        self.vy[jump, i] = JUMP_VY
+        self.on_ground[jump, i] = False
+
+        # 待機ポーズ
+        self.pose[can_move & ~crouch, i] = IDLE
+
+        # 重力・位置更新
+        self.vy[:, i] += GRAVITY
+        self.x[:, i] += vx
+        self.y[:, i] += self.vy[:, i]
+        landed = self.y[:, i] + self.h[:, i] >= game.FLOOR
+        self.y[landed, i] = game.FLOOR - self.h[landed, i]
+        self.vy[landed, i] = 0
+        self.on_ground[landed, i] = True
+
+        # くらい判定
+        cx = self.x[:, i] + self.w[:, i] // 2
+        cy = self.y[:, i] + self.h[:, i] // 2
+        self.hbx[:, i] = cx - HURTBOX_SIZE[0] // 2
+        self.hby[:, i] = self.y[:, i] + self.h[:, i] - HURTBOX_SIZE[1]
+
+        # 攻撃中のくらい判定
+        # 技のポーズのままのときだけ、技の表のそのフレームの値を使う
+        move = self.move[:, i]
+        valid = (atk != 0) & (self.pose[:, i] == self.atk_pose[move])
+        m = np.flatnonzero(valid)
+        k = move[m]
+        frame = self.atk_frames[k] - 1 - atk[m]
+        w, h, ox, oy = self.atk_hurtbox[k, frame].T
+        valid[m] = w > 0
+        self.ahb_valid[:, i] = valid
+        self.ahw[m, i] = w
+        self.ahh[m, i] = h
+        self.ahx[m, i] = cx[m] + ox * self.facing[m, i] - w // 2
+        self.ahy[m, i] = cy[m] - oy - h // 2
+
+    def _update_projectiles(self):
+        """Projectile.update と同じ処理（生きているスロットだけを扱う）"""
+        idx = np.flatnonzero(self.p_alive)
+        if idx.size == 0:
+            return
+        px, py, pw, ph = (a.reshape(-1) for a in (self.px, self.py, self.pw, self.ph))
+        kind = self.p_kind.reshape(-1)[idx]
+
+        cx = px[idx] + self.proj_speed[kind] * self.p_facing.reshape(-1)[idx] + pw[idx] // 2
+        cy = py[idx] + ph[idx] // 2
+
+        # 回転しない種類は表のサイズが常に元のサイズなので同じ式で扱える
+        angle = (self.p_angle.reshape(-1)[idx] + self.proj_rotate[kind]) % 360
+        w = self.rot_w[kind, angle]
+        h = self.rot_h[kind, angle]
+        x = cx - w // 2
+        self.p_angle.reshape(-1)[idx] = angle
+        px[idx] = x
+        py[idx] = cy - h // 2
+        pw[idx] = w
+        ph[idx] = h
+        self.phx.reshape(-1)[idx] = cx - self.proj_hitbox[kind, 0] // 2
+        self.phy.reshape(-1)[idx] = cy - self.proj_hitbox[kind, 1] // 2
+
+        off = (x + w < 0) | (x > game.WIDTH)
+        self.p_alive.reshape(-1)[idx[off]] = False
+
+    def _fuse_projectiles(self):
+        """
+        CollisionSystem.fuse_projectiles と同じ融合処理。
+        発生順に見ていき、まだ残っている手裏剣と螺旋丸の最初の組を融合する。
+        """
+        alive = self.p_alive
+        idx = np.flatnonzero(alive)
+        if idx.size < 2:
+            return
+        # 同じ持ち主が手裏剣と螺旋丸の両方を持っている試合だけを調べる
+        kind = self.p_kind.reshape(-1)[idx]
+        has_beam = np.zeros(self.n * F, bool)
+        has_bomb = np.zeros(self.n * F, bool)
+        has_beam[idx[kind == BEAM] // self.p] = True
+        has_bomb[idx[kind == BOMB] // self.p] = True
+        cand = (has_beam & has_bomb).reshape(self.n, F)
+        if not cand.any():
+            return
+
+        lanes, owners = np.nonzero(cand)
+        order = np.argsort(np.where(alive[lanes, owners], self.p_seq[lanes, owners],
+                                    np.iinfo(np.int64).max), axis=1)
+        take = lambda arr: np.take_along_axis(arr[lanes, owners], order, axis=1)
+        kind = take(self.p_kind)
+        x, y, w, h = take(self.px), take(self.py), take(self.pw), take(self.ph)
+        live = take(alive).copy()
+
+        # 組ごとの重なりと種類の組み合わせ (M, P, P)
+        overlap = _collide(x[:, :, None], y[:, :, None], w[:, :, None], h[:, :, None],
+                           x[:, None, :], y[:, None, :], w[:, None, :], h[:, None, :])
+        mixed = (((kind[:, :, None] == BEAM) & (kind[:, None, :] == BOMB)) |
+                 ((kind[:, :, None] == BOMB) & (kind[:, None, :] == BEAM)))
+        p = self.p
+        upper = np.triu(np.ones((p, p), bool), k=1)
+        valid = overlap & mixed & upper
+
+        fused_i, fused_j, rows = [], [], []
+        m = np.arange(len(lanes))
+        for i in range(p):
+            # i 番目がまだ残っていれば、残っている最初の j と融合する
+            ok = valid[:, i, :] & live & live[:, i:i + 1]
+            has = ok.any(axis=1)
+            if not has.any():
+                continue
+            j = ok.argmax(axis=1)
+            live[m[has], i] = False
+            live[m[has], j[has]] = False
+            rows.append(m[has])
+            fused_i.append(np.full(has.sum(), i))
+            fused_j.append(j[has])
+
+        if not rows:
+            return
+        rows = np.concatenate(rows)
+        fi = np.concatenate(fused_i)
+        fj = np.concatenate(fused_j)
+        cx = (x[rows, fi] + w[rows, fi] // 2 + x[rows, fj] + w[rows, fj] // 2) // 2
+        cy = (y[rows, fi] + h[rows, fi] // 2 + y[rows, fj] + h[rows, fj] // 2) // 2
+
+        # 元の2つを消す
+        slot_i = order[rows, fi]
+        slot_j = order[rows, fj]
+        lane_r, owner_r = lanes[rows], owners[rows]
+        self.p_alive[lane_r, owner_r, slot_i] = False
+        self.p_alive[lane_r, owner_r, slot_j] = False
+
+        # 螺旋手裏剣を融合位置の中心に出す
+        # 同じ試合・持ち主で複数融合した場合は、空きスロットを取り直すため順番に出す
+        w, h = self.proj_size[RASEN]
+        pending = np.arange(len(rows))
+        while pending.size:
+            _, first = np.unique(lane_r[pending] * F + owner_r[pending], return_index=True)
+            batch = pending[first]
+            pending = np.setdiff1d(pending, batch)
+            for owner in range(F):
+                sel = batch[owner_r[batch] == owner]
+                if sel.size == 0:
+                    continue
+                ok, slots = self._alloc_slot(lane_r[sel], owner)
+                sel = sel[ok]
+                lanes_k = lane_r[sel]
+                self._place(lanes_k, owner, slots, RASEN, cx[sel] - w // 2, cy[sel] - h // 2,
+                            self.facing[lanes_k, owner])
+
+    def _resolve_hits(self):
+        """CollisionSystem.resolve_hits と同じ当たり処理（ダメージ・ノックバックは合計）"""
+        damage = np.zeros((self.n, F), np.int32)
+        knock_x = np.zeros((self.n, F), np.int32)
+        lift = np.zeros((self.n, F), bool)
+
+        hbw, hbh = HURTBOX_SIZE
+        for o in range(F):
+            t = 1 - o
+            guard = self.guarding[:, t]
+
+            # 攻撃判定
+            hit = self.a_alive[:, o] & (
+                _collide(self.ax[:, o], self.ay[:, o], self.aw[:, o], self.ah[:, o],
+                         self.hbx[:, t], self.hby[:, t], hbw, hbh) |
+                (self.ahb_valid[:, t] &
+                 _collide(self.ax[:, o], self.ay[:, o], self.aw[:, o], self.ah[:, o],
+                          self.ahx[:, t], self.ahy[:, t], self.ahw[:, t], self.ahh[:, t])))
+            dmg = np.where(guard, self.a_damage[:, o] // 3, self.a_damage[:, o])
+            dmg = np.where(hit, dmg, 0)
+            damage[:, t] += dmg
+            knock_x[:, t] += dmg * 2 * self.facing[:, o]
+            lift[:, t] |= hit & (dmg * 2 > 10)
+            self.a_alive[:, o] &= ~hit
+
+        # 飛び道具（生きているスロットだけを扱う）
+        idx = np.flatnonzero(self.p_alive)
+        if idx.size:
+            lane = idx // (F * self.p)
+            owner = (idx // self.p) % F
+            target = 1 - owner
+            kind = self.p_kind.reshape(-1)[idx]
+            hit = _collide(self.phx.reshape(-1)[idx], self.phy.reshape(-1)[idx],
+                           self.proj_hitbox[kind, 0], self.proj_hitbox[kind, 1],
+                           self.hbx[lane, target], self.hby[lane, target], hbw, hbh)
+            if hit.any():
+                lane, owner, target, kind = lane[hit], owner[hit], target[hit], kind[hit]
+                base = self.proj_damage[kind]
+                dmg = np.where(self.guarding[lane, target], base // 3, base)
+                np.add.at(damage, (lane, target), dmg)
+                np.add.at(knock_x, (lane, target), dmg * 2 * self.facing[lane, owner])
+                big = dmg * 2 > 10
+                lift[lane[big], target[big]] = True
+                self.p_alive.reshape(-1)[idx[hit]] = False
+
+        self.hp -= damage
+        self.x += knock_x
+        self.vy[lift] = -8
+        self.on_ground[lift] = False
+
+
+# =====================
+# 入力の生成
+# =====================
+def random_inputs(rng: np.random.Generator, lanes: int,
+                  press_rate: float = 0.08) -> tuple[np.ndarray, np.ndarray]:
+    """
+    ランダムな入力を作る（バランス調整用のでたらめなプレイヤー）。
+
+    Returns:
+        (held, pressed) それぞれ (N, 2) の uint16
+    """
+    move_bits = int(BIT["left"] | BIT["right"] | BIT["jump"] | BIT["down"])
+    held = rng.integers(0, 1 << 16, (lanes, F), dtype=np.uint16) & np.uint16(move_bits)
+    pressed = rng.integers(0, 1 << 16, (lanes, F), dtype=np.uint16) & np.uint16(0x1FF)
+    pressed[rng.random((lanes, F)) >= press_rate] = 0
+    return held, pressed
+
+
+def chase_inputs(engine: BatchEngine, rng: np.random.Generator,
+                 press_rate: float = 0.08, chase_rate: float = 0.7) -> tuple[np.ndarray, np.ndarray]:
+    """
+    相手に近づく入力を混ぜたランダム入力（投げや接近戦が起きやすい）。
+
+    Returns:
+        (held, pressed) それぞれ (N, 2) の uint16
+    """
+    held, pressed = random_inputs(rng, engine.n, press_rate)
+    cx = engine.x + engine.w // 2
+    toward_right = cx[:, ::-1] > cx
+    chase = rng.random((engine.n, F)) < chase_rate
+    held[chase] &= ~(BIT["left"] | BIT["right"])
+    held[chase] |= np.where(toward_right[chase], BIT["right"], BIT["left"])
+    return held, pressed
+
+
+# =====================
+# オブジェクト版との突き合わせ
+# =====================
+def _lane_state(engine: BatchEngine, lane: int) -> dict:
+    """BatchEngine の1試合分を比較用の形にする"""
+    fighters = []
+    for i in range(F):
+        ahb = None
+        if engine.ahb_valid[lane, i]:
+            ahb = (int(engine.ahx[lane, i]), int(engine.ahy[lane, i]),
+                   int(engine.ahw[lane, i]), int(engine.ahh[lane, i]))
+        fighters.append({
+            "rect": (int(engine.x[lane, i]), int(engine.y[lane, i]),
+                     int(engine.w[lane, i]), int(engine.h[lane, i])),
+            "vy": int(engine.vy[lane, i]),
+            "hp": int(engine.hp[lane, i]),
+            "energy": float(engine.energy[lane, i]),
+            "facing": int(engine.facing[lane, i]),
+            "on_ground": bool(engine.on_ground[lane, i]),
+            "crouch": bool(engine.crouch[lane, i]),
+            "guard": bool(engine.guarding[lane, i]),
+            "timers": (int(engine.atk_timer[lane, i]), int(engine.rec_timer[lane, i]),
+                       int(engine.throw_cool[lane, i])),
+            "hurtbox": (int(engine.hbx[lane, i]), int(engine.hby[lane, i])),
+            "attack_hurtbox": ahb,
+        })
+    attacks = sorted(
+        (i, (int(engine.ax[lane, i]), int(engine.ay[lane, i]),
+             int(engine.aw[lane, i]), int(engine.ah[lane, i])), int(engine.a_life[lane, i]))
+        for i in range(F) if engine.a_alive[lane, i])
+    projectiles = sorted(
+        (o, KINDS[engine.p_kind[lane, o, s]],
+         (int(engine.px[lane, o, s]), int(engine.py[lane, o, s]),
+          int(engine.pw[lane, o, s]), int(engine.ph[lane, o, s])),
+         (int(engine.phx[lane, o, s]), int(engine.phy[lane, o, s])))
+        for o in range(F) for s in range(engine.p) if engine.p_alive[lane, o, s])
+    return {"fighters": fighters, "attacks": attacks, "projectiles": projectiles}
+
+
+def _sim_state(sim: "game.BattleSim") -> dict:
+    """BattleSim を比較用の形にする"""
+    fighters = []
+    for f in sim.fighters:
+        ahb = tuple(f.attack_hurtbox) if f.attack_hurtbox else None
+        fighters.append({
+            "rect": tuple(f.rect),
+            "vy": f.vy,
+            "hp": f.hp,
+            "energy": float(f.energy),
+            "facing": f.facing,
+            "on_ground": f.on_ground,
+            "crouch": f.is_crouching,
+            "guard": f.is_guarding,
+            "timers": (f.attack_timer, f.recover_timer, f.throw_cool),
+            "hurtbox": tuple(f.hurtbox.topleft),
+            "attack_hurtbox": ahb,
+        })
+    index = {f: i for i, f in enumerate(sim.fighters)}
+    attacks = sorted((index[a.owner], tuple(a.rect), a.life) for a in sim.attacks)
+    projectiles = sorted((index[p.owner], p.kind, tuple(p.rect), tuple(p.hitbox.topleft))
+                         for p in sim.projectiles)
+    return {"fighters": fighters, "attacks": attacks, "projectiles": projectiles}
+
+
+def cross_check(frames: int = 3000, lanes: int = 64, lane: int = 0, seed: int = 0,
+                press_rate: float = 0.08, chase: bool = True) -> int:
+    """
+    BatchEngine の1試合を BattleSim と毎フレーム比較する。
+    決着したら両方を初期化して続ける。
+
+    Args:
+        chase: 相手に近づく入力を混ぜる（投げや接近戦も確認する）
+
+    Returns:
+        一致を確認したフレーム数（食い違いがあれば AssertionError）
+    """
+    rng = np.random.default_rng(seed)
+    engine = BatchEngine(lanes)
+    p1_name, p2_name = engine.characters
+    sim = game.BattleSim(game.Fighter(200, game.P1_KEYS, p1_name, headless=True),
+                         game.Fighter(700, game.P2_KEYS, p2_name, headless=True))
+    sim.reset()
+
+    for frame in range(frames):
+        if chase:
+            held, pressed = chase_inputs(engine, rng, press_rate)
+        else:
+            held, pressed = random_inputs(rng, lanes, press_rate)
+        engine.step(held, pressed)
+        sim.step(tuple(game.PlayerInput(int(held[lane, i]), int(pressed[lane, i]))
+                       for i in range(F)))
+
+        expected = _sim_state(sim)
+        actual = _lane_state(engine, lane)
+        if expected != actual:
+            raise AssertionError(
+                f"frame {frame}: mismatch\n  object: {expected}\n  batch:  {actual}")
+
+        if sim.is_over():
+            assert engine.done[lane], f"frame {frame}: batch lane not finished"
+            sim = game.BattleSim(game.Fighter(200, game.P1_KEYS, p1_name, headless=True),
+                                 game.Fighter(700, game.P2_KEYS, p2_name, headless=True))
+            sim.reset()
+            mask = np.zeros(lanes, bool)
+            mask[lane] = True
+            engine.reset(mask)
+    return frames
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="NumPy による一括対戦シミュレーション")
+    parser.add_argument("--lanes", type=int, default=4096, help="同時に進める試合数")
+    parser.add_argument("--frames", type=int, default=game.MATCH_TIME * game.FPS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check", action="store_true",
+                        help="1試合をオブジェクト版と毎フレーム比較する")
+    args = parser.parse_args()
+
+    if args.check:
+        n = cross_check(args.frames, seed=args.seed)
+        print(f"cross-check ok: {n} frames")
+        return
+
+    rng = np.random.default_rng(args.seed)
+    engine = BatchEngine(args.lanes)
+    start = time.perf_counter()
+    for _ in range(args.frames):
+        engine.step(*random_inputs(rng, args.lanes))
+        if engine.done.all():
+            break
+    elapsed = time.perf_counter() - start
+    steps = int(engine.frame.max())
+    print(f"{args.lanes} matches x {steps} frames in {elapsed:.2f} s "
+          f"({args.lanes * steps / elapsed:,.0f} match-frames/s)")
+    wins = np.bincount(engine.winner[engine.done], minlength=3)
+    print(f"P1 {wins[0]}  P2 {wins[1]}  Draw {wins[2]}  "
+          f"KO {int(engine.ko.sum())}  unfinished {int((~engine.done).sum())}")
+    if engine.overflow:
+        print(f"[warning] projectile slots overflowed {engine.overflow} times")
+
+
+if __name__ == "__main__":
+    main()
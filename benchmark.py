@@ -0,0 +1,318 @@
+"""
+シミュレーションと描画の速さを測るベンチマーク。
+
+決まった入力のシナリオを実際のコード（BattleSim・BattleRenderer・メニュー）で動かし、
+画面なしのシミュレーション速度と、SDL の dummy ドライバでの描画込みの速度を測る。
+結果は JSON で保存して、コミット間で比べられる。
+
+    python benchmark.py --output bench.json
+    python benchmark.py --compare bench.json      # 前回の結果と比べる
+    python benchmark.py --scenario trading --frames 5000
+    python benchmark.py --render-scale 0.5 --scale-mode blit
+    python benchmark.py --no-menus --check-dirty  # 差分描画が全体の描き直しより遅くないか確かめる
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import pygame as pg
+
+import kakutou_koukaton as game
+
+
+def held(*names: str) -> int:
+    bits = 0
+    for name in names:
+        bits |= game.ACTION_BIT[name]
+    return bits
+
+
+def make_input(hold=(), press=()) -> game.PlayerInput:
+    return game.PlayerInput(held(*hold), held(*press))
+
+
+def approach(sim: game.BattleSim, i: int, distance: int) -> tuple:
+    """相手との距離が distance より遠ければ相手の方へ歩く入力"""
+    me = sim.fighters[i]
+    enemy = sim.fighters[1 - i]
+    if abs(me.rect.centerx - enemy.rect.centerx) <= distance:
+        return ()
+    return ("right",) if enemy.rect.centerx > me.rect.centerx else ("left",)
+
+
+# =====================
+# シナリオ
+# =====================
+# 各シナリオは (説明, 入力を返す関数, 毎フレーム前の準備)
+def idle_inputs(sim, frame):
+    return make_input(), make_input()
+
+
+def trading_inputs(sim, frame):
+    """近づいてパンチとキックを打ち合う"""
+    p1 = ("punch",) if frame % 12 == 0 else ("kick",) if frame % 12 == 6 else ()
+    p2 = ("kick",) if frame % 12 == 3 else ("punch",) if frame % 12 == 9 else ()
+    return (make_input(approach(sim, 0, 90), p1),
+            make_input(approach(sim, 1, 90), p2))
+
+
+def projectile_inputs(sim, frame):
+    """手裏剣と螺旋丸を同時に撃ち続けて螺旋手裏剣に融合させる"""
+    p1 = ("beam", "bomb") if frame % 8 == 0 else ()
+    p2 = ("beam", "bomb") if frame % 8 == 4 else ()
+    return make_input((), p1), make_input((), p2)
+
+
+def refill_energy(sim, frame):
+    # 撃ち続けられるようにエネルギーを満タンにしておく
+    for f in sim.fighters:
+        f.energy = 100
+
+
+def throw_inputs(sim, frame):
+    """近づいて投げ続ける（投げ返しもある）"""
+    return (make_input(approach(sim, 0, 50), ("throw",)),
+            make_input(approach(sim, 1, 50), ("throw",) if frame % 2 else ()))
+
+
+SCENARIOS = {
+    "idle": ("何もしない", idle_inputs, None),
+    "trading": ("パンチ・キックの打ち合い", trading_inputs, None),
+    "projectiles": ("飛び道具の連射と融合", projectile_inputs, refill_energy),
+    "throws": ("投げの繰り返し", throw_inputs, None),
+}
+MENUS = ("title", "select", "pause", "settings")
+
+# --check-dirty で、差分描画が全体の描き直しよりこの割合まで遅くても測定のぶれとみなす
+DIRTY_TOLERANCE = 0.05
+
+
+def new_sim(headless: bool) -> game.BattleSim:
+    sim = game.BattleSim(game.Fighter(200, game.P1_KEYS, "man", headless=headless),
+                         game.Fighter(700, game.P2_KEYS, "woman", headless=headless))
+    sim.reset()
+    return sim
+
+
+def run_battle(name: str, frames: int, sim: game.BattleSim, draw=None) -> dict:
+    """シナリオを frames フレーム動かして、フレーム/秒と出来事の数を返す"""
+    _, inputs_for, prepare = SCENARIOS[name]
+    hud = game.HUD()
+    stats = {"fusions": 0, "throws": 0, "damage": 0, "kos": 0, "allocations": 0}
+    start = time.perf_counter()
+    for frame in range(frames):
+        if prepare:
+            prepare(sim, frame)
+        kinds_before = sum(p.kind == "rasensyuriken" for p in sim.projectiles)
+        cools_before = [f.throw_cool for f in sim.fighters]
+        hp_before = [f.hp for f in sim.fighters]
+        sim.step(inputs_for(sim, frame))
+        stats["fusions"] += max(0, sum(p.kind == "rasensyuriken" for p in sim.projectiles) - kinds_before)
+        stats["throws"] += sum(f.throw_cool > c for f, c in zip(sim.fighters, cools_before))
+        stats["damage"] += sum(max(0, hp - f.hp) for f, hp in zip(sim.fighters, hp_before))
+        stats["allocations"] += sim.allocations
+        if draw is not None:
+            hud.update_time(sim.frame)
+            draw(sim, hud)
+        if sim.is_over():
+            stats["kos"] += sim.is_ko()
+            sim.reset()
+    elapsed = time.perf_counter() - start
+    return {"fps": frames / elapsed, **stats}
+
+
+def bench_sim(name: str, frames: int) -> dict:
+    return run_battle(name, frames, new_sim(headless=True))
+
+
+def bench_render(name: str, frames: int, dirty: bool) -> dict:
+    sim = new_sim(headless=False)
+    renderer = game.BattleRenderer(dirty, game.VIEW)
+    particles = game.ParticleSystem()
+    stage_bg = game.stage_background(0)
+
+    def draw(sim, hud):
+        pg.event.pump()
+        particles.emit_battle_events(sim)
+        particles.update()
+        rects = game.VIEW.present_battle(
+            renderer.draw(game.VIEW.battle_target, sim, hud, stage_bg, particles=particles))
+        pg.display.update(rects) if rects is not None else pg.display.update()
+
+    return run_battle(name, frames, sim, draw)
+
+
+def bench_menu(name: str, frames: int) -> dict:
+    """メニューを描き続ける（10フレームごとに選択や音量を変える）"""
+    hud = game.HUD()
+    pause_menu = game.PauseMenu(hud)
+    settings_menu = game.SettingsMenu(hud)
+    sim = new_sim(headless=False)
+    game.draw_battle(game.screen, sim, hud, game.stage_background(0))
+    battle_surface = game.screen.copy()
+    for layer in (game.TITLE_LAYER, game.SELECT_LAYER, pause_menu.layer, settings_menu.layer):
+        layer.invalidate()
+
+    start = time.perf_counter()
+    for frame in range(frames):
+        step = frame // 10
+        if name == "title":
+            rects = game.draw_title()
+        elif name == "select":
+            rects = game.draw_select(step % (len(game.STAGES) + 1))
+        elif name == "pause":
+            pause_menu.selected = step % len(pause_menu.options)
+            rects = pause_menu.draw(game.screen, battle_surface)
+        else:
+            hud.volume = (step % 21) * 0.05
+            rects = settings_menu.draw(game.screen, battle_surface)
+        pg.event.pump()
+        rects = game.VIEW.present_menu(rects)
+        pg.display.update(rects) if rects is not None else pg.display.update()
+    return {"fps": frames / (time.perf_counter() - start)}
+
+
+def best_of(repeat: int, func, *args) -> dict:
+    """repeat 回測って最も速かった回を返す"""
+    return max((func(*args) for _ in range(repeat)), key=lambda r: r["fps"])
+
+
+# =====================
+# 実行
+# =====================
+def git_revision() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=game.BASE_DIR,
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(scenarios: list[str], menus: list[str], frames: int, repeat: int,
+        view: game.RenderView | None = None) -> dict:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    game.init_app(view)
+    game.preload_assets()
+    for i in range(len(game.STAGES)):
+        game.stage_background(i)
+    game.title_background()
+
+    results = {}
+    for name in scenarios:
+        # 最初の1回は画像の回転フレームなどの準備を含むので捨てる
+        bench_sim(name, min(frames, 300))
+        sim = best_of(repeat, bench_sim, name, frames)
+        render = best_of(repeat, bench_render, name, frames, True)
+        full = best_of(repeat, bench_render, name, frames, False)
+        results[name] = {
+            "description": SCENARIOS[name][0],
+            "sim_fps": round(sim["fps"], 1),
+            "render_fps": round(render["fps"], 1),
+            "render_full_redraw_fps": round(full["fps"], 1),
+            # 差分描画が全体の描き直し（KOUKATON_FULL_REDRAW=1）の何倍速いか
+            "dirty_speedup": round(render["fps"] / full["fps"], 2),
+            "fusions": sim["fusions"],
+            "throws": sim["throws"],
+            "damage": sim["damage"],
+            "kos": sim["kos"],
+            # 攻撃判定・飛び道具のレコードを新しく作った回数（使い回せていれば少ないまま増えない）
+            "allocations": sim["allocations"],
+        }
+        print(f"{name:<12} sim {sim['fps']:10.0f} fps   render {render['fps']:8.0f} fps"
+              f"   full redraw {full['fps']:8.0f} fps (x{render['fps'] / full['fps']:.2f})"
+              f"   allocations {sim['allocations']}", file=sys.stderr)
+    for name in menus:
+        menu = best_of(repeat, bench_menu, name, frames)
+        results[f"menu_{name}"] = {"render_fps": round(menu["fps"], 1)}
+        print(f"menu_{name:<7} render {menu['fps']:8.0f} fps", file=sys.stderr)
+
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pygame": pg.version.ver,
+            "platform": platform.platform(),
+            "video_driver": os.environ.get("SDL_VIDEODRIVER"),
+            "frames": frames,
+            "repeat": repeat,
+            "render_scale": game.VIEW.scale,
+            "scale_mode": game.VIEW.mode,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, previous: dict) -> None:
+    """前回の JSON と比べて、速さの変化を表示する"""
+    rev = previous.get("meta", {}).get("revision")
+    print(f"compared with {rev or 'previous run'}", file=sys.stderr)
+    for name, result in current["results"].items():
+        old = previous.get("results", {}).get(name)
+        if not old:
+            continue
+        parts = []
+        for key in ("sim_fps", "render_fps", "render_full_redraw_fps"):
+            if key in result and old.get(key):
+                parts.append(f"{key} {result[key] / old[key] - 1:+.1%}")
+        print(f"  {name:<14} " + "  ".join(parts), file=sys.stderr)
+
+
+def check_dirty(result: dict) -> bool:
+    """差分描画が、どのシナリオでも全体の描き直しより遅くない（DIRTY_TOLERANCE まで）か"""
+    ok = True
+    for name, r in result["results"].items():
+        if "dirty_speedup" in r and r["dirty_speedup"] < 1 - DIRTY_TOLERANCE:
+            print(f"dirty rects slower than full redraw in {name}: "
+                  f"{r['render_fps']} vs {r['render_full_redraw_fps']} fps", file=sys.stderr)
+            ok = False
+    if ok:
+        print("dirty rects ok", file=sys.stderr)
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="シミュレーションと描画のベンチマーク")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS),
+                        help="測るシナリオ（複数指定可、省略時はすべて）")
+    parser.add_argument("--menu", action="append", choices=MENUS,
+                        help="測るメニュー画面（複数指定可、省略時はすべて）")
+    parser.add_argument("--no-menus", action="store_true", help="メニュー画面を測らない")
+    parser.add_argument("--frames", type=int, default=3000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="結果の JSON を書き出すファイル（省略時は標準出力）")
+    parser.add_argument("--compare", help="比べる前回の JSON")
+    parser.add_argument("--render-scale", type=float, choices=game.RENDER_SCALES, default=1.0,
+                        help="内部の描画解像度の倍率")
+    parser.add_argument("--scale-mode", choices=("scaled", "blit"), default="scaled",
+                        help="縮小した絵の拡大の方法")
+    parser.add_argument("--check-dirty", action="store_true",
+                        help="差分描画が全体の描き直しより遅いシナリオがあれば失敗（終了コード 1）にする")
+    args = parser.parse_args()
+
+    menus = [] if args.no_menus else (args.menu or list(MENUS))
+    view = game.RenderView(args.render_scale, args.scale_mode)
+    result = run(args.scenario or list(SCENARIOS), menus, args.frames, args.repeat, view)
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(result, json.load(f))
+    pg.quit()
+    if args.check_dirty and not check_dirty(result):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
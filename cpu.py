@@ -0,0 +1,431 @@
+"""
+CPU 対戦相手。
+
+試合状態のコピーから何手か先まで読むビームサーチで行動を選び、人と同じ操作（PlayerInput）で
+ファイターを動かす。探索は1フレームごとの時間（強さごとの budget_ms）で区切るか、
+別プロセス（CpuProcess）で行う。
+
+    KOUKATON_CPU=2 KOUKATON_CPU_LEVEL=hard python kakutou_koukaton.py
+    KOUKATON_CPU=2 KOUKATON_CPU_PROCESS=1 python kakutou_koukaton.py
+"""
+import math
+import multiprocessing
+import os
+import random
+import time
+
+import kakutou_koukaton as game
+
+
+# CPU が選ぶ行動 (名前, 押しっぱなしの操作, 最初のフレームで押す操作)。"forward" / "back" は向きで左右に直す
+CPU_ACTIONS = (
+    ("wait", (), ()),
+    ("forward", ("forward",), ()),
+    ("back", ("back",), ()),          # 相手に背を向けて下がる＝ガード
+    ("jump", ("jump",), ()),
+    ("jump_forward", ("jump", "forward"), ()),
+    ("crouch", ("down",), ()),
+    ("punch", (), ("punch",)),
+    ("kick", (), ("kick",)),
+    ("beam", (), ("beam",)),
+    ("bomb", (), ("bomb",)),
+    ("throw", ("forward",), ("throw",)),
+)
+
+# 強さ
+#   budget_ms: 1フレームに探索に使ってよい時間
+#   frames: 1つの行動を続けるフレーム数（この間に次の行動を探索するので、反応の遅れにもなる）
+#   depth: 何手先まで読むか / width: 各深さで残す候補の数 / mistake: でたらめに動く確率
+CPU_LEVELS = {
+    "easy": {"budget_ms": 0.8, "frames": 10, "depth": 1, "width": 1, "mistake": 0.3},
+    "normal": {"budget_ms": 1.5, "frames": 10, "depth": 2, "width": 3, "mistake": 0.02},
+    "hard": {"budget_ms": 3.0, "frames": 8, "depth": 3, "width": 4, "mistake": 0.0},
+}
+
+
+def cpu_input(action: int, facing: int, first: bool) -> game.PlayerInput:
+    """CPU_ACTIONS の行動を、向きを考えた PlayerInput にする"""
+    _, hold, press = CPU_ACTIONS[action]
+    forward, back = ("right", "left") if facing == 1 else ("left", "right")
+    held = 0
+    for name in hold:
+        held |= game.ACTION_BIT[forward if name == "forward" else back if name == "back" else name]
+    pressed = 0
+    if first:
+        for name in press:
+            pressed |= game.ACTION_BIT[name]
+    return game.PlayerInput(held, pressed)
+
+
+class CpuSearch:
+    """
+    試合状態のコピーから何手か先まで読んで、最もよい行動を選ぶビームサーチ。
+
+    探索は run(締め切り) を何度かに分けて呼んで進められる（途中で時間切れになっても
+    その時点で一番よい行動を返せる。深さの違う評価値は比べられないので、深く読めた方を優先する）。
+    状態は BattleSim.save_state() のバイト列で持ち、試すたびに CPU 専用の画面なしの
+    BattleSim に load_state して進める。
+    """
+
+    def __init__(self, cpu: "CpuPlayer", state: bytes, opponent: game.PlayerInput,
+                 predict: int | None = None) -> None:
+        """
+        Args:
+            predict: 指定すると、state からこの行動を続けた後の状態を予想して、そこから読む
+                     （予想も1回の試し読みとして run() の中で締め切りを守って行う）
+        """
+        self.cpu = cpu
+        self.opponent = opponent
+        self.predict = predict
+        self.depth = 0
+        self.best = (-1, -math.inf)  # (深さ, 評価値)
+        self.best_action = 0
+        self.children = []
+        # (状態, 最初の行動, 評価値)
+        self.frontier = [(state, None, 0.0)]
+        self.queue = self._expand() if predict is None else []
+        self.done = False
+
+    def _expand(self) -> list:
+        order = list(range(len(CPU_ACTIONS)))
+        self.cpu.rng.shuffle(order)  # 時間切れのときに特定の行動ばかり試さないように
+        return [(node, action) for node in self.frontier for action in order]
+
+    def run(self, deadline: float, limit: int | None = None) -> bool:
+        """
+        締め切り（time.perf_counter() の値）まで探索する。読み終わったら True。
+        1回の試し読みにかかる時間の見込みが残り時間を超えるなら、次の試し読みは始めない。
+        limit を指定すると、時間ではなく試し読みの回数で止める（結果が実行環境によらない）。
+        """
+        cpu = self.cpu
+        count = cpu.rollouts
+        while not self.done:
+            if limit is None:
+                if time.perf_counter() + cpu.rollout_time >= deadline:
+                    break
+            elif cpu.rollouts - count >= limit:
+                break
+            if self.predict is not None:
+                predicted, _ = cpu.rollout(self.frontier[0][0], self.predict, self.opponent)
+                self.predict = None
+                self.frontier = [(predicted, None, 0.0)]
+                self.queue = self._expand()
+                if limit is not None:
+                    count += 1  # 回数で区切るときは、予想を除いた読みの回数で数える
+                continue
+            if not self.queue:
+                self.depth += 1
+                self.children.sort(key=lambda c: c[2], reverse=True)
+                self.frontier = self.children[:cpu.width]
+                self.children = []
+                if self.depth >= cpu.depth or not self.frontier:
+                    self.done = True
+                    break
+                self.queue = self._expand()
+                continue
+            (state, first, _), action = self.queue.pop()
+            new_state, score = cpu.rollout(state, action, self.opponent)
+            first = action if first is None else first
+            self.children.append((new_state, first, score))
+            if (self.depth, score) > self.best:
+                self.best = (self.depth, score)
+                self.best_action = first
+        if not self.done and limit is None and cpu.rollouts == count:
+            # 見込みが大きすぎて1回も試せなかったら、見込みを下げて次のフレームで試せるようにする
+            cpu.rollout_time *= 0.8
+        return self.done
+
+
+class CpuPlayer:
+    """
+    どちらかのファイターを操作する CPU。人と同じ操作（PlayerInput）で動かす。
+
+    行動を1つ選んだら frames フレームの間それを続け、その間に毎フレーム budget_ms だけ
+    次の行動を探索する。探索は行動を決めた時点の状態から始めるので、frames フレーム分遅れて反応する。
+    """
+
+    def __init__(self, player: int, char_names=("man", "woman"), level: str = "normal",
+                 seed: int | None = None, rollouts_per_frame: int | None = None,
+                 teams=None) -> None:
+        """
+        Args:
+            player: 操作するファイターの番号（0 が P1）
+            char_names: 全員のキャラクター名（P1, P2, ... の順）
+            level: CPU_LEVELS の強さ
+            seed: でたらめな動きの乱数の種
+            rollouts_per_frame: 指定すると、探索を時間ではなく1フレームあたりの試し読みの回数で区切る
+                                （自動対戦で結果を再現できるようにする）
+            teams: ファイターごとのチーム番号（BattleSim と同じ）
+        """
+        self.player = player
+        self.level = level
+        self.rollouts_per_frame = rollouts_per_frame
+        settings = CPU_LEVELS[level]
+        self.budget = settings["budget_ms"] / 1000
+        self.frames = settings["frames"]
+        self.depth = settings["depth"]
+        self.width = settings["width"]
+        self.mistake = settings["mistake"]
+        self.rng = random.Random(seed)
+        self.rollout_time = 0.0  # 1回の試し読みにかかる時間（秒、移動平均）
+        self.sim = game.BattleSim(*(game.Fighter(0, {}, name, headless=True)
+                                    for name in char_names),
+                                  teams=teams)
+        self.reset()
+        self.warm_up()
+
+    def warm_up(self) -> None:
+        """初回だけ遅い処理を済ませて、試し読みにかかる時間の見込みを作っておく"""
+        self.sim.reset()
+        state = self.sim.save_state()
+        for action in range(len(CPU_ACTIONS)):
+            self.rollout(state, action, game.PlayerInput())
+        self.rollout_time = 0.0
+        for action in range(len(CPU_ACTIONS)):
+            self.rollout(state, action, game.PlayerInput())
+        self.rollouts = 0
+
+    def reset(self) -> None:
+        self.action = 0
+        self.remaining = 0
+        self.search = None
+        self.rollouts = 0
+
+    # ---------------------
+    # 探索
+    # ---------------------
+    def rollout(self, state: bytes, action: int, opponent: game.PlayerInput) -> tuple[bytes, float]:
+        """state から action を frames フレーム続けた後の状態と評価値（自分以外は全員 opponent を続ける）"""
+        start = time.perf_counter()
+        sim = self.sim
+        sim.load_state(state)
+        me = sim.fighters[self.player]
+        for t in range(self.frames):
+            inputs = [opponent] * len(sim.fighters)
+            inputs[self.player] = cpu_input(action, me.facing, t == 0)
+            sim.step(tuple(inputs))
+            if sim.is_over():
+                break
+        self.rollouts += 1
+        result = sim.save_state(), self.evaluate(sim)
+        # GC などでたまに遅くなった分に引きずられないよう、見込みの2倍までで数える
+        elapsed = time.perf_counter() - start
+        if self.rollout_time:
+            elapsed = min(elapsed, self.rollout_time * 2)
+        self.rollout_time += (elapsed - self.rollout_time) * 0.1
+        return result
+
+    def evaluate(self, sim: game.BattleSim) -> float:
+        """自分から見た状態のよさ（3人以上なら、味方と敵の体力の差と一番近い敵との関係で見る）"""
+        me = sim.fighters[self.player]
+        enemies = [f for f in sim.fighters if f.team != me.team]
+        score = float(sum(f.hp for f in sim.fighters if f.team == me.team) - sum(f.hp for f in enemies))
+        score += 1000 * sum(f.hp <= 0 for f in enemies)
+        if me.hp <= 0:
+            score -= 1000
+        # 倒れていない一番近い敵
+        x = me.rect.centerx
+        enemy = min(enemies, key=lambda f: (f.hp <= 0, abs(f.rect.centerx - x)))
+        score += (me.energy - enemy.energy) * 0.05
+        # 飛んでいる飛び道具は、相手の方へ向かっていれば半分当たるものとして数える
+        for proj in sim.projectiles:
+            mine = proj.owner.team == me.team
+            target = enemy if mine else me
+            if (target.rect.centerx - proj.rect.centerx) * proj.facing > 0:
+                score += proj.damage * (0.5 if mine else -0.5)
+        # 近づきすぎず離れすぎない距離を好む
+        score -= abs(abs(me.rect.centerx - enemy.rect.centerx) - 100) * 0.01
+        return score
+
+    def start_search(self, state: bytes, opponent: game.PlayerInput,
+                     predict: int | None = None) -> None:
+        self.search = CpuSearch(self, state, opponent, predict)
+
+    def best_action(self) -> int:
+        """探索結果の行動（強さに応じてわざと間違える）"""
+        if self.mistake and self.rng.random() < self.mistake:
+            return self.rng.randrange(len(CPU_ACTIONS))
+        return self.search.best_action if self.search else 0
+
+    def choose(self, state: bytes, opponent: game.PlayerInput) -> int:
+        """その場で frames フレーム分の予算を使い切って行動を選ぶ（別プロセスでの探索用）"""
+        self.start_search(state, opponent)
+        limit = self.rollouts_per_frame and self.rollouts_per_frame * self.frames
+        self.search.run(time.perf_counter() + self.budget * self.frames, limit)
+        return self.best_action()
+
+    # ---------------------
+    # 毎フレームの操作
+    # ---------------------
+    def act(self, sim: game.BattleSim, opponent: game.PlayerInput | None = None,
+            deadline: float | None = None) -> game.PlayerInput:
+        """
+        このフレームの入力を返す。
+        探索は budget_ms の締め切りまでで、1回の試し読みの見込みが残り時間を超えるなら始めない
+        （行動を決めたときの、その行動が終わったときの状態の予想も1回の試し読みとして数える）。
+
+        Args:
+            sim: 対戦中の BattleSim（読むだけで変更しない）
+            opponent: 相手の直前の入力（探索では相手がこれを続けると仮定する）
+            deadline: 指定すると budget_ms の代わりにこの時刻（time.perf_counter() の値）まで探索する
+        """
+        if deadline is None:
+            deadline = time.perf_counter() + self.budget
+        opponent = game.PlayerInput(opponent.held) if opponent else game.PlayerInput()
+        if self.remaining == 0:
+            self.action = self.best_action()
+            self.remaining = self.frames
+            # 次の行動はこの行動が終わってから出るので、終わったときの状態を予想してそこから読む
+            self.start_search(sim.save_state(), opponent, self.action)
+        self.search.run(deadline, self.rollouts_per_frame)
+
+        first = self.remaining == self.frames
+        self.remaining -= 1
+        return cpu_input(self.action, sim.fighters[self.player].facing, first)
+
+
+def cpu_worker(conn, player: int, char_names, level: str, seed, teams=None) -> None:
+    """別プロセスで探索する CPU の本体。(状態, 相手の入力) を受け取って行動番号を返す"""
+    cpu = CpuPlayer(player, char_names, level, seed, teams=teams)
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            state, opponent = message
+            conn.send(cpu.choose(state, game.PlayerInput.unpack(opponent)))
+    except (EOFError, KeyboardInterrupt):
+        pass
+
+
+class CpuProcess:
+    """
+    探索を別プロセスで行う CPU。act() は結果を待たないので、描画のループを止めない。
+    結果が届くまでは前の行動を続け、届いた行動を frames フレーム続ける。
+    """
+
+    def __init__(self, player: int, char_names=("man", "woman"), level: str = "normal",
+                 seed: int | None = None, teams=None) -> None:
+        self.player = player
+        self.level = level
+        self.frames = CPU_LEVELS[level]["frames"]
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=cpu_worker, daemon=True,
+                                   args=(child, player, tuple(char_names), level, seed, teams))
+        self.process.start()
+        child.close()
+        self.waiting = False
+        self.reset()
+
+    def reset(self) -> None:
+        # 前の試合の状態で頼んだ結果がまだ届いていなければ、届いたときに捨てる
+        self.discard = self.waiting
+        self.action = 0
+        self.remaining = 0
+        self.late = 0  # 結果が間に合わなかったフレーム数
+
+    def act(self, sim: game.BattleSim, opponent: game.PlayerInput | None = None,
+            deadline: float | None = None) -> game.PlayerInput:
+        """このフレームの入力を返す（探索は別プロセスなので deadline は使わない）"""
+        if self.waiting and self.conn.poll():
+            action = self.conn.recv()
+            self.waiting = False
+            if self.discard:
+                self.discard = False
+            else:
+                self.action = action
+                self.remaining = self.frames
+        if not self.waiting and self.remaining <= 1:
+            # 今の行動が終わる前に次を頼んでおく
+            opponent = game.PlayerInput(opponent.held) if opponent else game.PlayerInput()
+            self.conn.send((sim.save_state(), opponent.pack()))
+            self.waiting = True
+        first = self.remaining == self.frames
+        if self.remaining > 0:
+            self.remaining -= 1
+        else:
+            self.late += 1
+        return cpu_input(self.action, sim.fighters[self.player].facing, first)
+
+    def close(self) -> None:
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class CpuGroup:
+    """
+    対戦に出る CPU をまとめて動かす。
+
+    同じプロセスで探索する CPU（CpuPlayer）は、1ステップあたり1人分の予算（一番大きい budget_ms）を
+    分け合う。3人以上の対戦で CPU が増えても、1ステップの探索にかかる時間は増えない。
+    """
+
+    def __init__(self, cpus) -> None:
+        self.cpus = list(cpus)
+        local = [c for c in self.cpus if isinstance(c, CpuPlayer)]
+        self.local = len(local)
+        self.budget = max((c.budget for c in local), default=0.0)
+
+    def __len__(self) -> int:
+        return len(self.cpus)
+
+    def reset(self) -> None:
+        for c in self.cpus:
+            c.reset()
+
+    def act(self, sim: game.BattleSim, inputs) -> tuple:
+        """
+        inputs（全員の入力）のうち CPU の分を CPU の入力に置き換えて返す。
+        CPU は一番近い敵の今の入力が続くものとして読む。
+        """
+        inputs = list(inputs)
+        end = time.perf_counter() + self.budget
+        waiting = self.local
+        for c in self.cpus:
+            target = sim.targets[c.player]
+            opponent = inputs[sim.fighters.index(target)] if target else None
+            if isinstance(c, CpuPlayer):
+                # 残りの時間を、まだ動いていない CPU で等分する（前の CPU が余らせた分は後に回る）
+                now = time.perf_counter()
+                inputs[c.player] = c.act(sim, opponent, now + max(0.0, end - now) / waiting)
+                waiting -= 1
+            else:
+                inputs[c.player] = c.act(sim, opponent)
+        return tuple(inputs)
+
+    def close(self) -> None:
+        for c in self.cpus:
+            if isinstance(c, CpuProcess):
+                c.close()
+
+
+def cpu_class_from_env() -> type:
+    """KOUKATON_CPU_PROCESS=1 なら探索を別プロセスで行う CpuProcess、そうでなければ CpuPlayer"""
+    return CpuProcess if os.environ.get("KOUKATON_CPU_PROCESS") == "1" else CpuPlayer
+
+
+def cpu_level_from_env() -> str:
+    level = os.environ.get("KOUKATON_CPU_LEVEL", "normal")
+    if level not in CPU_LEVELS:
+        print(f"[CPU] unknown level {level!r}, using normal")
+        level = "normal"
+    return level
+
+
+def cpu_from_env(char_names=("man", "woman"), teams=None):
+    """
+    環境変数から CPU を作る（設定がなければ None）。
+        KOUKATON_CPU=1 / 2: その番号のプレイヤーを CPU にする
+        KOUKATON_CPU_LEVEL=easy / normal / hard
+        KOUKATON_CPU_PROCESS=1: 探索を別プロセスで行う
+    """
+    player = os.environ.get("KOUKATON_CPU", "")
+    if player not in ("1", "2"):
+        return None
+    return cpu_class_from_env()(int(player) - 1, char_names, cpu_level_from_env(), teams=teams)
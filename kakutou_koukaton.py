@@ -2,6 +2,21 @@ import pygame as pg
 import sys
 import os
 import platform
+import math
+import io
+import json
+import random
+import multiprocessing
+import mmap
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from fractions import Fraction
 
 # =====================
 # 初期設定
@@ -14,6 +29,7 @@ SELECT = 1
 BATTLE = 2
 PAUSED = 3
 SETTINGS = 4
+RESULT = 5
 
 # OS判定して適切なフォントパスを設定
 if platform.system() == "Windows":
@@ -30,17 +46,661 @@ BATTLE_BGM = "sound/bgm/vhs-tape.mp3"
 # マッチ時間(秒)
 MATCH_TIME = 90
 
-# カレントディレクトリをスクリプトの場所に
-try:
-    os.chdir(os.path.dirname(os.path.abspath(__file__)))
-except Exception:
-    pass
+# シミュレーションは常に 1/60 秒単位で進める
+FPS = 60
+STEP_MS = 1000 / FPS
+MAX_STEPS_PER_FRAME = 5  # 処理落ち時に1描画あたり進める最大ステップ数
+
+# 決着表示の長さ(フレーム)
+RESULT_FRAMES = 2 * FPS
+
+# バトル画面を差分だけ描き直す（KOUKATON_FULL_REDRAW=1 で毎フレーム全体を描き直す）
+DIRTY_RECTS = os.environ.get("KOUKATON_FULL_REDRAW", "") != "1"
+# 描き直す範囲がこの数か、合計でこの割合の面積を超えたら、そのフレームは全体を描き直す
+# （範囲ごとに背景を戻して送るより、まとめて描いた方が速い）
+DIRTY_MAX_RECTS = 24
+DIRTY_MAX_AREA = 0.5
+
+# 画像などはスクリプトの場所から読む
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# =====================
+# 起動時間の記録
+# =====================
+class StartupTimer:
+    """起動の各段階にかかった時間を記録する（KOUKATON_STARTUP_TIMING=1 で表示）"""
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.phases: list[tuple[str, float]] = []
+
+    def mark(self, name: str) -> None:
+        """前回の mark からの時間を name の段階として記録する"""
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self) -> str:
+        total = self.last - self.start
+        lines = [f"[startup] {total * 1000:.1f} ms"]
+        for name, sec in self.phases:
+            lines.append(f"  {sec * 1000:7.1f} ms  {name}")
+        return "\n".join(lines)
+
+
+STARTUP = StartupTimer()
+
+
+# =====================
+# フレームプロファイラ
+# =====================
+class FrameProfiler:
+    """
+    1フレームの処理を段階ごとに計測する。
+
+    begin_frame() のあと、各段階の終わりで lap(段階) を呼ぶと、前の lap からの時間が
+    その段階に加算される。直近 window フレーム分をリングバッファに持って p50/p95/p99 を求め、
+    全フレーム分（最大 max_rows）を CSV に書き出せる。
+    計測する側は profiler が None かどうかだけを見るので、無効時の負荷はほぼない。
+    """
+
+    PHASES = ("events", "sim_input", "fighters", "attacks", "projectiles", "collisions",
+              "hud_text", "background", "blit", "menu", "display")
+    INDEX = {name: i for i, name in enumerate(PHASES)}
+
+    def __init__(self, window: int = 600, max_rows: int = 60 * 60 * FPS) -> None:
+        self.window = window
+        self.max_rows = max_rows
+        n = len(self.PHASES)
+        self.ring = [array("d", bytes(8 * window)) for _ in range(n)]
+        self.ring_total = array("d", bytes(8 * window))
+        self.ring_allocs = array("I", bytes(4 * window))  # フレームごとに新しく作ったレコードの数
+        self.count = 0
+        self.current = [0.0] * n
+        self.current_allocs = 0
+        self.rows = array("f")  # フレームごとの各段階の時間(ms)を並べたもの
+        self.last = 0.0
+        self.frame_start = 0.0
+        self.overlay = False
+        self.overlay_font = None
+        self.overlay_surface = None
+        self.overlay_frame = -1
+
+    def begin_frame(self) -> None:
+        now = time.perf_counter()
+        self.frame_start = self.last = now
+        for i in range(len(self.current)):
+            self.current[i] = 0.0
+        self.current_allocs = 0
+
+    def add_allocations(self, n: int) -> None:
+        """このフレームで新しく作った攻撃判定・飛び道具のレコードの数を加える"""
+        self.current_allocs += n
+
+    def lap(self, phase: str) -> None:
+        """前の lap から今までを phase の時間として加える"""
+        now = time.perf_counter()
+        self.current[self.INDEX[phase]] += now - self.last
+        self.last = now
+
+    def end_frame(self) -> None:
+        slot = self.count % self.window
+        for i, sec in enumerate(self.current):
+            self.ring[i][slot] = sec
+        self.ring_total[slot] = self.last - self.frame_start
+        self.ring_allocs[slot] = self.current_allocs
+        if len(self.rows) < self.max_rows * len(self.PHASES):
+            self.rows.extend(sec * 1000 for sec in self.current)
+        self.count += 1
+
+    def percentiles(self) -> list[tuple[str, float, float, float]]:
+        """直近のフレームについて (段階, p50, p95, p99)（ms）の一覧を返す"""
+        n = min(self.count, self.window)
+        result = []
+        if n == 0:
+            return result
+        for name, ring in zip(self.PHASES + ("total",), self.ring + [self.ring_total]):
+            values = sorted(ring[:n])
+            result.append((name,) + tuple(values[min(n - 1, int(n * q))] * 1000
+                                          for q in (0.50, 0.95, 0.99)))
+        return result
+
+    def overlay_item(self):
+        """
+        右下に出す計測値の (Surface, 左上座標)。30フレームごとに作り直す。
+        """
+        if self.overlay_surface is None or self.count - self.overlay_frame >= 30:
+            if self.overlay_font is None:
+                self.overlay_font = pg.font.Font(None, 18)
+            rows = [("phase (ms)", "p50", "p95", "p99")]
+            for name, p50, p95, p99 in self.percentiles():
+                rows.append((name, f"{p50:.2f}", f"{p95:.2f}", f"{p99:.2f}"))
+            n = min(self.count, self.window)
+            if n:
+                # 新しく作ったレコードの数（1フレームあたり、直近の平均と最大）
+                allocs = self.ring_allocs[:n]
+                rows.append(("allocs/frame", f"{sum(allocs) / n:.2f}", "max", str(max(allocs))))
+            surf = pg.Surface((230, 16 * len(rows) + 8))
+            surf.fill((0, 0, 0))
+            for i, row in enumerate(rows):
+                for x, text in zip((5, 100, 145, 190), row):
+                    surf.blit(self.overlay_font.render(text, True, (255, 255, 0)), (x, 4 + 16 * i))
+            self.overlay_surface = surf
+            self.overlay_frame = self.count
+        surf = self.overlay_surface
+        return surf, (WIDTH - surf.get_width() - 10, HEIGHT - 70 - surf.get_height())
+
+    def write_csv(self, path: str) -> int:
+        """フレームごとの時間(ms)を CSV に書き出し、行数を返す"""
+        n = len(self.PHASES)
+        frames = len(self.rows) // n
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            f.write("frame,total," + ",".join(self.PHASES) + "\n")
+            for i in range(frames):
+                row = self.rows[i * n:(i + 1) * n]
+                f.write(f"{i},{sum(row):.4f}," + ",".join(f"{v:.4f}" for v in row) + "\n")
+        return frames
+
+
+PROFILE_DIR = os.path.join(BASE_DIR, "profiles")
+
+
+# =====================
+# 描画解像度
+# =====================
+# 描画解像度の倍率（KOUKATON_RENDER_SCALE）
+RENDER_SCALES = (0.5, 0.75, 1.0)
+
+
+class RenderView:
+    """
+    内部の描画解像度と、ウィンドウへの拡大。
+
+    ゲームの座標はいつも WIDTH x HEIGHT のまま。scale が 1 より小さいとき、
+    バトル画面は縮小済みの背景・画像を使って内部解像度の Surface（battle_target）に描き、
+    1回の拡大でウィンドウに出す。メニューは今までどおり WIDTH x HEIGHT の screen に描き、
+    変わった範囲だけ縮小して出す。
+
+    mode:
+        "scaled": ウィンドウを内部解像度で作り、pg.SCALED で拡大してもらう（拡大は SDL 側）
+        "blit": ウィンドウは WIDTH x HEIGHT のまま、内部解像度の絵の変わった範囲だけを拡大して貼る
+    """
+
+    def __init__(self, scale: float = 1.0, mode: str = "scaled", fullscreen: bool = False) -> None:
+        self.scale = scale
+        self.mode = mode
+        self.fullscreen = fullscreen
+        self.size = (round(WIDTH * scale), round(HEIGHT * scale))
+        # 内部解像度の block 画素がウィンドウの zoom 画素になる（0.75 なら 3 -> 4）
+        ratio = Fraction(scale).limit_denominator(16)
+        self.block, self.zoom = ratio.numerator, ratio.denominator
+        self.display = None       # pg.display の Surface
+        self.screen = None        # メニューを描く WIDTH x HEIGHT の Surface
+        self.battle_target = None  # バトル画面を描く内部解像度の Surface
+        self.images: OrderedDict = OrderedDict()  # 元の Surface -> 縮小した Surface
+        self.max_images = 2048
+        self.rendered: OrderedDict = OrderedDict()  # (キー, 範囲) -> 描画関数の結果を縮小した Surface
+        self.scratch = None
+
+    @property
+    def scaled(self) -> bool:
+        return self.scale != 1.0
+
+    def setup(self) -> pg.Surface:
+        """ウィンドウを作り、メニューを描く Surface を返す"""
+        flags = pg.FULLSCREEN if self.fullscreen else 0
+        if not self.scaled:
+            self.display = pg.display.set_mode((WIDTH, HEIGHT), flags)
+            self.screen = self.battle_target = self.display
+        elif self.mode == "scaled":
+            self.display = pg.display.set_mode(self.size, flags | pg.SCALED)
+            self.screen = pg.Surface((WIDTH, HEIGHT)).convert()
+            self.battle_target = self.display
+        else:
+            self.display = pg.display.set_mode((WIDTH, HEIGHT), flags)
+            self.screen = self.display
+            self.battle_target = pg.Surface(self.size).convert()
+        return self.screen
+
+    # ---------------------
+    # 縮小
+    # ---------------------
+    def rect(self, rect) -> pg.Rect:
+        """ゲーム座標の矩形を内部解像度の矩形にする（端は外側に丸める）"""
+        s = self.scale
+        x, y, w, h = rect
+        left, top = math.floor(x * s), math.floor(y * s)
+        return pg.Rect(left, top, math.ceil((x + w) * s) - left, math.ceil((y + h) * s) - top)
+
+    def image(self, surface: pg.Surface) -> pg.Surface:
+        """surface を内部解像度に縮小したもの（一度縮小したものは使い回す）"""
+        if not self.scaled:
+            return surface
+        scaled = self.images.get(surface)
+        if scaled is None:
+            w, h = surface.get_size()
+            size = (max(1, round(w * self.scale)), max(1, round(h * self.scale)))
+            if surface.get_bitsize() >= 24:
+                scaled = pg.transform.smoothscale(surface, size)
+            else:
+                scaled = pg.transform.scale(surface, size)
+            self.images[surface] = scaled
+            if len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+        else:
+            self.images.move_to_end(surface)
+        return scaled
+
+    def prescale(self, surfaces) -> None:
+        """読み込んだ画像を先に縮小しておく（描画中に縮小しないように）"""
+        if self.scaled:
+            for surface in surfaces:
+                self.image(surface)
+
+    def render_item(self, rect: pg.Rect, key, draw) -> pg.Surface:
+        """
+        screen に直接描く関数の結果を、内部解像度の Surface にする。
+        WIDTH x HEIGHT の作業用 Surface の該当範囲に描いて縮小する（キーと範囲が同じなら使い回す）。
+        """
+        cache_key = (key, tuple(rect))
+        surf = self.rendered.get(cache_key)
+        if surf is None:
+            if self.scratch is None:
+                self.scratch = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
+            area = rect.clip(self.scratch.get_rect())
+            self.scratch.fill((0, 0, 0, 0), area)
+            draw(self.scratch)
+            surf = pg.transform.smoothscale(self.scratch.subsurface(area), self.rect(area).size)
+            self.rendered[cache_key] = surf
+            if len(self.rendered) > 256:
+                self.rendered.popitem(last=False)
+        return surf
+
+    def items(self, items: list) -> list:
+        """battle_items() の (範囲, キー, 描画) を内部解像度のものにする"""
+        result = []
+        for rect, key, draw in items:
+            if isinstance(draw, pg.Surface):
+                surf = self.image(draw)
+                x, y = rect.topleft
+                result.append((surf.get_rect(topleft=(round(x * self.scale), round(y * self.scale))),
+                               key, surf))
+            else:
+                surf = self.render_item(rect, key, draw)
+                area = rect.clip(0, 0, WIDTH, HEIGHT)
+                result.append((surf.get_rect(topleft=self.rect(area).topleft), key, surf))
+        return result
+
+    # ---------------------
+    # 画面に出す
+    # ---------------------
+    def present_battle(self, rects):
+        """battle_target に描いたバトル画面を出す。pg.display.update() に渡す範囲を返す"""
+        if not self.scaled or self.mode != "blit":
+            return rects
+        if rects is None:
+            pg.transform.scale(self.battle_target, (WIDTH, HEIGHT), self.display)
+            return None
+        # 変わった範囲だけ拡大する。範囲を block 画素の区切りに広げておくと、
+        # 画面全体を1回で拡大したときと同じ画素になる
+        bounds = self.battle_target.get_rect()
+        b, z = self.block, self.zoom
+        out = []
+        for rect in rects:
+            area = pg.Rect(rect).clip(bounds)
+            if not area.width or not area.height:
+                continue
+            left, top = area.left // b * b, area.top // b * b
+            right = min(-(-area.right // b) * b, bounds.width)
+            bottom = min(-(-area.bottom // b) * b, bounds.height)
+            src = pg.Rect(left, top, right - left, bottom - top)
+            dest = pg.Rect(left * z // b, top * z // b,
+                           -(-right * z // b) - left * z // b, -(-bottom * z // b) - top * z // b)
+            dest = dest.clip(self.display.get_rect())
+            pg.transform.scale(self.battle_target.subsurface(src), dest.size,
+                               self.display.subsurface(dest))
+            out.append(dest)
+        return out
+
+    def present_menu(self, rects):
+        """screen に描いたメニューを出す。pg.display.update() に渡す範囲を返す"""
+        if not self.scaled or self.mode == "blit":
+            return rects
+        if rects is None:
+            rects = [self.screen.get_rect()]
+        out = []
+        for rect in rects:
+            area = pg.Rect(rect).clip(self.screen.get_rect())
+            if not area.width or not area.height:
+                continue
+            dest = self.rect(area)
+            # 丸めた範囲に合わせて元の範囲を取り直す
+            src = pg.Rect(dest.x / self.scale, dest.y / self.scale,
+                          dest.width / self.scale, dest.height / self.scale).clip(self.screen.get_rect())
+            self.display.blit(pg.transform.smoothscale(self.screen.subsurface(src), dest.size), dest)
+            out.append(dest)
+        return out
+
+    def snapshot(self) -> pg.Surface:
+        """今出ているバトル画面の WIDTH x HEIGHT のコピー（ポーズ画面の背景用）"""
+        if self.scaled and self.mode == "scaled":
+            return pg.transform.smoothscale(self.display, (WIDTH, HEIGHT))
+        return self.screen.copy()
+
+    def map_event(self, event):
+        """pg.SCALED のウィンドウのマウス座標（内部解像度）をゲーム座標にする"""
+        if self.scaled and self.mode == "scaled" and hasattr(event, "pos"):
+            x, y = event.pos
+            return pg.event.Event(event.type, {**event.dict,
+                                               "pos": (int(x / self.scale), int(y / self.scale))})
+        return event
+
+
+def render_view_from_env() -> RenderView:
+    """
+    環境変数から描画解像度の設定を作る。
+        KOUKATON_RENDER_SCALE=0.5 / 0.75 / 1: 内部の描画解像度の倍率
+        KOUKATON_SCALE_MODE=scaled / blit: 拡大の方法（RenderView 参照）
+        KOUKATON_FULLSCREEN=1: 全画面
+    """
+    try:
+        scale = float(os.environ.get("KOUKATON_RENDER_SCALE", "1"))
+    except ValueError:
+        scale = 1.0
+    if scale not in RENDER_SCALES:
+        print(f"[render] unsupported scale {scale}, use one of {RENDER_SCALES}")
+        scale = 1.0
+    mode = os.environ.get("KOUKATON_SCALE_MODE", "scaled")
+    if mode not in ("scaled", "blit"):
+        mode = "scaled"
+    return RenderView(scale, mode, os.environ.get("KOUKATON_FULLSCREEN") == "1")
+
+
+# init_app() で作り直す
+VIEW = RenderView()
+
+
+# =====================
+# 録画
+# =====================
+CAPTURE_DIR = os.path.join(BASE_DIR, "captures")
+CAPTURE_FORMATS = ("raw", "png", "video")
+# リングバッファのバイト順（小さい番地から）-> ffmpeg の pix_fmt
+FFMPEG_PIX_FMTS = {
+    "bgrx": "bgr0", "rgbx": "rgb0", "xrgb": "0rgb", "xbgr": "0bgr",
+    "bgra": "bgra", "rgba": "rgba", "argb": "argb", "abgr": "abgr",
+    "bgr": "bgr24", "rgb": "rgb24",
+}
+
+
+def pixel_layout(surface: pg.Surface) -> str:
+    """Surface の1画素のバイトの並び（小さい番地から、例: "bgrx"）"""
+    layout = []
+    for i in range(surface.get_bytesize()):
+        shift = 8 * i if sys.byteorder == "little" else 8 * (surface.get_bytesize() - 1 - i)
+        layout.append(next((c for c, mask in zip("rgba", surface.get_masks()) if mask == 0xff << shift),
+                           "x"))
+    return "".join(layout)
+
+
+class FrameCapture:
+    """
+    画面を毎フレーム録画する。
+
+    ゲームのループでは、できあがった画面のピクセルを、最初に確保したリングバッファの空いている
+    1枚へそのままコピーするだけで、ファイルへの書き出しは書き出し用のスレッドが行う。
+    空きがなければ待たずにそのフレームを捨てて dropped に数えるので、ディスクやエンコーダーが
+    追いつかなくてもゲームは止まらない。
+
+    fmt:
+        "raw": 全フレームのピクセルを1つのファイルに並べる（大きさや画素の並びは .json に書く）
+        "png": フレームごとに PNG を書く
+        "video": ffmpeg があればパイプで送って mp4 にする（なければ raw にする）
+    """
+
+    def __init__(self, surface: pg.Surface, fmt: str = "raw", directory: str = CAPTURE_DIR,
+                 buffers: int = 32, fps: int = FPS) -> None:
+        self.size = surface.get_size()
+        self.pitch = surface.get_pitch()
+        self.layout = pixel_layout(surface)
+        self.fps = fps
+        self.ring = [bytearray(self.pitch * self.size[1]) for _ in range(buffers)]
+        self.free = queue.SimpleQueue()
+        for i in range(buffers):
+            self.free.put(i)
+        self.filled = queue.SimpleQueue()
+
+        self.frames = 0           # capture() を呼ばれた回数
+        self.written = 0          # 書き出したフレーム数（書き出し用スレッドだけが増やす）
+        self.dropped = 0          # 空きがなくて捨てたフレーム数
+        self.max_backlog = 0      # 書き出し待ちの最大数
+        self.pressure_frames = 0  # 書き出し待ちがリングの 3/4 を超えていたフレーム数
+        self.reported_dropped = 0
+        self.report_frame = 0
+        self.error = None
+
+        self.fmt = fmt
+        if fmt == "video" and (self.layout not in FFMPEG_PIX_FMTS or shutil.which("ffmpeg") is None):
+            print("[capture] ffmpeg not found, recording raw frames instead")
+            self.fmt = "raw"
+        os.makedirs(directory, exist_ok=True)
+        self.out = self.process = self.png_surface = None
+        self.path = self.create_output(directory, time.strftime("%Y%m%d-%H%M%S"))
+        if self.fmt == "png":
+            # 書き出し用スレッドが使う、画面と同じ形式の Surface
+            self.png_surface = pg.Surface(self.size, 0, surface)
+        elif self.fmt == "video":
+            self.process = subprocess.Popen(self.ffmpeg_command(), stdin=subprocess.PIPE)
+
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="capture", daemon=True)
+        self.thread.start()
+
+    def create_output(self, directory: str, stamp: str) -> str:
+        """
+        出力先を作ってそのパスを返す。
+        同じ名前があれば "-1", "-2", ... を付けて、前の録画を上書きしない。
+        """
+        ext = {"raw": ".raw", "png": "", "video": ".mp4"}[self.fmt]
+        n = 0
+        while True:
+            path = os.path.join(directory, (f"{stamp}-{n}" if n else stamp) + ext)
+            try:
+                if self.fmt == "png":
+                    os.mkdir(path)
+                else:
+                    out = open(path, "xb")  # video は ffmpeg が書くまで名前だけ取っておく
+                    if self.fmt == "raw":
+                        self.out = out
+                    else:
+                        out.close()
+                return path
+            except FileExistsError:
+                n += 1
+
+    def ffmpeg_command(self) -> list[str]:
+        bytesize = len(self.layout)
+        w, h = self.size
+        command = [shutil.which("ffmpeg"), "-loglevel", "error", "-y",
+                   "-f", "rawvideo", "-pix_fmt", FFMPEG_PIX_FMTS[self.layout],
+                   "-s", f"{self.pitch // bytesize}x{h}", "-r", str(self.fps), "-i", "-"]
+        if self.pitch != w * bytesize:
+            command += ["-vf", f"crop={w}:{h}:0:0"]
+        return command + ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", self.path]
+
+    # ---------------------
+    # ゲームのループ側
+    # ---------------------
+    def capture(self, surface: pg.Surface) -> bool:
+        """
+        surface（表示し終えた画面）を1フレーム分コピーして書き出しを頼む。待つことはない。
+        空きがなくて捨てたら False を返す。
+        """
+        self.frames += 1
+        if surface.get_size() != self.size or surface.get_pitch() != self.pitch:
+            self.dropped += 1
+            return False
+        try:
+            i = self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            self.report_pressure()
+            return False
+        self.ring[i][:] = surface.get_buffer()
+        self.filled.put(i)
+
+        backlog = self.filled.qsize()
+        self.max_backlog = max(self.max_backlog, backlog)
+        if backlog * 4 > len(self.ring) * 3:
+            self.pressure_frames += 1
+        return True
+
+    def report_pressure(self) -> None:
+        """捨てたフレームがあれば、1秒に1回だけ知らせる"""
+        if self.frames - self.report_frame >= self.fps:
+            print(f"[capture] writer is falling behind: dropped {self.dropped - self.reported_dropped} frames")
+            self.reported_dropped = self.dropped
+            self.report_frame = self.frames
+
+    # ---------------------
+    # 書き出し用スレッド
+    # ---------------------
+    def run(self) -> None:
+        while True:
+            i = self.filled.get()
+            if i is None:
+                self.finish()
+                return
+            try:
+                if self.error is None:
+                    self.write(self.ring[i])
+                    self.written += 1
+            except (OSError, ValueError, pg.error) as e:
+                # 書けなくなったら残りは読み捨てて、空きを返し続ける
+                self.error = e
+            finally:
+                self.free.put(i)
+
+    def write(self, frame: bytearray) -> None:
+        if self.fmt == "raw":
+            self.out.write(frame)
+        elif self.fmt == "png":
+            view = memoryview(self.png_surface.get_buffer())
+            view[:] = frame
+            view.release()
+            pg.image.save(self.png_surface, os.path.join(self.path, f"frame_{self.written:06d}.png"))
+        else:
+            self.process.stdin.write(frame)
+
+    def close(self) -> None:
+        """
+        録画を終える（待たない）。書き出し待ちのフレームと .json は書き出し用スレッドが書き、
+        書き終えたら結果を表示する。
+        """
+        if not self.closed:
+            self.closed = True
+            self.filled.put(None)
+
+    def join(self) -> None:
+        """書き出しが終わるまで待つ（プロセスの終了前に呼ぶ）"""
+        self.close()
+        self.thread.join()
+
+    def finish(self) -> None:
+        """書き出し用スレッドで、ファイルを閉じて結果を表示する"""
+        try:
+            if self.out is not None:
+                self.out.close()
+                with open(os.path.splitext(self.path)[0] + ".json", "w", encoding="utf-8") as f:
+                    json.dump({"width": self.size[0], "height": self.size[1], "pitch": self.pitch,
+                               "pixel_layout": self.layout, "fps": self.fps, "frames": self.written},
+                              f, indent=2)
+                    f.write("\n")
+            if self.process is not None:
+                self.process.stdin.close()
+                self.process.wait()
+        except OSError as e:
+            self.error = self.error or e
+        print(self.report())
+
+    def report(self) -> str:
+        line = (f"[capture] {self.fmt} {self.path}: {self.written}/{self.frames} frames written, "
+                f"{self.dropped} dropped, max backlog {self.max_backlog}/{len(self.ring)}, "
+                f"{self.pressure_frames} frames under backpressure")
+        if self.error is not None:
+            line += f", error: {self.error}"
+        return line
+
+
+def capture_from_env(surface: pg.Surface, default: str | None = None) -> FrameCapture | None:
+    """
+    KOUKATON_CAPTURE=raw / png / video なら録画を始める（指定がなければ default の形式で始める）。
+    始められなければ None。
+    """
+    fmt = os.environ.get("KOUKATON_CAPTURE") or default
+    if fmt is None:
+        return None
+    if fmt not in CAPTURE_FORMATS:
+        print(f"[capture] unknown format {fmt!r}, choose from {', '.join(CAPTURE_FORMATS)}")
+        return None
+    try:
+        capture = FrameCapture(surface, fmt)
+    except OSError as e:
+        print(f"[capture error] {e}")
+        return None
+    print(f"[capture] recording -> {capture.path}")
+    return capture
+
+
+# init_app() で作る
+screen = None
+clock = None
+FONT_BIG = FONT_MED = FONT_SMALL = None
+
+
+def init_app(view: RenderView | None = None) -> pg.Surface:
+    """
+    pygame の初期化・ウィンドウ作成・フォント作成を行う。
+    import だけでは何もしないので、画面を使う前に1回呼ぶ。
+
+    Args:
+        view: 描画解像度の設定（省略時は WIDTH x HEIGHT のまま）
+    """
+    global screen, clock, FONT_BIG, FONT_MED, FONT_SMALL, VIEW
+    if screen is not None:
+        return screen
+
+    # カレントディレクトリをスクリプトの場所に
+    try:
+        os.chdir(BASE_DIR)
+    except Exception:
+        pass
+
+    pg.init()
+    STARTUP.mark("pg.init")
+    try:
+        pg.mixer.init()
+    except pg.error as e:
+        print(f"[Audio error] {e}")
+    AUDIO.init()
+    STARTUP.mark("mixer")
+
+    VIEW = view or RenderView()
+    screen = VIEW.setup()
+    pg.display.set_caption("こうかとん ファイター")
+    clock = pg.time.Clock()
+    STARTUP.mark("window")
+
+    # フォントの作成
+    FONT_BIG = load_font(80)
+    FONT_MED = load_font(36)
+    FONT_SMALL = load_font(13)
+    STARTUP.mark("fonts")
+    return screen
 
-pg.init()
-pg.mixer.init()
-screen = pg.display.set_mode((WIDTH, HEIGHT))
-pg.display.set_caption("こうかとん ファイター")
-clock = pg.time.Clock()
 
 def load_font(size):
     """フォントを安全にロードする関数"""
@@ -53,45 +713,470 @@ def load_font(size):
         return pg.font.Font(None, size)
 
 
-# フォントの作成
-FONT_BIG = load_font(80)
-FONT_MED = load_font(36)
-FONT_SMALL = load_font(13)
+# =====================
+# 文字描画キャッシュ
+# =====================
+class TextCache:
+    """
+    font.render の結果を (フォント, 文字列, 色) ごとに保持する LRU キャッシュ。
+    毎フレーム同じ文字列をラスタライズしないようにする。
+    """
 
-# フォントの作成
-FONT_BIG = load_font(80)
-FONT_MED = load_font(36)
-FONT_SMALL = load_font(13)
-# pg.init()
-# screen = pg.display.set_mode((WIDTH, HEIGHT))
-# pg.display.set_caption("Mini Street Fighter MAX")
-# clock = pg.time.Clock()
+    def __init__(self, max_size: int = 256) -> None:
+        self.max_size = max_size
+        self.surfaces: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
-def safe_load_and_play_bgm(path, volume=0.5, loops=-1):
-    """BGMを安全にロードして再生する"""
-    try:
-        pg.mixer.music.load(path)
+    def render(self, font: pg.font.Font, text: str, color) -> pg.Surface:
+        """キャッシュ済みなら再利用し、なければ描画して登録する"""
+        key = (font, text, tuple(color))
+        surf = self.surfaces.get(key)
+        if surf is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surf
+
+        self.misses += 1
+        surf = font.render(text, True, color)
+        self.surfaces[key] = surf
+        if len(self.surfaces) > self.max_size:
+            self.surfaces.popitem(last=False)
+        return surf
+
+    def clear(self) -> None:
+        self.surfaces.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+TEXT_CACHE = TextCache()
+
+
+def render_text(font: pg.font.Font, text: str, color) -> pg.Surface:
+    """アンチエイリアス付きで文字列を描画する（キャッシュ経由）"""
+    return TEXT_CACHE.render(font, text, color)
+
+
+# =====================
+# 画像アセット管理
+# =====================
+class AssetManager:
+    """
+    画像の読み込み・拡大縮小・反転を1回だけ行い、同じ Surface を共有する。
+    読み込み回数と所要時間を記録する。
+    """
+
+    def __init__(self) -> None:
+        self.images: dict[tuple, pg.Surface] = {}
+        self.load_count = 0
+        self.load_time = 0.0
+        self.timings: dict[str, float] = {}
+
+    def image(self, path: str, size: tuple[int, int], alpha: bool = True,
+              fallback=(255, 0, 255), flip: bool = False) -> pg.Surface:
+        """
+        画像を取得する（初回のみディスクから読み込む）。
+
+        Args:
+            path: 画像ファイルのパス
+            size: 拡大縮小後のサイズ
+            alpha: 透過付きで変換するか
+            fallback: 読み込み失敗時の塗りつぶし色、または代わりの Surface
+            flip: 左右反転した画像を返すか
+        """
+        key = (path, size, alpha, flip)
+        surf = self.images.get(key)
+        if surf is not None:
+            return surf
+
+        if flip:
+            surf = pg.transform.flip(self.image(path, size, alpha, fallback), True, False)
+        else:
+            surf = self._load(path, size, alpha, fallback)
+        self.images[key] = surf
+        return surf
+
+    def peek(self, path: str, size: tuple[int, int], alpha: bool = True) -> pg.Surface | None:
+        """読み込み済みなら返す（読み込みはしない）"""
+        return self.images.get((path, size, alpha, False))
+
+    def put(self, path: str, size: tuple[int, int], alpha: bool, surf: pg.Surface) -> None:
+        """別の場所で読み込んだ画像を登録する"""
+        self.images.setdefault((path, size, alpha, False), surf)
+
+    def _load(self, path, size, alpha, fallback) -> pg.Surface:
+        start = time.perf_counter()
+        try:
+            surf = pg.image.load(os.path.join(BASE_DIR, path))
+            # ウィンドウがない（headless）場合は変換せずに使う
+            if pg.display.get_surface() is not None:
+                surf = surf.convert_alpha() if alpha else surf.convert()
+            surf = pg.transform.scale(surf, size)
+        except Exception:
+            if isinstance(fallback, pg.Surface):
+                surf = fallback.copy()
+            else:
+                surf = pg.Surface(size, pg.SRCALPHA) if alpha else pg.Surface(size)
+                surf.fill(fallback)
+        elapsed = time.perf_counter() - start
+        self.load_count += 1
+        self.load_time += elapsed
+        self.timings[path] = self.timings.get(path, 0.0) + elapsed
+        return surf
+
+    def report(self) -> str:
+        """読み込み回数と時間の一覧を文字列で返す"""
+        lines = [f"[assets] {self.load_count} loads, {self.load_time * 1000:.1f} ms"]
+        for path, sec in sorted(self.timings.items(), key=lambda kv: -kv[1]):
+            lines.append(f"  {sec * 1000:7.1f} ms  {path}")
+        return "\n".join(lines)
+
+
+ASSETS = AssetManager()
+
+
+# =====================
+# バックグラウンド読み込み
+# =====================
+class BackgroundLoader:
+    """
+    画像のデコード・拡大縮小と、ファイルの読み込みを別スレッドで行う。
+
+    スレッドでは Surface を作るところまで行い、画面の形式への convert() と
+    ASSETS への登録はメインスレッドの poll() で行う。
+    スレッドは最初の依頼で起動する。
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Condition()
+        self.queue: deque = deque()    # まだ始めていない依頼
+        self.pending: set = set()      # 依頼済みで結果を受け取っていないもの
+        self.results: deque = deque()  # スレッドが読み終えた (依頼, 結果, 秒)
+        self.files: dict[str, bytes] = {}
+        self.missing: set = set()      # 読めなかったファイル（再依頼しない）
+        self.broken_images: set = set()  # 読めなかった画像の (path, size, alpha)（再依頼しない）
+        self.loading = None
+        self.thread = None
+        self.done = 0
+        self.failed = 0
+        self.worker_time = 0.0
+
+    def request_image(self, path: str, size: tuple[int, int], alpha: bool = True,
+                      urgent: bool = False) -> None:
+        """画像を先読みする（読み込み済み・依頼済み・読めなかったものなら何もしない）"""
+        if (path, size, alpha) not in self.broken_images and ASSETS.peek(path, size, alpha) is None:
+            self._request(("image", path, size, alpha), urgent)
+
+    def request_file(self, path: str, urgent: bool = False) -> None:
+        """ファイルの中身を先読みする（BGM など）"""
+        if path not in self.files and path not in self.missing:
+            self._request(("file", path), urgent)
+
+    def _request(self, job: tuple, urgent: bool) -> None:
+        with self.lock:
+            if job in self.pending:
+                # 急ぎなら順番を先頭に移す
+                if urgent and job in self.queue:
+                    self.queue.remove(job)
+                    self.queue.appendleft(job)
+                return
+            self.pending.add(job)
+            if urgent:
+                self.queue.appendleft(job)
+            else:
+                self.queue.append(job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="asset-loader", daemon=True)
+                self.thread.start()
+            self.lock.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.lock.wait()
+                job = self.queue.popleft()
+                self.loading = job
+            start = time.perf_counter()
+            try:
+                if job[0] == "image":
+                    _, path, size, _ = job
+                    result = pg.transform.scale(pg.image.load(os.path.join(BASE_DIR, path)), size)
+                else:
+                    with open(os.path.join(BASE_DIR, job[1]), "rb") as f:
+                        result = f.read()
+            except Exception as e:
+                result = e
+            with self.lock:
+                self.results.append((job, result, time.perf_counter() - start))
+                self.loading = None
+
+    def poll(self) -> int:
+        """
+        読み終わったものを受け取って登録する（メインスレッドで毎フレーム呼ぶ）。
+
+        Returns:
+            登録した数
+        """
+        if not self.results:
+            return 0
+        with self.lock:
+            finished = list(self.results)
+            self.results.clear()
+        for job, result, sec in finished:
+            self.worker_time += sec
+            with self.lock:
+                self.pending.discard(job)
+            if isinstance(result, Exception):
+                self.failed += 1
+                if job[0] == "file":
+                    self.missing.add(job[1])
+                else:
+                    self.broken_images.add(job[1:])
+                continue
+            self.done += 1
+            if job[0] == "image":
+                _, path, size, alpha = job
+                if pg.display.get_surface() is not None:
+                    result = result.convert_alpha() if alpha else result.convert()
+                ASSETS.put(path, size, alpha, result)
+            else:
+                self.files[job[1]] = result
+        return len(finished)
+
+    def file_data(self, path: str) -> bytes | None:
+        """先読み済みのファイルの中身（まだなら None）"""
+        self.poll()
+        return self.files.get(path)
+
+    def status(self) -> dict:
+        """キューの状態（診断用）"""
+        with self.lock:
+            return {
+                "queued": [job[1] for job in self.queue],
+                "loading": self.loading[1] if self.loading else None,
+                "waiting_for_main": len(self.results),
+                "done": self.done,
+                "failed": self.failed,
+                "worker_ms": self.worker_time * 1000,
+            }
+
+    def report(self) -> str:
+        st = self.status()
+        return (f"[loader] done {st['done']}, failed {st['failed']}, "
+                f"worker {st['worker_ms']:.1f} ms, queued {len(st['queued'])}, "
+                f"loading {st['loading']}")
+
+
+LOADER = BackgroundLoader()
+
+
+# =====================
+# 音
+# =====================
+# 効果音: 名前 -> (ファイル, 優先度, 音量, 読み込めないときに合成する音 (周波数Hz, 長さms, 波形))
+# 優先度が高い音は、空きチャンネルがないとき優先度の同じか低い音を止めて鳴らす
+SOUND_EFFECTS = {
+    "shot": ("sound/se/shot.wav", 0, 0.5, (880, 70, "square")),
+    "guard": ("sound/se/guard.wav", 1, 0.6, (1200, 40, "square")),
+    "hit": ("sound/se/hit.wav", 2, 0.8, (180, 80, "noise")),
+    "fusion": ("sound/se/fusion.wav", 2, 0.7, (440, 160, "square")),
+    "throw": ("sound/se/throw.wav", 3, 0.9, (90, 150, "noise")),
+}
+# 効果音専用に確保するチャンネル数（BGM は pg.mixer.music で別に鳴る）
+SFX_CHANNELS = 6
+
+
+class AudioSystem:
+    """
+    BGM と効果音の管理。
+
+    BGM はファイルの中身をメモリに持っておき、画面の切り替えのたびにディスクから読まないようにする
+    （デコードは pg.mixer.music が再生しながら行う）。効果音は最初にデコードした pg.mixer.Sound を使い回し、
+    予約したチャンネルに優先度つきで割り当てる。音量は HUD.volume に合わせる。
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.volume = 0.5
+        self.music_data: dict[str, bytes] = {}
+        self.music_path = None
+        self.missing: set[str] = set()
+        self.sounds: dict[str, "pg.mixer.Sound"] = {}
+        self.channels = []
+        self.playing = []  # チャンネルごとの (優先度, 鳴らし始めた順番)
+        self.serial = 0
+        self.played = 0
+        self.stolen = 0
+        self.dropped = 0
+
+    def init(self) -> None:
+        """ミキサーの初期化後に呼ぶ。効果音用のチャンネルを予約する"""
+        if not pg.mixer.get_init():
+            return
+        self.enabled = True
+        pg.mixer.set_num_channels(max(pg.mixer.get_num_channels(), SFX_CHANNELS + 2))
+        pg.mixer.set_reserved(SFX_CHANNELS)
+        self.channels = [pg.mixer.Channel(i) for i in range(SFX_CHANNELS)]
+        self.playing = [(0, 0)] * SFX_CHANNELS
+        self.set_volume(self.volume)
+
+    # ---------------------
+    # 効果音
+    # ---------------------
+    def load_effects(self) -> None:
+        """効果音をデコードしておく（ファイルがなければ合成する）"""
+        if not self.enabled:
+            return
+        for name, (path, _, volume, fallback) in SOUND_EFFECTS.items():
+            if name in self.sounds:
+                continue
+            try:
+                sound = pg.mixer.Sound(os.path.join(BASE_DIR, path))
+            except (pg.error, FileNotFoundError):
+                sound = synth_sound(*fallback)
+            sound.set_volume(volume)
+            self.sounds[name] = sound
+
+    def play(self, name: str) -> bool:
+        """
+        効果音を鳴らす。空きチャンネルがなければ、優先度が同じか低い中で一番古い音を止めて鳴らす。
+        止められる音がなければ鳴らさない。鳴らしたら True
+        """
+        if not self.enabled:
+            return False
+        sound = self.sounds.get(name)
+        if sound is None:
+            self.load_effects()
+            sound = self.sounds[name]
+        priority = SOUND_EFFECTS[name][1]
+
+        index = None
+        for i, channel in enumerate(self.channels):
+            if not channel.get_busy():
+                index = i
+                break
+        if index is None:
+            # 優先度が低い順、同じなら古い順
+            victim = min(range(len(self.channels)), key=lambda i: self.playing[i])
+            if self.playing[victim][0] > priority:
+                self.dropped += 1
+                return False
+            index = victim
+            self.stolen += 1
+
+        self.serial += 1
+        self.playing[index] = (priority, self.serial)
+        channel = self.channels[index]
+        channel.play(sound)
+        channel.set_volume(self.volume)
+        self.played += 1
+        return True
+
+    def play_battle_events(self, sim: "BattleSim") -> None:
+        """BattleSim.step の直後に呼んで、このフレームの当たりや飛び道具の音を鳴らす"""
+        if not self.enabled:
+            return
+        for _, defender, source, _, _ in sim.collisions.hits:
+            if source == "throw":
+                self.play("throw")
+            elif defender.is_guarding:
+                self.play("guard")
+            else:
+                self.play("hit")
+        for proj in sim.spawned:
+            self.play("fusion" if proj.kind == "rasensyuriken" else "shot")
+
+    # ---------------------
+    # BGM・音量
+    # ---------------------
+    def play_music(self, path: str, loops: int = -1) -> None:
+        """BGM を鳴らす（同じ曲が鳴っていればそのまま）"""
+        if not self.enabled or path in self.missing:
+            return
+        if path == self.music_path and pg.mixer.music.get_busy():
+            return
+        data = self.music_data.get(path)
+        if data is None:
+            data = LOADER.file_data(path)
+        try:
+            if data is None:
+                with open(os.path.join(BASE_DIR, path), "rb") as f:
+                    data = f.read()
+            self.music_data[path] = data
+            pg.mixer.music.load(io.BytesIO(data), os.path.splitext(path)[1].lstrip("."))
+            pg.mixer.music.set_volume(self.volume)
+            pg.mixer.music.play(loops)
+            self.music_path = path
+        except (OSError, pg.error) as e:
+            # 読めないファイルは何度も試さない
+            self.missing.add(path)
+            print(f"[BGM load error] {path} : {e}")
+
+    def set_volume(self, volume: float) -> None:
+        """BGM と効果音の音量（HUD.volume）"""
+        self.volume = volume
+        if not self.enabled:
+            return
         pg.mixer.music.set_volume(volume)
-        pg.mixer.music.play(loops)
-    except Exception as e:
-        print(f"[BGM load error] {path} : {e}")
+        for channel in self.channels:
+            channel.set_volume(volume)
+
+    def report(self) -> str:
+        return (f"audio: {len(self.sounds)} effects, {len(self.music_data)} music files in memory, "
+                f"played {self.played}, stolen {self.stolen}, dropped {self.dropped}")
+
+
+def synth_sound(freq: int, length_ms: int, wave: str) -> "pg.mixer.Sound":
+    """短い効果音を合成する（矩形波かノイズ、だんだん小さくなる）"""
+    rate, size, channels = pg.mixer.get_init()
+    n = rate * length_ms // 1000
+    period = max(1, rate // freq)
+    rng = random.Random(freq)
+    samples = array("h")
+    for i in range(n):
+        if wave == "noise":
+            # 周期ごとに値を変えるノイズ（周波数で音の高さが変わる）
+            if i % period == 0:
+                value = rng.uniform(-1, 1)
+        else:
+            value = 1 if (i // (period // 2 or 1)) % 2 else -1
+        level = int(value * 12000 * (1 - i / n))
+        samples.extend([level] * channels)
+    if abs(size) == 8:
+        # 8 ビットのミキサーには符号なしで渡す
+        data = bytes((s >> 8) + 128 if size > 0 else (s >> 8) & 0xFF for s in samples)
+    elif abs(size) == 32:
+        data = array("f", (s / 32768 for s in samples)).tobytes()
+    else:
+        data = samples.tobytes()
+    return pg.mixer.Sound(buffer=data)
+
+
+AUDIO = AudioSystem()
+
+
+def safe_load_and_play_bgm(path, volume=0.5, loops=-1):
+    """BGMを安全にロードして再生する（一度読んだ曲はメモリから読む）"""
+    AUDIO.set_volume(volume)
+    AUDIO.play_music(path, loops)
 
 
 # =====================
 # 画像読み込み
 # =====================
-try:
-    TITLE_BG = pg.transform.scale(
-        pg.image.load("ダウンロード (1).jpg").convert(),
-        (WIDTH, HEIGHT)
-    )
-except:
-    TITLE_BG = pg.Surface((WIDTH, HEIGHT))
-    TITLE_BG.fill((20, 20, 50))
+TITLE_BG_FILE = "ダウンロード (1).jpg"
+
+
+def title_background() -> pg.Surface:
+    return ASSETS.image(TITLE_BG_FILE, (WIDTH, HEIGHT), alpha=False, fallback=(20, 20, 50))
+
 
 # =====================
 # ステージ定義
 # =====================
+# 背景は最初にプレビュー・選択されたときに読み込む（stage_background()）
 STAGES = []
 stage_files = [
     ("境内", "Tryfog.jpg"),
@@ -100,15 +1185,28 @@ stage_files = [
 ]
 
 for name, filename in stage_files:
-    try:
-        bg = pg.transform.scale(
-            pg.image.load(filename).convert(),
-            (WIDTH, HEIGHT)
-        )
-    except:
-        bg = pg.Surface((WIDTH, HEIGHT))
-        bg.fill((50, 50, 80))
-    STAGES.append({"name": name, "bg": bg})
+    STAGES.append({"name": name, "file": filename})
+
+
+def stage_background(index: int) -> pg.Surface:
+    """ステージの背景画像（初回のみ読み込む）"""
+    LOADER.poll()
+    return ASSETS.image(STAGES[index]["file"], (WIDTH, HEIGHT), alpha=False, fallback=(50, 50, 80))
+
+
+def preload_stage(index: int) -> None:
+    """
+    ステージ選択中に、選んでいるステージの背景とバトルBGMを別スレッドで読み始める。
+    両隣のステージも後回しで読んでおく。
+    """
+    for i, urgent in ((index, True), (index - 1, False), (index + 1, False)):
+        if 0 <= i < len(STAGES):
+            LOADER.request_image(STAGES[i]["file"], (WIDTH, HEIGHT), alpha=False, urgent=urgent)
+    LOADER.request_file(BATTLE_BGM)
+
+
+# 背景を読み込み中のステージ選択画面に出す色
+STAGE_PLACEHOLDER_COLOR = (50, 50, 80)
 
 
 # =====================
@@ -150,6 +1248,400 @@ def apply_knockback(target, attacker, damage):
         target.vy = -8
         target.on_ground = False
 
+
+# =====================
+# プレイヤー入力
+# =====================
+ACTIONS = ("left", "right", "jump", "down", "punch", "kick", "beam", "bomb", "throw")
+ACTION_BIT = {name: 1 << i for i, name in enumerate(ACTIONS)}
+
+
+class PlayerInput:
+    """
+    1フレーム分のプレイヤー入力。
+    held は押しっぱなしの操作、pressed はこのフレームで押された操作のビットマスク。
+    """
+
+    __slots__ = ("held", "pressed")
+
+    def __init__(self, held: int = 0, pressed: int = 0) -> None:
+        self.held = held
+        self.pressed = pressed
+
+    def is_held(self, action: str) -> bool:
+        return bool(self.held & ACTION_BIT[action])
+
+    def was_pressed(self, action: str) -> bool:
+        return bool(self.pressed & ACTION_BIT[action])
+
+    @classmethod
+    def from_keys(cls, keys: dict[str, int], key_lst, pressed_keys=()) -> "PlayerInput":
+        """
+        キー設定と pygame のキー状態から入力を作る。
+
+        Args:
+            keys: 操作キー設定（操作名 -> キーコード）
+            key_lst: pygame.key.get_pressed() の結果
+            pressed_keys: このフレームの KEYDOWN のキーコード
+        """
+        held = 0
+        pressed = 0
+        for action, code in keys.items():
+            if key_lst[code]:
+                held |= ACTION_BIT[action]
+            if code in pressed_keys:
+                pressed |= ACTION_BIT[action]
+        return cls(held, pressed)
+
+    def pack(self) -> int:
+        """held と pressed を1つの整数にまとめる（通信・記録用）"""
+        return self.held | (self.pressed << len(ACTIONS))
+
+    @classmethod
+    def unpack(cls, value: int) -> "PlayerInput":
+        mask = (1 << len(ACTIONS)) - 1
+        return cls(value & mask, (value >> len(ACTIONS)) & mask)
+
+
+# =====================
+# 入力バッファ
+# =====================
+# 先行入力: 攻撃中・硬直中に押したパンチ・キックを、動けるようになる何フレーム前までなら出すか
+BUFFER_WINDOW = 6
+# コマンド入力: 方向と方向の間 / 最後の方向からボタンまでに許すフレーム数
+MOTION_STEP_WINDOW = 10
+MOTION_BUTTON_WINDOW = 8
+# 先行入力の対象
+BUFFERED_ACTIONS = ACTION_BIT["punch"] | ACTION_BIT["kick"]
+
+
+class KeyMap:
+    """
+    キーコード -> (プレイヤー番号, 操作ビット) の逆引き表と、プレイヤーごとの入力状態。
+    イベント1つにつき辞書を1回引くだけで、どのプレイヤーのどの操作かがわかる。
+    """
+
+    def __init__(self, key_sets) -> None:
+        """
+        Args:
+            key_sets: プレイヤーごとの操作キー設定（操作名 -> キーコード）の並び
+        """
+        self.table: dict[int, list[tuple[int, int]]] = {}
+        for player, keys in enumerate(key_sets):
+            for action, code in keys.items():
+                self.table.setdefault(code, []).append((player, ACTION_BIT[action]))
+        self.held = [0] * len(key_sets)
+        self.pressed = [0] * len(key_sets)
+
+    def handle_event(self, event) -> bool:
+        """キー操作なら入力状態に反映する。操作キーだったら True"""
+        if event.type == pg.KEYDOWN:
+            bindings = self.table.get(event.key)
+            if bindings:
+                for player, bit in bindings:
+                    self.held[player] |= bit
+                    self.pressed[player] |= bit
+                return True
+        elif event.type == pg.KEYUP:
+            bindings = self.table.get(event.key)
+            if bindings:
+                for player, bit in bindings:
+                    self.held[player] &= ~bit
+                return True
+        elif event.type == pg.WINDOWFOCUSLOST:
+            # 離したことがわからなくなるので、押しっぱなしを解除する
+            self.release_all()
+        return False
+
+    def state(self, player: int) -> tuple[int, int]:
+        """(押しっぱなし, 前回の clear_pressed から押された) のビットマスク"""
+        return self.held[player], self.pressed[player]
+
+    def clear_pressed(self) -> None:
+        for i in range(len(self.pressed)):
+            self.pressed[i] = 0
+
+    def release_all(self) -> None:
+        for i in range(len(self.held)):
+            self.held[i] = 0
+            self.pressed[i] = 0
+
+
+class InputBuffer:
+    """
+    1人分の入力の履歴（時刻つきのリングバッファ）と、それを使った先行入力・コマンド入力の判定。
+
+    履歴には方向が変わったとき（テンキー表記の 1-9）とボタンを押したとき（10 + 操作番号）を記録する。
+    コマンドは技ごとに「何個目の方向まで入ったか」だけを持ち、入力が来るたびに進めるので、
+    判定の手間は履歴の長さによらない。
+    """
+
+    SIZE = 64
+    BUTTON = 10
+
+    def __init__(self) -> None:
+        self.frames = array("i", [0] * self.SIZE)
+        self.codes = array("B", [0] * self.SIZE)
+        self.reset()
+
+    def reset(self) -> None:
+        self.head = 0
+        self.count = 0
+        self.frame = 0
+        self.direction = 5
+        self.waiting = 0  # 先行入力で待っているボタン
+        self.waiting_frame = 0
+        # コマンド技ごとの進み具合（方向がいくつ入ったか, 最後に入ったフレーム）
+        self.progress: dict[int, list[int]] = {}
+
+    def push(self, code: int) -> None:
+        """履歴に1件記録する（古いものから上書き）"""
+        self.frames[self.head] = self.frame
+        self.codes[self.head] = code
+        self.head = (self.head + 1) % self.SIZE
+        self.count = min(self.count + 1, self.SIZE)
+
+    def history(self, limit: int = SIZE):
+        """新しい順に (フレーム, コード) を返す"""
+        for k in range(1, min(limit, self.count) + 1):
+            i = (self.head - k) % self.SIZE
+            yield self.frames[i], self.codes[i]
+
+    @staticmethod
+    def direction_of(held: int, facing: int) -> int:
+        """押しっぱなしの方向キーを、向きを考えたテンキー表記にする（6 が前）"""
+        x = bool(held & ACTION_BIT["right"]) - bool(held & ACTION_BIT["left"])
+        if held & ACTION_BIT["down"]:
+            y = -3
+        elif held & ACTION_BIT["jump"]:
+            y = 3
+        else:
+            y = 0
+        return 5 + x * facing + y
+
+    def feed(self, held: int, pressed: int, fighter: "Fighter") -> PlayerInput:
+        """
+        1フレーム分のキー入力を記録して、シミュレーションに渡す入力を作る。
+        コマンドが成立したらボタンの代わりに技の操作を押したことにする。
+        """
+        self.frame += 1
+        frame = self.frame
+        moves = fighter.moves
+
+        direction = self.direction_of(held, fighter.facing)
+        if direction != self.direction:
+            self.direction = direction
+            self.push(direction)
+            for m, dirs, _, _ in moves.motions:
+                step = self.progress.setdefault(m, [0, 0])
+                n, last = step
+                in_time = n == 0 or frame - last <= MOTION_STEP_WINDOW
+                if n < len(dirs) and direction == dirs[n] and in_time:
+                    step[0] = n + 1
+                    step[1] = frame
+                elif direction == dirs[0]:
+                    step[0] = 1
+                    step[1] = frame
+                # それ以外の方向（途中でニュートラルに戻るなど）は無視して、時間切れだけで判定する
+
+        if pressed:
+            for i in range(len(ACTIONS)):
+                if pressed >> i & 1:
+                    self.push(self.BUTTON + i)
+            for m, dirs, button, action in moves.motions:
+                step = self.progress.get(m)
+                if (step and step[0] == len(dirs) and pressed & button and
+                        frame - step[1] <= MOTION_BUTTON_WINDOW and
+                        fighter.energy >= moves.energy[m]):
+                    pressed = (pressed & ~button) | action
+                    step[0] = 0
+
+        # 先行入力（攻撃中・硬直中の押下を覚えておき、動けるようになったら出す）
+        busy = fighter.attack_timer > 0 or fighter.recover_timer > 0
+        if busy:
+            if pressed & BUFFERED_ACTIONS:
+                self.waiting = pressed & BUFFERED_ACTIONS
+                self.waiting_frame = frame
+        elif self.waiting:
+            if frame - self.waiting_frame <= BUFFER_WINDOW:
+                pressed |= self.waiting
+            self.waiting = 0
+
+        return PlayerInput(held, pressed)
+
+
+# =====================
+# ファイター画像読み込み
+# =====================
+# ポーズ名 -> (ファイル名の接尾辞, サイズ, 読み込み失敗時の色)
+# 色が None のポーズは待機画像で代用する
+FIGHTER_POSE_FILES = {
+    "idle": ("", (150, 200), (255, 100, 100, 255)),
+    "punch": ("_punch", (150, 200), None),
+    "kick": ("_kick", (190, 200), (100, 255, 100, 255)),
+    "crouch": ("_crouch", (110, 150), (100, 100, 255, 255)),
+}
+
+
+def load_fighter_sprites(char_name: str) -> dict[str, tuple[pg.Surface, pg.Surface]]:
+    """
+    キャラクターの各ポーズ画像を取得する（画像はアセット管理で共有）。
+
+    Returns:
+        ポーズ名 -> (右向き画像, 左向き画像)
+    """
+    sprites = {}
+    for pose, (suffix, size, fallback) in FIGHTER_POSE_FILES.items():
+        if fallback is None:
+            fallback = sprites["idle"][0]
+        path = f"fig/{char_name}fighter{suffix}.png"
+        sprites[pose] = (
+            ASSETS.image(path, size, fallback=fallback),
+            ASSETS.image(path, size, fallback=fallback, flip=True),
+        )
+    return sprites
+
+# =====================
+# 技データ
+# =====================
+# 技の定義。フレーム数は 1/60 秒単位。
+#   打撃 (strike):
+#     pose: 技を出している間のポーズ
+#     startup / active / recovery: 判定が出るまで / 攻撃判定が出ている間 / 判定が消えて構えが終わるまで
+#     cooldown: 構えが終わってから動けるようになるまで
+#     hitbox: 攻撃判定 (幅, 高さ, 前方向のずれ, 上方向のずれ) の active 中の各フレームの値
+#     hurtbox: 技を出している間にのびるくらい判定（同じ形式、startup + active + recovery の各フレーム）
+#     どちらも1つだけ書けば全フレーム同じ値になる
+#   飛び道具 (projectile):
+#     hitbox: 当たり判定 (幅, 高さ) / speed: 1フレームの移動量 / rotate: 1フレームの回転角度
+#   共通: damage: ダメージ / energy: 消費エネルギー
+#     motion: コマンド入力の方向（テンキー表記、右向きのとき。6 が前、2 が下）と button のボタン
+#             例: (2, 3, 6) + "punch" は 下・右下・右 + パンチ（左向きなら左右が逆）
+BASE_MOVES = {
+    "punch": {
+        "type": "strike", "pose": "punch",
+        "startup": 0, "active": 6, "recovery": 4, "cooldown": 10,
+        "hitbox": [(40, 20, 70, 60)], "hurtbox": [(65, 30, 70, 60)],
+        "damage": 5, "energy": 0,
+    },
+    "kick": {
+        "type": "strike", "pose": "kick",
+        "startup": 0, "active": 8, "recovery": 7, "cooldown": 10,
+        "hitbox": [(65, 25, 70, -60)], "hurtbox": [(85, 35, 70, -60)],
+        "damage": 8, "energy": 0,
+    },
+    "beam": {
+        "type": "projectile", "hitbox": (15, 15), "speed": 12, "rotate": 20,
+        "damage": 10, "energy": 20, "motion": (2, 3, 6), "button": "punch",
+    },
+    "bomb": {
+        "type": "projectile", "hitbox": (40, 40), "speed": 8, "rotate": 0,
+        "damage": 15, "energy": 30, "motion": (2, 1, 4), "button": "kick",
+    },
+    # 手裏剣と螺旋丸が融合してできる（ボタンでは出せない）
+    "rasensyuriken": {
+        "type": "projectile", "hitbox": (45, 45), "speed": 8, "rotate": 15,
+        "damage": 30, "energy": 0,
+    },
+}
+
+# キャラクターごとに BASE_MOVES から変える値 {技: {項目: 値}}
+CHARACTER_MOVES = {
+    "man": {},
+    "woman": {},
+}
+
+NO_BOX = (0, 0, 0, 0)
+
+
+class MoveTable:
+    """
+    技データを、技の番号とフレーム番号で引ける平たい表にしたもの。
+
+    hitbox[hitbox_start[技] + フレーム] のように、毎フレームの判定は配列を1回引くだけで求まる。
+    判定のないフレームは NO_BOX（幅 0 の矩形はどことも当たらない）。
+    """
+
+    def __init__(self, moves: dict) -> None:
+        self.names = tuple(moves)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.kind = []
+        self.pose = []
+        self.startup = []
+        self.active = []
+        self.recovery = []
+        self.cooldown = []
+        self.duration = []   # startup + active + recovery
+        self.damage = []
+        self.energy = []
+        self.speed = []
+        self.rotate = []
+        self.size = []       # 飛び道具の当たり判定の大きさ
+        self.hitbox_start = []
+        self.hurtbox_start = []
+        self.hitbox: list[tuple[int, int, int, int]] = []
+        self.hurtbox: list[tuple[int, int, int, int]] = []
+        # コマンド技 (技の番号, 方向の並び, ボタンのビット, 出す操作のビット)
+        self.motions: list[tuple[int, tuple[int, ...], int, int]] = []
+
+        for name, move in moves.items():
+            kind = move["type"]
+            startup = move.get("startup", 0)
+            active = move.get("active", 0)
+            recovery = move.get("recovery", 0)
+            self.kind.append(kind)
+            self.pose.append(move.get("pose"))
+            self.startup.append(startup)
+            self.active.append(active)
+            self.recovery.append(recovery)
+            self.cooldown.append(move.get("cooldown", 0))
+            self.duration.append(startup + active + recovery)
+            self.damage.append(move["damage"])
+            self.energy.append(move.get("energy", 0))
+            self.speed.append(move.get("speed", 0))
+            self.rotate.append(move.get("rotate", 0))
+            if move.get("motion"):
+                if name not in ACTION_BIT:
+                    raise ValueError(f"{name} has a motion but no button of its own")
+                self.motions.append((len(self.kind) - 1, tuple(move["motion"]),
+                                     ACTION_BIT[move["button"]], ACTION_BIT[name]))
+
+            self.hitbox_start.append(len(self.hitbox))
+            self.hurtbox_start.append(len(self.hurtbox))
+            if kind == "strike":
+                self.size.append((0, 0))
+                self.hitbox.extend([NO_BOX] * startup + self._frames(name, move, "hitbox", active))
+                self.hurtbox.extend(self._frames(name, move, "hurtbox", startup + active + recovery))
+            elif kind == "projectile":
+                self.size.append(tuple(move["hitbox"]))
+            else:
+                raise ValueError(f"unknown move type {kind!r} for {name}")
+
+    @staticmethod
+    def _frames(name: str, move: dict, key: str, count: int) -> list:
+        boxes = [tuple(box) if box else NO_BOX for box in move.get(key) or [None]]
+        if len(boxes) == 1:
+            return boxes * count
+        if len(boxes) != count:
+            raise ValueError(f"{name}.{key} needs 1 or {count} boxes, got {len(boxes)}")
+        return boxes
+
+
+MOVE_TABLES: dict[str, MoveTable] = {}
+
+
+def move_table(char_name: str) -> MoveTable:
+    """キャラクターの技の表（初回にだけ作る）"""
+    table = MOVE_TABLES.get(char_name)
+    if table is None:
+        overrides = CHARACTER_MOVES.get(char_name, {})
+        moves = {name: {**move, **overrides.get(name, {})} for name, move in BASE_MOVES.items()}
+        for name, move in overrides.items():
+            moves.setdefault(name, move)
+        table = MOVE_TABLES[char_name] = MoveTable(moves)
+    return table
+
+
 # =====================
 # Fighter クラス
 # =====================
@@ -159,7 +1651,16 @@ class Fighter(pg.sprite.Sprite):
     移動・ジャンプ・攻撃・防御・しゃがみの状態を管理する。
     """
 
-    def __init__(self, x: int, keys: dict[str, int], char_name: str) -> None:
+    # ポーズごとの当たり判定サイズ（画像サイズと同じ）
+    POSE_SIZE = {
+        "idle": (150, 200),
+        "punch": (150, 200),
+        "kick": (190, 200),
+        "crouch": (110, 150),
+    }
+
+    def __init__(self, x: int, keys: dict[str, int], char_name: str,
+                 headless: bool = False) -> None:
         """
         Fighterを初期化する。
 
@@ -167,6 +1668,7 @@ class Fighter(pg.sprite.Sprite):
             x: 初期X座標
             keys: 操作キー設定
             char_name: キャラクター名
+            headless: True の場合は画像を読み込まない（シミュレーション専用）
         """
         super().__init__()
         self.energy = 100  # 追加：エネルギー
@@ -179,49 +1681,15 @@ class Fighter(pg.sprite.Sprite):
         self.energy_regen = 0.1
 
         # ===== 画像読み込み =====
-        try:
-            self.idle_r = pg.transform.scale(
-                pg.image.load(f"fig/{char_name}fighter.png").convert_alpha(),
-                (150, 200)
-            )
-        except:
-            self.idle_r = pg.Surface((150, 200), pg.SRCALPHA)
-            self.idle_r.fill((255, 100, 100, 255))
-        self.idle_l = pg.transform.flip(self.idle_r, True, False)
-
-        try:
-            self.punch_r = pg.transform.scale(
-                pg.image.load(f"fig/{char_name}fighter_punch.png").convert_alpha(),
-                (150, 200)
-            )
-        except:
-            self.punch_r = self.idle_r.copy()
-
-        self.punch_l = pg.transform.flip(self.punch_r, True, False)
-
-        try:
-            self.kick_r = pg.transform.scale(
-                pg.image.load(f"fig/{char_name}fighter_kick.png").convert_alpha(),
-                (190, 200)
-            )
-        except:
-            self.kick_r = pg.Surface((190, 200), pg.SRCALPHA)
-            self.kick_r.fill((100, 255, 100, 255))
-        self.kick_l = pg.transform.flip(self.kick_r, True, False)
-        
-        try:
-            self.crouch_r = pg.transform.scale(
-                pg.image.load(f"fig/{char_name}fighter_crouch.png").convert_alpha(),
-                (110, 150)
-            )
-        except:
-            self.crouch_r = pg.Surface((150, 140), pg.SRCALPHA)
-            self.crouch_r.fill((100, 100, 255, 255))
-
-        self.crouch_l = pg.transform.flip(self.crouch_r, True, False)
+        # headless の場合は画像を持たず、ポーズごとのサイズだけで判定する
+        self.char_name = char_name
+        self.sprites = None if headless else load_fighter_sprites(char_name)
+        self.moves = move_table(char_name)
+        self.move = None  # 出している技の番号
+        self.pose = "idle"
+        self.facing: int = 1
 
-        self.image = self.idle_r
-        self.rect = self.image.get_rect()
+        self.rect = pg.Rect((0, 0), self.POSE_SIZE["idle"])
         self.rect.bottomleft = (x, FLOOR)
 
         # ===== HurtBox =====
@@ -237,7 +1705,7 @@ class Fighter(pg.sprite.Sprite):
 
         # ステータス
         self.hp: int = 100
-        self.facing: int = 1
+        self.team: int = 0  # BattleSim が決める
 
         # 入力設定
         self.keys = keys
@@ -249,39 +1717,41 @@ class Fighter(pg.sprite.Sprite):
         self.attack_timer: int = 0
         self.recover_timer: int = 0
 
+    @property
+    def image(self) -> pg.Surface | None:
+        """現在のポーズと向きに対応する画像（headless の場合は None）"""
+        if self.sprites is None:
+            return None
+        return self.sprites[self.pose][0 if self.facing == 1 else 1]
+
     def update_hurtbox(self):
         """本体のくらい判定を更新"""
         self.hurtbox.centerx = self.rect.centerx
         self.hurtbox.bottom = self.rect.bottom
 
     def update_attack_hurtbox(self):
-        """攻撃中のくらい判定を更新"""
-        if self.attack_timer == 0:
+        """攻撃中のくらい判定を技の表から更新"""
+        moves = self.moves
+        m = self.move
+        # しゃがみから出した技などでポーズが変わっていたら判定はのびない
+        if self.attack_timer == 0 or m is None or self.pose != moves.pose[m]:
             self.attack_hurtbox = None
             return
 
-        if self.image in (self.punch_r, self.punch_l):
-            w, h = 65, 30
-            offset_x = 70 if self.facing == 1 else -70
-            offset_y = 60
-        elif self.image in (self.kick_r, self.kick_l):
-            w, h = 85, 35
-            offset_x = 70 if self.facing == 1 else -70
-            offset_y = -60
-        else:
+        frame = moves.duration[m] - 1 - self.attack_timer
+        w, h, ox, oy = moves.hurtbox[moves.hurtbox_start[m] + frame]
+        if w == 0:
             self.attack_hurtbox = None
             return
+        self.attack_hurtbox = pg.Rect(self.rect.centerx + ox * self.facing - w // 2,
+                                      self.rect.centery - oy - h // 2, w, h)
 
-        self.attack_hurtbox = pg.Rect(0, 0, w, h)
-        self.attack_hurtbox.centerx = self.rect.centerx + offset_x
-        self.attack_hurtbox.centery = self.rect.centery - offset_y
-
-    def update(self, key_lst: list[bool], enemy: "Fighter" = None) -> None:
+    def update(self, inp: "PlayerInput", enemy: "Fighter" = None) -> None:
         """
         キャラクターの状態更新を行う。
 
         Args:
-            key_lst: pygame.key.get_pressed() の結果
+            inp: このフレームのプレイヤー入力
             enemy: 対戦相手の Fighter
         """
         self.vx = 0
@@ -291,7 +1761,7 @@ class Fighter(pg.sprite.Sprite):
         if self.attack_timer > 0:
             self.attack_timer -= 1
             if self.attack_timer == 0:
-                self.recover_timer = 10
+                self.recover_timer = self.moves.cooldown[self.move]
         elif self.recover_timer > 0:
             self.recover_timer -= 1
         else:
@@ -310,51 +1780,46 @@ class Fighter(pg.sprite.Sprite):
         # =====================
         # しゃがみ処理
         # =====================
-        if key_lst[self.keys["down"]] and self.on_ground and can_move:
+        if inp.is_held("down") and self.on_ground and can_move:
             if not self.is_crouching:
                 self.is_crouching = True
-                old_bottom = self.rect.bottom
-                self.image = self.crouch_r if self.facing == 1 else self.crouch_l
-                self.rect = self.image.get_rect(
-                    midbottom=(self.rect.centerx, old_bottom)
-                )
+                self.set_pose("crouch")
         else:
             if self.is_crouching:
                 self.is_crouching = False
-                self.image = self.idle_r if self.facing == 1 else self.idle_l
-                self.rect = self.image.get_rect(midbottom=self.rect.midbottom)
+                self.set_pose("idle")
 
         # =====================
         # 防御処理（攻撃中・しゃがみ中は不可）
         # =====================
         if not self.is_attacking and not self.is_crouching and enemy and can_move:
-            back_key = (
-                self.keys["left"]
+            back_action = (
+                "left"
                 if enemy.rect.centerx > self.rect.centerx
-                else self.keys["right"]
+                else "right"
             )
 
-            if key_lst[back_key]:
+            if inp.is_held(back_action):
                 self.is_guarding = True
                 self.vx = (
-                    -1 if back_key == self.keys["left"] else 1
+                    -1 if back_action == "left" else 1
                 ) * (self.walk_speed // 2)
 
         # =====================
         # 通常移動
         # =====================
         if not self.is_guarding and not self.is_crouching and can_move:
-            if key_lst[self.keys["left"]]:
+            if inp.is_held("left"):
                 self.vx = -self.walk_speed
                 self.facing = -1
-            if key_lst[self.keys["right"]]:
+            if inp.is_held("right"):
                 self.vx = self.walk_speed
                 self.facing = 1
 
         # =====================
         # ジャンプ
         # =====================
-        if (key_lst[self.keys["jump"]] and self.on_ground and 
+        if (inp.is_held("jump") and self.on_ground and 
             not self.is_crouching and can_move):
             self.vy = -20
             self.on_ground = False
@@ -362,7 +1827,7 @@ class Fighter(pg.sprite.Sprite):
         # 待機画像更新
         if (self.attack_timer == 0 and self.recover_timer == 0 and 
             not self.is_crouching):
-            self.image = self.idle_r if self.facing == 1 else self.idle_l
+            self.pose = "idle"
 
         # =====================
         # 重力・位置更新
@@ -379,119 +1844,222 @@ class Fighter(pg.sprite.Sprite):
         self.update_hurtbox()
         self.update_attack_hurtbox()
 
+    def set_pose(self, pose: str) -> None:
+        """ポーズを切り替え、足元を基準に矩形サイズを合わせる"""
+        midbottom = self.rect.midbottom
+        self.pose = pose
+        self.rect = pg.Rect((0, 0), self.POSE_SIZE[pose])
+        self.rect.midbottom = midbottom
+
     def do_attack(self, atk_type, attacks):
         """攻撃を実行"""
         if self.attack_timer > 0 or self.recover_timer > 0:
             return
 
-        if atk_type == "punch":
-            self.image = self.punch_r if self.facing == 1 else self.punch_l
-            self.attack_timer = 10
-            self.is_attacking = True
-        elif atk_type == "kick":
-            self.image = self.kick_r if self.facing == 1 else self.kick_l
-            self.attack_timer = 15
-            self.is_attacking = True
+        m = self.moves.index[atk_type]
+        self.move = m
+        self.pose = self.moves.pose[m]
+        self.attack_timer = self.moves.duration[m]
+        self.is_attacking = True
 
-        attacks.add(Attack(self, atk_type))
+        attacks.spawn().start(self, atk_type)
 
 
 # =====================
-# 攻撃クラス
+# 攻撃・飛び道具のレコードの並び
 # =====================
-class Attack(pg.sprite.Sprite):
-    """攻撃判定用のヒットボックスクラス"""
+class RecordList:
+    """
+    攻撃判定・飛び道具のレコードの並び（pg.sprite.Group の代わり）。
 
-    DATA = {
-        "punch": {"size": (40, 20), "life": 6, "damage": 5},
-        "kick": {"size": (65, 25), "life": 8, "damage": 8},
-    }
+    生きているレコードを出した順に items に並べる。kill() されたレコードは alive が False になり、
+    compact() で items から外して free に戻し、次の spawn() で使い回す。
+    allocated は新しく作ったレコードの数で、出る数が一巡したあとは増えない。
+    """
+
+    def __init__(self, factory) -> None:
+        self.factory = factory
+        self.items = []
+        self.free = []
+        self.allocated = 0
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def spawn(self):
+        """空いているレコードを取り出して items の最後に加える（中身は呼んだ側で入れる）"""
+        if self.free:
+            record = self.free.pop()
+        else:
+            record = self.factory()
+            self.allocated += 1
+        record.alive = True
+        self.items.append(record)
+        return record
+
+    def compact(self) -> None:
+        """消えたレコードを順番を変えずに items から外す"""
+        items = self.items
+        j = 0
+        for record in items:
+            if record.alive:
+                items[j] = record
+                j += 1
+            else:
+                self.free.append(record)
+        del items[j:]
+
+    def clear(self) -> None:
+        for record in self.items:
+            record.alive = False
+        self.free.extend(self.items)
+        self.items.clear()
+
+
+# =====================
+# 攻撃クラス
+# =====================
+class Attack:
+    """
+    攻撃判定用のヒットボックス。
+    技を出した瞬間のファイターの中心を基準に、技の表のフレームごとの判定を置く。
+    見えない判定なので画像は持たない。RecordList で使い回すので、中身は start() で入れる。
+    """
 
-    def __init__(self, fighter: Fighter, atk_type: str) -> None:
-        super().__init__()
-        self.owner = fighter
-        self.damage = self.DATA[atk_type]["damage"]
+    __slots__ = ("owner", "atk_type", "moves", "move", "damage", "frames", "life",
+                 "facing", "anchor", "rect", "alive")
 
-        w, h = self.DATA[atk_type]["size"]
-        self.image = pg.Surface((w, h), pg.SRCALPHA)
-        self.image.fill((0, 0, 0, 0))
+    def __init__(self) -> None:
+        self.owner = None
+        self.rect = pg.Rect(0, 0, 0, 0)
+        self.alive = False
 
-        self.rect = self.image.get_rect()
-        offset_x = 70 if fighter.facing == 1 else -70
-        offset_y = 60 if atk_type == "punch" else -60
+    def start(self, fighter: Fighter, atk_type: str) -> "Attack":
+        moves = fighter.moves
+        m = moves.index[atk_type]
+        self.owner = fighter
+        self.atk_type = atk_type
+        self.moves = moves
+        self.move = m
+        self.damage = moves.damage[m]
+        self.frames = moves.startup[m] + moves.active[m]
+        self.life = self.frames
+        self.facing = fighter.facing
+        self.anchor = fighter.rect.center
+        self.place(0)
+        return self
 
-        self.rect.centerx = fighter.rect.centerx + offset_x
-        self.rect.centery = fighter.rect.centery - offset_y
+    def kill(self) -> None:
+        self.alive = False
 
-        self.life = self.DATA[atk_type]["life"]
+    def place(self, frame: int) -> None:
+        """frame フレーム目の判定に合わせて rect を置く"""
+        moves = self.moves
+        w, h, ox, oy = moves.hitbox[moves.hitbox_start[self.move] + frame]
+        ax, ay = self.anchor
+        self.rect.update(ax + ox * self.facing - w // 2, ay - oy - h // 2, w, h)
 
     def update(self) -> None:
         """攻撃判定の寿命管理"""
         self.life -= 1
         if self.life <= 0:
-            self.kill()
+            self.alive = False
+        else:
+            self.place(self.frames - self.life)
 
 
 # =====================
-# 飛び道具
+# 飛び道具の画像
 # =====================
-class Projectile(pg.sprite.Sprite):
-    def __init__(self, fighter, kind):
-        super().__init__()
-        self.owner = fighter
-        self.kind = kind
-        self.facing = fighter.facing
-        self.angle = 0
-        self.rotate_speed = 0
+# 種類 -> (画像ファイル, サイズ, 読み込み失敗時の色)
+PROJECTILE_FILES = {
+    "beam": ("fig/syuriken.png", (30, 30), (255, 200, 0, 255)),
+    "bomb": ("fig/rasengan1.png", (80, 80), (0, 150, 255, 255)),
+    "rasensyuriken": ("fig/rasensyuriken.png", (80, 80), (255, 100, 0, 255)),
+}
 
-        if kind == "beam":
-            try:
-                self.original_image = pg.transform.scale(
-                    pg.image.load("fig/syuriken.png").convert_alpha(), (30, 30)
-                )
-            except:
-                self.original_image = pg.Surface((30, 30), pg.SRCALPHA)
-                self.original_image.fill((255, 200, 0, 255))
 
-            self.hitbox_size = (15, 15)
-            self.speed = 12
-            self.damage = 10
-            self.rotate_speed = 20
+def projectile_image(kind: str, facing: int) -> pg.Surface:
+    """飛び道具の画像を向き付きで取得する（アセット管理で共有）"""
+    path, size, fallback = PROJECTILE_FILES[kind]
+    return ASSETS.image(path, size, fallback=fallback, flip=facing == -1)
 
-        elif kind == "bomb":
-            try:
-                self.original_image = pg.transform.scale(
-                    pg.image.load("fig/rasengan1.png").convert_alpha(), (80, 80)
-                )
-            except:
-                self.original_image = pg.Surface((80, 80), pg.SRCALPHA)
-                self.original_image.fill((0, 150, 255, 255))
 
-            self.hitbox_size = (40, 40)
-            self.speed = 8
-            self.damage = 15
-            self.rotate_speed = 0
+# =====================
+# 飛び道具の回転画像
+# =====================
+ROTATION_FRAMES: dict[tuple[str, int, int], list] = {}
+
 
-        elif kind == "rasensyuriken":
-            try:
-                self.original_image = pg.transform.scale(
-                    pg.image.load("fig/rasensyuriken.png").convert_alpha(), (80, 80)
-                )
-            except:
-                self.original_image = pg.Surface((80, 80), pg.SRCALPHA)
-                self.original_image.fill((255, 100, 0, 255))
+def get_rotation_frames(kind: str, facing: int, image: pg.Surface, step: int) -> list:
+    """
+    回転後の画像を step 度ごとに事前計算して返す（種類・向きごとに1回だけ作る）。
+
+    Returns:
+        [(画像, (幅, 高さ), 中心からのオフセット), ...]  添字は 角度 // step
+    """
+    key = (kind, facing, step)
+    frames = ROTATION_FRAMES.get(key)
+    if frames is None:
+        frames = []
+        for angle in range(0, 360, step):
+            rotated = pg.transform.rotate(image, angle)
+            w, h = rotated.get_size()
+            frames.append((rotated, (w, h), (w // 2, h // 2)))
+        ROTATION_FRAMES[key] = frames
+    return frames
+
+
+# =====================
+# 飛び道具
+# =====================
+class Projectile:
+    """
+    飛び道具。RecordList で使い回すので、中身は start() で入れる
+    （fighter を渡して作ればすぐに start() する）。
+    """
 
-            self.hitbox_size = (45, 45)
-            self.speed = 8
-            self.damage = 30
-            self.rotate_speed = 15
+    __slots__ = ("owner", "kind", "facing", "angle", "hitbox_size", "speed", "damage",
+                 "rotate_speed", "original_image", "image", "rect", "hitbox", "angle_step",
+                 "frames", "alive")
 
-        if self.facing == -1:
-            self.original_image = pg.transform.flip(self.original_image, True, False)
+    def __init__(self, fighter=None, kind=None, facing=None):
+        self.owner = None
+        self.rect = pg.Rect(0, 0, 0, 0)
+        self.hitbox = pg.Rect(0, 0, 0, 0)
+        self.alive = False
+        if fighter is not None:
+            self.start(fighter, kind, facing)
+
+    def start(self, fighter, kind, facing=None) -> "Projectile":
+        self.owner = fighter
+        self.kind = kind
+        self.facing = fighter.facing if facing is None else facing
+        self.angle = 0
 
-        self.image = self.original_image.copy()
-        self.rect = self.original_image.get_rect()
-        self.hitbox = pg.Rect(0, 0, *self.hitbox_size)
+        # 大きさ・速さ・ダメージ・回転角度（0 は回転しない）は技の表から
+        moves = fighter.moves
+        m = moves.index[kind]
+        self.hitbox_size = moves.size[m]
+        self.speed = moves.speed[m]
+        self.damage = moves.damage[m]
+        self.rotate_speed = moves.rotate[m]
+
+        self.original_image = projectile_image(kind, self.facing)
+
+        self.image = self.original_image
+        self.rect.update(0, 0, self.image.get_width(), self.image.get_height())
+        self.hitbox.update(0, 0, *self.hitbox_size)
+
+        # 回転画像は種類・向きごとに共有する
+        self.angle_step = math.gcd(self.rotate_speed, 360)
+        self.frames = (
+            get_rotation_frames(kind, self.facing, self.original_image, self.angle_step)
+            if self.rotate_speed != 0 else None
+        )
 
         if self.facing == 1:
             self.rect.midleft = fighter.rect.midright
@@ -499,6 +2067,10 @@ class Projectile(pg.sprite.Sprite):
             self.rect.midright = fighter.rect.midleft
 
         self.hitbox.center = self.rect.center
+        return self
+
+    def kill(self) -> None:
+        self.alive = False
 
     def update(self):
         self.rect.x += self.speed * self.facing
@@ -506,13 +2078,36 @@ class Projectile(pg.sprite.Sprite):
 
         if self.rotate_speed != 0:
             self.angle = (self.angle + self.rotate_speed) % 360
-            center = self.rect.center
-            self.image = pg.transform.rotate(self.original_image, self.angle)
-            self.rect = self.image.get_rect(center=center)
-            self.hitbox.center = center
+            cx, cy = self.rect.center
+            self.image, (w, h), (ox, oy) = self.frames[self.angle // self.angle_step]
+            self.rect.update(cx - ox, cy - oy, w, h)
+            self.hitbox.center = (cx, cy)
 
         if self.rect.right < 0 or self.rect.left > WIDTH:
-            self.kill()
+            self.alive = False
+
+
+def preload_assets(char_names=("man", "woman")) -> None:
+    """
+    対戦で使う画像と回転画像を先に用意しておく。
+    対戦中に飛び道具を出してもディスク読み込みや回転処理が起きないようにする。
+    """
+    for name in char_names:
+        load_fighter_sprites(name)
+        moves = move_table(name)
+        for kind in PROJECTILE_FILES:
+            speed = moves.rotate[moves.index[kind]]
+            for facing in (1, -1):
+                image = projectile_image(kind, facing)
+                if speed:
+                    get_rotation_frames(kind, facing, image, math.gcd(speed, 360))
+    # 描画解像度を下げているときは、縮小した画像も先に作っておく
+    if VIEW.scaled:
+        for name in char_names:
+            VIEW.prescale(surf for pair in load_fighter_sprites(name).values() for surf in pair)
+        VIEW.prescale(frame[0] for frames in ROTATION_FRAMES.values() for frame in frames)
+        VIEW.prescale(projectile_image(kind, facing) for kind in PROJECTILE_FILES for facing in (1, -1))
+    AUDIO.load_effects()
 
 
 # =====================
@@ -538,12 +2133,576 @@ def try_throw(attacker, defender):
     return False
 
 
+# =====================
+# 衝突判定
+# =====================
+def sweep_and_prune(boxes: list[tuple[pg.Rect, tuple]]) -> list[tuple[tuple, tuple]]:
+    """
+    x 軸のスイープ＆プルーンで、x 方向の範囲が重なる組だけを列挙する。
+
+    Args:
+        boxes: [(矩形, キー), ...]  キーは (グループ番号, 添字) のような比較可能な値
+    Returns:
+        [(キーa, キーb), ...]  キーa < キーb
+    """
+    pairs = []
+    active = []
+    for rect, key in sorted(boxes, key=lambda b: b[0].left):
+        left = rect.left
+        active = [a for a in active if a[0].right > left]
+        for _, other in active:
+            pairs.append((other, key) if other < key else (key, other))
+        active.append((rect, key))
+    return pairs
+
+
+class CollisionSystem:
+    """
+    攻撃・飛び道具・ファイターの当たり判定。
+    ブロードフェーズ（x軸スイープ＆プルーン）で候補を絞ってから矩形判定を行う。
+    """
+
+    def __init__(self) -> None:
+        self.pair_tests = 0  # このフレームで行った矩形判定の回数
+        self.hits = []       # このフレームの当たり (攻撃した側, 受けた側, 技, ダメージ, 当たった場所)
+
+    def begin_frame(self) -> None:
+        self.pair_tests = 0
+        self.hits.clear()
+
+    def test(self, a: pg.Rect, b: pg.Rect) -> bool:
+        """矩形判定（回数を数える）"""
+        self.pair_tests += 1
+        return a.colliderect(b)
+
+    def fuse_projectiles(self, projectiles: RecordList) -> list["Projectile"]:
+        """同じチームの手裏剣と螺旋丸が重なったら螺旋手裏剣に融合する（できた飛び道具を返す）"""
+        proj_list = projectiles.items
+        fused = []
+        if len(proj_list) < 2:
+            return fused
+
+        boxes = [(p.rect, (0, i)) for i, p in enumerate(proj_list)]
+        for (_, i), (_, j) in sorted(sweep_and_prune(boxes)):
+            p1_proj = proj_list[i]
+            p2_proj = proj_list[j]
+
+            if (p1_proj.alive and p2_proj.alive and
+                p1_proj.owner.team == p2_proj.owner.team and
+                {p1_proj.kind, p2_proj.kind} == {"beam", "bomb"} and
+                self.test(p1_proj.rect, p2_proj.rect)):
+
+                x = (p1_proj.rect.centerx + p2_proj.rect.centerx) // 2
+                y = (p1_proj.rect.centery + p2_proj.rect.centery) // 2
+
+                p1_proj.kill()
+                p2_proj.kill()
+
+                new_proj = projectiles.spawn().start(p1_proj.owner, "rasensyuriken")
+                new_proj.rect.center = (x, y)
+                new_proj.hitbox.center = (x, y)
+                fused.append(new_proj)
+        return fused
+
+    def candidates(self, boxes: list[pg.Rect], fighters: list["Fighter"]) -> dict[int, list[int]]:
+        """
+        ヒットボックスごとに、x 方向で重なりうるファイターの添字を求める。
+        ファイター側はくらい判定と攻撃中のくらい判定を合わせた範囲を使う。
+        """
+        items = [(rect, (0, i)) for i, rect in enumerate(boxes)]
+        for j, f in enumerate(fighters):
+            area = f.hurtbox.union(f.attack_hurtbox) if f.attack_hurtbox else f.hurtbox
+            items.append((area, (1, j)))
+
+        result: dict[int, list[int]] = {}
+        for (ga, a), (gb, b) in sweep_and_prune(items):
+            if ga == 0 and gb == 1:
+                result.setdefault(a, []).append(b)
+        for lst in result.values():
+            lst.sort()
+        return result
+
+    def resolve_hits(self, attacks: RecordList, projectiles: RecordList,
+                     fighters: list["Fighter"]) -> None:
+        """攻撃判定と飛び道具の当たりを処理する（持ち主と味方には当たらない）"""
+        atk_list = attacks.items
+        cand = self.candidates([atk.rect for atk in atk_list], fighters)
+        for i, atk in enumerate(atk_list):
+            for j in cand.get(i, ()):
+                f = fighters[j]
+                if f.team == atk.owner.team:
+                    continue
+
+                box = None
+                damage = atk.damage
+
+                # 防御中は軽減
+                if f.is_guarding:
+                    damage = damage // 3
+
+                if self.test(atk.rect, f.hurtbox):
+                    box = f.hurtbox
+                elif f.attack_hurtbox and self.test(atk.rect, f.attack_hurtbox):
+                    box = f.attack_hurtbox
+
+                if box is not None:
+                    f.hp -= damage
+                    self.hits.append((atk.owner, f, atk.atk_type, damage, atk.rect.clip(box).center))
+                    apply_knockback(f, atk.owner, damage)
+                    atk.kill()
+                    break
+
+        # 飛び道具とファイターの衝突判定
+        proj_list = projectiles.items
+        cand = self.candidates([proj.hitbox for proj in proj_list], fighters)
+        for i, proj in enumerate(proj_list):
+            if not proj.alive:
+                continue  # 融合で消えたもの
+            for j in cand.get(i, ()):
+                f = fighters[j]
+                if f.team != proj.owner.team and self.test(proj.hitbox, f.hurtbox):
+                    damage = proj.damage
+                    if f.is_guarding:
+                        damage = damage // 3
+                    f.hp -= damage
+                    self.hits.append((proj.owner, f, proj.kind, damage,
+                                      proj.hitbox.clip(f.hurtbox).center))
+                    apply_knockback(f, proj.owner, damage)
+                    proj.kill()
+                    break
+
+
+# =====================
+# 対戦シミュレーション
+# =====================
+MAX_FIGHTERS = 8
+
+
+class BattleSim:
+    """
+    描画を行わない対戦シミュレーション。
+    2〜MAX_FIGHTERS 人分の入力を受け取り、1フレームずつ試合を進める。
+
+    teams で同じ番号にしたファイター同士は味方で、攻撃が当たらず、飛び道具を融合できる
+    （省略時は全員が別のチームの個人戦）。各ファイターは一番近い敵を相手にする。
+    体力が 0 になったファイターは、その試合ではもう動かず、攻撃も当たらない。
+    """
+
+    # 2人のときの初期位置と向き
+    START = ((200, 1), (700, -1))
+
+    def __init__(self, *fighters: Fighter, match_frames: int = MATCH_TIME * FPS,
+                 teams=None) -> None:
+        """
+        Args:
+            fighters: 対戦する Fighter（P1, P2, ... の順）
+            match_frames: 制限時間(フレーム数)
+            teams: ファイターごとのチーム番号（例: (0, 0, 1, 1) で 2対2）
+        """
+        if not 2 <= len(fighters) <= MAX_FIGHTERS:
+            raise ValueError(f"a battle needs 2 to {MAX_FIGHTERS} fighters, got {len(fighters)}")
+        teams = tuple(range(len(fighters))) if teams is None else tuple(teams)
+        if len(teams) != len(fighters) or len(set(teams)) < 2:
+            raise ValueError(f"bad teams {teams} for {len(fighters)} fighters")
+        self.fighters = list(fighters)
+        self.teams = teams
+        for f, team in zip(self.fighters, teams):
+            f.team = team
+        self.targets = [None] * len(fighters)  # ファイターごとの一番近い敵（step() で求める）
+        self.order = list(range(len(fighters)))  # x 座標の順に並べたファイターの添字
+        self.attacks = RecordList(Attack)
+        self.projectiles = RecordList(Projectile)
+        self.allocations = 0  # 直前の step() で新しく作ったレコードの数
+        self.frame = 0
+        self.match_frames = match_frames
+        self.collisions = CollisionSystem()
+        self.spawned = []  # このフレームに出た飛び道具（融合でできたものを含む）
+        self.profiler = None  # FrameProfiler を入れると段階ごとに計測する
+
+    def start_positions(self) -> list[tuple[int, int]]:
+        """ファイターごとの初期位置（左端の x）と向き。3人以上なら等間隔に並べて中央を向かせる"""
+        n = len(self.fighters)
+        if n == 2:
+            return list(self.START)
+        width = Fighter.POSE_SIZE["idle"][0]
+        positions = []
+        for i in range(n):
+            x = 20 + i * (WIDTH - 40 - width) // (n - 1)
+            positions.append((x, 1 if x + width // 2 < WIDTH // 2 else -1))
+        return positions
+
+    def reset(self) -> None:
+        """試合開始時の状態に戻す"""
+        for f, (x, facing) in zip(self.fighters, self.start_positions()):
+            f.hp = 100
+            f.energy = 100
+            f.rect.bottomleft = (x, FLOOR)
+            f.facing = facing
+        self.clear_objects()
+        self.frame = 0
+        self.find_targets()
+
+    def clear_objects(self) -> None:
+        """攻撃判定と飛び道具をすべて消す"""
+        self.attacks.clear()
+        self.projectiles.clear()
+
+    def find_targets(self) -> None:
+        """
+        ファイターごとに、体力の残っている一番近い敵を targets に入れる。
+        x 座標の順に並べ、自分の左右へ最初に見つかった敵だけを比べるので、
+        味方が固まっていなければ人数にほぼ比例する手間ですむ。
+        """
+        fighters = self.fighters
+        order = self.order
+        order.sort(key=lambda i: fighters[i].rect.centerx)
+        n = len(order)
+        for pos in range(n):
+            me = fighters[order[pos]]
+            x = me.rect.centerx
+            best = None
+            best_dist = 0
+            for direction in (-1, 1):
+                p = pos + direction
+                while 0 <= p < n:
+                    other = fighters[order[p]]
+                    if other.team != me.team and other.hp > 0:
+                        dist = abs(other.rect.centerx - x)
+                        if best is None or dist < best_dist:
+                            best, best_dist = other, dist
+                        break
+                    p += direction
+            self.targets[order[pos]] = best
+
+    def step(self, inputs: tuple[PlayerInput, ...]) -> None:
+        """
+        1フレーム進める。
+
+        Args:
+            inputs: ファイターごとの入力（P1, P2, ... の順）
+        """
+        self.collisions.begin_frame()
+        self.spawned.clear()
+        allocated = self.attacks.allocated + self.projectiles.allocated
+        # 倒れたファイターは入力を受け付けず、攻撃も当たらない
+        standing = self.fighters
+        if any(f.hp <= 0 for f in self.fighters):
+            inputs = tuple(PlayerInput() if f.hp <= 0 else inp for f, inp in zip(self.fighters, inputs))
+            standing = [f for f in self.fighters if f.hp > 0]
+        self.find_targets()
+
+        # パンチ・キック
+        for f, inp in zip(self.fighters, inputs):
+            if inp.was_pressed("punch"):
+                f.do_attack("punch", self.attacks)
+            if inp.was_pressed("kick"):
+                f.do_attack("kick", self.attacks)
+
+        # 飛び道具
+        for f, inp in zip(self.fighters, inputs):
+            for kind in ("beam", "bomb"):
+                cost = f.moves.energy[f.moves.index[kind]]
+                if inp.was_pressed(kind) and f.energy >= cost:
+                    proj = self.projectiles.spawn().start(f, kind)
+                    self.spawned.append(proj)
+                    f.energy -= cost
+
+        # 投げ技（一番近い敵を投げる）
+        for attacker, defender, inp in zip(self.fighters, self.targets, inputs):
+            if defender is None or not inp.was_pressed("throw"):
+                continue
+            hp = defender.hp
+            if try_throw(attacker, defender):
+                self.collisions.hits.append((attacker, defender, "throw", hp - defender.hp,
+                                             defender.rect.center))
+        prof = self.profiler
+        if prof is not None:
+            prof.lap("sim_input")
+
+        # ファイター更新（防御の向きは一番近い敵で決める）
+        for f, inp, target in zip(self.fighters, inputs, self.targets):
+            f.update(inp, target)
+        if prof is not None:
+            prof.lap("fighters")
+
+        for atk in self.attacks:
+            atk.update()
+        self.attacks.compact()
+        if prof is not None:
+            prof.lap("attacks")
+        for proj in self.projectiles:
+            proj.update()
+        self.projectiles.compact()
+        if prof is not None:
+            prof.lap("projectiles")
+
+        self.spawned.extend(self.collisions.fuse_projectiles(self.projectiles))
+        self.collisions.resolve_hits(self.attacks, self.projectiles, standing)
+        self.attacks.compact()
+        self.projectiles.compact()
+        self.allocations = self.attacks.allocated + self.projectiles.allocated - allocated
+        if prof is not None:
+            prof.lap("collisions")
+            prof.add_allocations(self.allocations)
+        self.frame += 1
+
+    # =====================
+    # スナップショット
+    # =====================
+    # 試合状態を固定長のバイナリにまとめる（ロールバック・リプレイ用）
+    _HEAD = struct.Struct("<IBB")             # フレーム, 攻撃数, 飛び道具数
+    _FIGHTER = struct.Struct("<4i2hhdbBBB3h2i4i")
+    _ATTACK = struct.Struct("<BBb2i4ihh")      # 持ち主, 技, 向き, 基準点, 矩形, 寿命, ダメージ
+    _PROJECTILE = struct.Struct("<BBbh4i2i")  # 持ち主, 種類, 向き, 角度, 矩形, 当たり判定位置
+    NO_MOVE = 255
+    POSES = tuple(Fighter.POSE_SIZE)
+    PROJECTILE_KINDS = tuple(PROJECTILE_FILES)
+
+    def save_state(self) -> bytes:
+        """
+        試合状態をバイト列にする。
+        残り時間は frame から求まるので、HUD.match_time は hud.update_time(sim.frame) で戻す。
+        """
+        index = {f: i for i, f in enumerate(self.fighters)}
+        parts = [self._HEAD.pack(self.frame, len(self.attacks), len(self.projectiles))]
+        for f in self.fighters:
+            flags = (f.on_ground | f.is_guarding << 1 | f.is_crouching << 2 |
+                     f.is_attacking << 3 | (f.attack_hurtbox is not None) << 4)
+            ahb = f.attack_hurtbox or (0, 0, 0, 0)
+            parts.append(self._FIGHTER.pack(
+                *f.rect, f.vx, f.vy, f.hp, f.energy, f.facing,
+                self.POSES.index(f.pose), flags,
+                self.NO_MOVE if f.move is None else f.move,
+                f.attack_timer, f.recover_timer, f.throw_cool,
+                f.hurtbox.x, f.hurtbox.y, *ahb))
+        for atk in self.attacks:
+            parts.append(self._ATTACK.pack(
+                index[atk.owner], atk.move, atk.facing, *atk.anchor,
+                *atk.rect, atk.life, atk.damage))
+        for proj in self.projectiles:
+            parts.append(self._PROJECTILE.pack(
+                index[proj.owner], self.PROJECTILE_KINDS.index(proj.kind),
+                proj.facing, proj.angle, *proj.rect, proj.hitbox.x, proj.hitbox.y))
+        return b"".join(parts)
+
+    def load_state(self, data: bytes) -> None:
+        """save_state で作ったバイト列から試合状態を戻す"""
+        self.frame, n_attacks, n_projectiles = self._HEAD.unpack_from(data, 0)
+        offset = self._HEAD.size
+
+        for f in self.fighters:
+            (x, y, w, h, f.vx, f.vy, f.hp, f.energy, f.facing, pose, flags,
+             move, f.attack_timer, f.recover_timer, f.throw_cool,
+             hx, hy, ax, ay, aw, ah) = self._FIGHTER.unpack_from(data, offset)
+            offset += self._FIGHTER.size
+            f.rect = pg.Rect(x, y, w, h)
+            f.pose = self.POSES[pose]
+            f.move = None if move == self.NO_MOVE else move
+            f.on_ground = bool(flags & 1)
+            f.is_guarding = bool(flags & 2)
+            f.is_crouching = bool(flags & 4)
+            f.is_attacking = bool(flags & 8)
+            f.hurtbox.topleft = (hx, hy)
+            f.attack_hurtbox = pg.Rect(ax, ay, aw, ah) if flags & 16 else None
+
+        self.clear_objects()
+        for _ in range(n_attacks):
+            (owner, move, facing, ax, ay,
+             x, y, w, h, life, damage) = self._ATTACK.unpack_from(data, offset)
+            offset += self._ATTACK.size
+            owner = self.fighters[owner]
+            atk = self.attacks.spawn().start(owner, owner.moves.names[move])
+            atk.facing = facing
+            atk.anchor = (ax, ay)
+            atk.rect.update(x, y, w, h)
+            atk.life = life
+            atk.damage = damage
+
+        for _ in range(n_projectiles):
+            (owner, kind, facing, angle,
+             x, y, w, h, hx, hy) = self._PROJECTILE.unpack_from(data, offset)
+            offset += self._PROJECTILE.size
+            proj = self.projectiles.spawn().start(self.fighters[owner],
+                                                  self.PROJECTILE_KINDS[kind], facing)
+            proj.angle = angle
+            if proj.frames is not None:
+                proj.image = proj.frames[angle // proj.angle_step][0]
+            proj.rect.update(x, y, w, h)
+            proj.hitbox.topleft = (hx, hy)
+
+    def standing_teams(self) -> set[int]:
+        """体力の残っているファイターがいるチーム"""
+        return {f.team for f in self.fighters if f.hp > 0}
+
+    def is_ko(self) -> bool:
+        """体力の残っているチームが1つ以下になったか（2人ならどちらかの体力が0以下か）"""
+        return len(self.standing_teams()) <= 1
+
+    def is_time_up(self) -> bool:
+        """制限時間を使い切ったか"""
+        return self.frame >= self.match_frames
+
+    def is_over(self) -> bool:
+        """決着がついたか"""
+        return self.is_ko() or self.is_time_up()
+
+    def team_label(self, team: int) -> str:
+        """個人戦なら "P1" など、チーム戦なら "Team 1" など"""
+        if len(set(self.teams)) == len(self.teams):
+            return f"P{self.teams.index(team) + 1}"
+        return f"Team {sorted(set(self.teams)).index(team) + 1}"
+
+    def winner(self) -> str:
+        """
+        勝者（team_label() か "Draw"）。
+        K.O. なら残ったチーム、時間切れなら体力の合計が多いチームが勝ち。
+        """
+        standing = self.standing_teams()
+        if len(standing) == 1:
+            return self.team_label(standing.pop())
+        totals = {}
+        for f in self.fighters:
+            # 時間切れのときは倒れた味方の分を引かない
+            hp = f.hp if not standing else max(0, f.hp)
+            totals[f.team] = totals.get(f.team, 0) + hp
+        best = max(totals.values())
+        leaders = [team for team, hp in totals.items() if hp == best]
+        return self.team_label(leaders[0]) if len(leaders) == 1 else "Draw"
+
+# =====================
+# リプレイ
+# =====================
+REPLAY_DIR = os.path.join(BASE_DIR, "replays")
+REPLAY_MAGIC = b"KKRP"
+REPLAY_VERSION = 2
+
+# マジック, 版, キーフレーム間隔, ステージ, 制限時間(フレーム), P1キャラ, P2キャラ
+REPLAY_HEADER = struct.Struct("<4sBHBI8s8s")
+# キーフレーム: 開始フレーム, スナップショットの長さ（この後にスナップショットと入力が続く）
+REPLAY_BLOCK = struct.Struct("<IH")
+# 1フレーム分の入力（2人分の PlayerInput.pack() を 18 ビットずつ詰めて 5 バイト）
+REPLAY_INPUT_BITS = 2 * len(ACTIONS)
+REPLAY_INPUT_SIZE = 5
+
+
+class ReplayWriter:
+    """
+    対戦の入力をバイナリで記録する。
+
+    ファイルはヘッダの後にブロックが並ぶ。各ブロックは keyframe_interval フレームごとの
+    BattleSim.save_state() と、そこから次のブロックまでの入力（1フレーム 5 バイト）。
+    途中で終了しても、書き込めたところまでは再生できる。
+    """
+
+    def __init__(self, path: str, sim: BattleSim, stage: int = 0,
+                 keyframe_interval: int = 2 * FPS) -> None:
+        self.path = path
+        self.sim = sim
+        self.keyframe_interval = keyframe_interval
+        self.frames = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "wb")
+        p1, p2 = sim.fighters
+        self.file.write(REPLAY_HEADER.pack(
+            REPLAY_MAGIC, REPLAY_VERSION, keyframe_interval, stage, sim.match_frames,
+            p1.char_name.encode("ascii"), p2.char_name.encode("ascii")))
+
+    def record(self, inputs: tuple[PlayerInput, PlayerInput]) -> None:
+        """sim.step(inputs) の直前に呼ぶ"""
+        if self.frames % self.keyframe_interval == 0:
+            state = self.sim.save_state()
+            self.file.write(REPLAY_BLOCK.pack(self.sim.frame, len(state)))
+            self.file.write(state)
+        value = inputs[0].pack() | inputs[1].pack() << REPLAY_INPUT_BITS
+        self.file.write(value.to_bytes(REPLAY_INPUT_SIZE, "little"))
+        self.frames += 1
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+
+
+def open_replay_writer(sim: BattleSim, stage: int) -> ReplayWriter | None:
+    """replays/ に日時の名前でリプレイを作る（書けなければ記録しない。形式が2人分なので1対1のみ）"""
+    if len(sim.fighters) != 2:
+        return None
+    path = os.path.join(REPLAY_DIR, time.strftime("%Y%m%d-%H%M%S") + ".kkr")
+    try:
+        return ReplayWriter(path, sim, stage)
+    except OSError as e:
+        print(f"[Replay error] {path} : {e}")
+        return None
+
+
+class ReplayReader:
+    """
+    リプレイファイルをメモリマップして読む。
+
+    キーフレームの位置だけを最初に拾っておき、seek() では直前のキーフレームを
+    読み込んでから高々 keyframe_interval フレーム進める。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.keyframe_interval, self.stage, self.match_frames,
+         p1_name, p2_name) = REPLAY_HEADER.unpack_from(self.data, 0)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError(f"not a replay file: {path}")
+        self.char_names = (p1_name.rstrip(b"\0").decode("ascii"),
+                           p2_name.rstrip(b"\0").decode("ascii"))
+
+        # (開始フレーム, スナップショットの位置, 長さ, 入力の位置, 入力フレーム数)
+        self.blocks = []
+        offset = REPLAY_HEADER.size
+        size = len(self.data)
+        while offset + REPLAY_BLOCK.size <= size:
+            start, state_len = REPLAY_BLOCK.unpack_from(self.data, offset)
+            state_at = offset + REPLAY_BLOCK.size
+            inputs_at = state_at + state_len
+            if inputs_at > size:
+                break
+            count = min(self.keyframe_interval, (size - inputs_at) // REPLAY_INPUT_SIZE)
+            self.blocks.append((start, state_at, state_len, inputs_at, count))
+            offset = inputs_at + count * REPLAY_INPUT_SIZE
+        self.frames = sum(block[4] for block in self.blocks)
+
+    def inputs(self, frame: int) -> tuple[PlayerInput, PlayerInput]:
+        """frame 番目のフレームで使われた2人分の入力"""
+        _, _, _, inputs_at, _ = self.blocks[frame // self.keyframe_interval]
+        offset = inputs_at + (frame % self.keyframe_interval) * REPLAY_INPUT_SIZE
+        value = int.from_bytes(self.data[offset:offset + REPLAY_INPUT_SIZE], "little")
+        mask = (1 << REPLAY_INPUT_BITS) - 1
+        return PlayerInput.unpack(value & mask), PlayerInput.unpack(value >> REPLAY_INPUT_BITS)
+
+    def seek(self, sim: BattleSim, frame: int) -> None:
+        """sim を frame 番目のフレームの直前の状態にする"""
+        frame = max(0, min(frame, self.frames))
+        index = min(frame // self.keyframe_interval, len(self.blocks) - 1)
+        start, state_at, state_len, _, _ = self.blocks[index]
+        sim.load_state(self.data[state_at:state_at + state_len])
+        for f in range(start, frame):
+            sim.step(self.inputs(f))
+
+    def step(self, sim: BattleSim) -> bool:
+        """記録どおりに1フレーム進める。最後まで再生したら False"""
+        if sim.frame >= self.frames:
+            return False
+        sim.step(self.inputs(sim.frame))
+        return True
+
+    def close(self) -> None:
+        self.data.close()
+        self.file.close()
+
+
 # =====================
 # HPバー
 # =====================
-def draw_hp(screen, fighter, x):
-    pg.draw.rect(screen, (255, 0, 0), (x, 20, 300, 20))
-    pg.draw.rect(screen, (0, 255, 0), (x, 20, 3 * fighter.hp, 20))
+def draw_hp(screen, fighter, x, y=20, width=300):
+    pg.draw.rect(screen, (255, 0, 0), (x, y, width, 20))
+    pg.draw.rect(screen, (0, 255, 0), (x, y, width * fighter.hp // 100, 20))
 
             
 # =====================
@@ -552,60 +2711,162 @@ def draw_hp(screen, fighter, x):
 class HUD:
     """画面上部のタイマー・スコア・ポーズボタン・下部の操作説明を描画"""
 
-    def __init__(self):
+    def __init__(self, labels=("P1", "P2"), fighters: int = 2):
+        """
+        Args:
+            labels: 勝ち数を数える名前（BattleSim.team_label() の値）
+            fighters: ファイターの人数（バーの並べ方に合わせて勝ち数の位置を決める）
+        """
         self.match_time = MATCH_TIME
-        self.p1_wins = 0
-        self.p2_wins = 0
+        self.labels = tuple(labels)
+        self.fighters = fighters
+        self.wins = dict.fromkeys(self.labels, 0)
         self.pause_rect = pg.Rect(WIDTH - 110, 70, 100, 40)
         self.volume = 0.5
-        self.last_time_check = pg.time.get_ticks()
 
-    def update_time(self):
-        """秒単位の時間を減少させる"""
-        current_time = pg.time.get_ticks()
-        elapsed = (current_time - self.last_time_check) / 1000.0
-        if elapsed >= 1.0:
-            self.match_time = max(0, self.match_time - 1)
-            self.last_time_check = current_time
+    def update_time(self, frame):
+        """経過フレーム数から残り秒数を求める"""
+        self.match_time = max(0, MATCH_TIME - frame // FPS)
 
-    def draw_top(self, screen):
-        """上部中央に時間、左/右にスコア、右上にポーズボタンを描画"""
-        score_left = FONT_MED.render(f"P1 Wins: {self.p1_wins}", True, (255, 255, 255))
-        score_right = FONT_MED.render(f"P2 Wins: {self.p2_wins}", True, (255, 255, 255))
-        screen.blit(score_left, (10, 10))
-        screen.blit(score_right, (WIDTH - 10 - score_right.get_width(), 10))
+    def top_items(self):
+        """
+        上部の表示を (範囲, 内容のキー, 描画) のリストで返す。
+        描画は Surface（範囲の左上に貼る）か、screen を受け取る関数。
+        """
+        if len(self.labels) == 2:
+            left, right = self.labels
+            score_left = render_text(FONT_MED, f"{left} Wins: {self.wins[left]}", (255, 255, 255))
+            score_right = render_text(FONT_MED, f"{right} Wins: {self.wins[right]}", (255, 255, 255))
+            scores = [(score_left.get_rect(topleft=(10, 10)), score_left, score_left),
+                      (score_right.get_rect(topright=(WIDTH - 10, 10)), score_right, score_right)]
+        else:
+            # 3人以上はバーの下に1行にまとめる
+            text = "Wins  " + "  ".join(f"{label}: {self.wins[label]}" for label in self.labels)
+            score = render_text(FONT_SMALL, text, (255, 255, 255))
+            _, y, _ = status_bar_layout(self.fighters)[-1]
+            scores = [(score.get_rect(topleft=(10, y + 45)), score, score)]
 
         time_sec = int(self.match_time)
         if time_sec <= 30 and time_sec % 2 == 0:
             time_color = (255, 0, 0)
         else:
             time_color = (255, 255, 255)
+        time_text = render_text(FONT_MED, f"Time: {time_sec}", time_color)
 
-        time_text = FONT_MED.render(f"Time: {time_sec}", True, time_color)
-        screen.blit(time_text, (WIDTH // 2 - time_text.get_width() // 2, 10))
+        return scores + [
+            (time_text.get_rect(midtop=(WIDTH // 2, 10)), time_text, time_text),
+            (self.pause_rect, "pause", self.draw_pause_button),
+        ]
 
+    def add_win(self, label: str) -> None:
+        """勝者（"Draw" は数えない）の勝ち数を1つ増やす"""
+        if label in self.wins:
+            self.wins[label] += 1
+
+    def draw_pause_button(self, screen):
         pg.draw.rect(screen, (180, 180, 180), self.pause_rect)
-        p_label = FONT_SMALL.render("PAUSE", True, (0, 0, 0))
+        p_label = render_text(FONT_SMALL, "PAUSE", (0, 0, 0))
         screen.blit(p_label, (self.pause_rect.centerx - p_label.get_width() // 2,
                               self.pause_rect.centery - p_label.get_height() // 2))
 
-    def draw_bottom_controls(self, screen, p1_keys_text, p2_keys_text):
+    def draw_top(self, screen):
+        """上部中央に時間、左/右にスコア、右上にポーズボタンを描画"""
+        for rect, _, draw in self.top_items():
+            if isinstance(draw, pg.Surface):
+                screen.blit(draw, rect)
+            else:
+                draw(screen)
+
+    def draw_bottom_controls(self, screen):
         """画面下部に操作説明を表示"""
         rect = pg.Rect(0, HEIGHT - 60, WIDTH, 60)  # 高さを40→60に変更
         pg.draw.rect(screen, (40, 40, 40), rect)
         
         # P1の操作説明を2行に分割
-        p1_line1 = FONT_SMALL.render("P1: A/D=移動 W=ジャンプ S=しゃがみ", True, (220, 220, 220))
-        p1_line2 = FONT_SMALL.render("C=パンチ V=キック G=手裏剣 H=螺旋丸 T=投げ", True, (220, 220, 220))
+        p1_line1 = render_text(FONT_SMALL, "P1: A/D=移動 W=ジャンプ S=しゃがみ", (220, 220, 220))
+        p1_line2 = render_text(FONT_SMALL, "C=パンチ V=キック G=手裏剣 H=螺旋丸 T=投げ", (220, 220, 220))
         screen.blit(p1_line1, (10, HEIGHT - 55))
         screen.blit(p1_line2, (10, HEIGHT - 35))
         
         # P2の操作説明を2行に分割
-        p2_line1 = FONT_SMALL.render("P2: ←/→=移動 ↑=ジャンプ ↓=しゃがみ", True, (220, 220, 220))
-        p2_line2 = FONT_SMALL.render(".=パンチ /=キック :=手裏剣 ;=螺旋丸 ]=投げ", True, (220, 220, 220))
+        p2_line1 = render_text(FONT_SMALL, "P2: ←/→=移動 ↑=ジャンプ ↓=しゃがみ", (220, 220, 220))
+        p2_line2 = render_text(FONT_SMALL, ".=パンチ /=キック :=手裏剣 ;=螺旋丸 ]=投げ", (220, 220, 220))
         screen.blit(p2_line1, (WIDTH - 10 - p2_line1.get_width(), HEIGHT - 55))
         screen.blit(p2_line2, (WIDTH - 10 - p2_line2.get_width(), HEIGHT - 35))
 
+# =====================
+# メニュー画面の下地
+# =====================
+DIM_OVERLAYS = {}
+
+
+def dim_overlay(alpha, per_pixel=False):
+    """画面を暗くする半透明の黒（アルファごとに1枚作って使い回す）"""
+    key = (alpha, per_pixel)
+    overlay = DIM_OVERLAYS.get(key)
+    if overlay is None:
+        if per_pixel:
+            overlay = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
+            overlay.fill((0, 0, 0, alpha))
+        else:
+            overlay = pg.Surface((WIDTH, HEIGHT))
+            overlay.set_alpha(alpha)
+            overlay.fill((0, 0, 0))
+        DIM_OVERLAYS[key] = overlay
+    return overlay
+
+
+def menu_base(background):
+    """下地を描き込む画面と同じ形式の Surface（背景の透明度は持ち込まない）"""
+    base = pg.Surface((WIDTH, HEIGHT))
+    base.blit(background, (0, 0))
+    return base
+
+
+class MenuLayer:
+    """
+    メニュー画面の描画を使い回す。
+
+    背景・暗幕・動かない文字は下地として1枚に合成しておき、
+    選択肢や音量バーなど変わる部分は、その内容が変わったときだけ area の中を描き直す。
+    draw() は更新が必要な範囲を返す（何も変わっていなければ空）。
+    """
+
+    def __init__(self, area=None):
+        self.area = area
+        self.base = None
+        self.base_key = None
+        self.shown_key = None
+
+    def invalidate(self):
+        """次の draw() で画面全体を描き直す（画面を切り替えたときなど）"""
+        self.shown_key = None
+
+    def draw(self, screen, base_key, build_base, parts_key=None, draw_parts=None):
+        """
+        Args:
+            base_key: 下地の内容を表すキー（変わったら build_base() で作り直す）
+            build_base: 下地の Surface を作る関数
+            parts_key: 変わる部分の内容を表すキー
+            draw_parts: 変わる部分を screen に描く関数
+        """
+        if self.base is None or base_key != self.base_key:
+            self.base = build_base()
+            self.base_key = base_key
+            self.shown_key = None
+
+        full = self.shown_key is None
+        if not full and parts_key == self.shown_key[1]:
+            return []
+
+        area = screen.get_rect() if full or self.area is None else self.area
+        screen.blit(self.base, area, area)
+        if draw_parts:
+            draw_parts(screen)
+        self.shown_key = (base_key, parts_key)
+        return [area]
+
+
 # =====================
 # ポーズメニュー
 # =====================
@@ -616,23 +2877,28 @@ class PauseMenu:
         self.options = ["Continue", "Settings", "Quit"]
         self.selected = 0
         self.hud = hud
+        # 選択肢の範囲だけ描き直す
+        self.layer = MenuLayer(pg.Rect(0, 180, WIDTH, 230))
+
+    def draw(self, screen, background):
+        """background（ポーズ直前のバトル画面）の上にメニューを描き、更新範囲を返す"""
+        def build_base():
+            base = menu_base(background)
+            base.blit(dim_overlay(160, per_pixel=True), (0, 0))
+            title = render_text(FONT_BIG, "Paused", (255, 255, 255))
+            base.blit(title, (WIDTH // 2 - title.get_width() // 2, 100))
+            guide = render_text(FONT_SMALL, "↑↓ Select  ENTER Confirm  SPACE Continue", (200, 200, 200))
+            base.blit(guide, (WIDTH // 2 - guide.get_width() // 2, 500))
+            return base
+
+        def draw_options(screen):
+            for i, opt in enumerate(self.options):
+                color = (255, 255, 0) if i == self.selected else (220, 220, 220)
+                label = render_text(FONT_MED, opt, color)
+                rect = label.get_rect(center=(WIDTH // 2, 220 + i * 70))
+                screen.blit(label, rect)
 
-    def draw(self, screen):
-        overlay = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
-        overlay.fill((0, 0, 0, 160))
-        screen.blit(overlay, (0, 0))
-
-        title = FONT_BIG.render("Paused", True, (255, 255, 255))
-        screen.blit(title, (WIDTH // 2 - title.get_width() // 2, 100))
-
-        for i, opt in enumerate(self.options):
-            color = (255, 255, 0) if i == self.selected else (220, 220, 220)
-            label = FONT_MED.render(opt, True, color)
-            rect = label.get_rect(center=(WIDTH // 2, 220 + i * 70))
-            screen.blit(label, rect)
-
-        guide = FONT_SMALL.render("↑↓ Select  ENTER Confirm  SPACE Continue", True, (200, 200, 200))
-        screen.blit(guide, (WIDTH // 2 - guide.get_width() // 2, 500))
+        return self.layer.draw(screen, background, build_base, self.selected, draw_options)
 
     def handle_event(self, event):
         if event.type == pg.KEYDOWN:
@@ -647,7 +2913,7 @@ class PauseMenu:
         elif event.type == pg.MOUSEBUTTONDOWN and event.button == 1:
             mx, my = event.pos
             for i, opt in enumerate(self.options):
-                label = FONT_MED.render(opt, True, (0, 0, 0))
+                label = render_text(FONT_MED, opt, (220, 220, 220))
                 rect = label.get_rect(center=(WIDTH // 2, 220 + i * 70))
                 if rect.collidepoint(mx, my):
                     return opt
@@ -662,45 +2928,51 @@ class SettingsMenu:
 
     def __init__(self, hud):
         self.hud = hud
-
-    def draw(self, screen):
-        overlay = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
-        overlay.fill((0, 0, 0, 180))
-        screen.blit(overlay, (0, 0))
-
-        title = FONT_BIG.render("Settings", True, (255, 255, 255))
-        screen.blit(title, (WIDTH // 2 - title.get_width() // 2, 100))
-
-        vol_text = FONT_MED.render(f"Music Volume: {int(self.hud.volume * 100)}%", True, (255, 255, 255))
-        screen.blit(vol_text, (WIDTH // 2 - vol_text.get_width() // 2, 250))
-
-        bar_back = pg.Rect(WIDTH // 2 - 150, 320, 300, 20)
-        pg.draw.rect(screen, (80, 80, 80), bar_back)
-        fill = pg.Rect(bar_back.x, bar_back.y, int(300 * self.hud.volume), 20)
-        pg.draw.rect(screen, (0, 200, 100), fill)
-
-        guide1 = FONT_SMALL.render("←/→ to change volume", True, (200, 200, 200))
-        guide2 = FONT_SMALL.render("ESC or ENTER to return to pause menu", True, (200, 200, 200))
-        screen.blit(guide1, (WIDTH // 2 - guide1.get_width() // 2, 400))
-        screen.blit(guide2, (WIDTH // 2 - guide2.get_width() // 2, 430))
-
-        back_rect = pg.Rect(WIDTH // 2 - 75, 480, 150, 50)
-        pg.draw.rect(screen, (100, 100, 100), back_rect)
-        pg.draw.rect(screen, (200, 200, 200), back_rect, 2)
-        back_label = FONT_MED.render("Back", True, (255, 255, 255))
-        screen.blit(back_label, (back_rect.centerx - back_label.get_width() // 2,
-                                 back_rect.centery - back_label.get_height() // 2))
-
-        self.back_rect = back_rect
+        self.back_rect = pg.Rect(WIDTH // 2 - 75, 480, 150, 50)
+        # 音量の表示とバーの範囲だけ描き直す
+        self.layer = MenuLayer(pg.Rect(0, 240, WIDTH, 110))
+
+    def draw(self, screen, background):
+        """background（ポーズ直前のバトル画面）の上に設定画面を描き、更新範囲を返す"""
+        def build_base():
+            base = menu_base(background)
+            base.blit(dim_overlay(180, per_pixel=True), (0, 0))
+
+            title = render_text(FONT_BIG, "Settings", (255, 255, 255))
+            base.blit(title, (WIDTH // 2 - title.get_width() // 2, 100))
+
+            guide1 = render_text(FONT_SMALL, "←/→ to change volume", (200, 200, 200))
+            guide2 = render_text(FONT_SMALL, "ESC or ENTER to return to pause menu", (200, 200, 200))
+            base.blit(guide1, (WIDTH // 2 - guide1.get_width() // 2, 400))
+            base.blit(guide2, (WIDTH // 2 - guide2.get_width() // 2, 430))
+
+            back_rect = self.back_rect
+            pg.draw.rect(base, (100, 100, 100), back_rect)
+            pg.draw.rect(base, (200, 200, 200), back_rect, 2)
+            back_label = render_text(FONT_MED, "Back", (255, 255, 255))
+            base.blit(back_label, (back_rect.centerx - back_label.get_width() // 2,
+                                   back_rect.centery - back_label.get_height() // 2))
+            return base
+
+        def draw_volume(screen):
+            vol_text = render_text(FONT_MED, f"Music Volume: {int(self.hud.volume * 100)}%", (255, 255, 255))
+            screen.blit(vol_text, (WIDTH // 2 - vol_text.get_width() // 2, 250))
+
+            bar_back = pg.Rect(WIDTH // 2 - 150, 320, 300, 20)
+            pg.draw.rect(screen, (80, 80, 80), bar_back)
+            fill = pg.Rect(bar_back.x, bar_back.y, int(300 * self.hud.volume), 20)
+            pg.draw.rect(screen, (0, 200, 100), fill)
+
+        return self.layer.draw(screen, background, build_base, self.hud.volume, draw_volume)
 
     def handle_event(self, event):
         if event.type == pg.KEYDOWN:
             if event.key == pg.K_LEFT:
                 self.hud.volume = max(0.0, self.hud.volume - 0.05)
-                pg.mixer.music.set_volume(self.hud.volume)
+                AUDIO.set_volume(self.hud.volume)
             if event.key == pg.K_RIGHT:
                 self.hud.volume = min(1.0, self.hud.volume + 0.05)
-                pg.mixer.music.set_volume(self.hud.volume)
+                AUDIO.set_volume(self.hud.volume)
             if event.key == pg.K_ESCAPE or event.key == pg.K_RETURN:
                 return "Back"
         elif event.type == pg.MOUSEBUTTONDOWN and event.button == 1:
@@ -709,7 +2981,7 @@ class SettingsMenu:
             if bar.collidepoint(mx, my):
                 rel = (mx - bar.x) / bar.width
                 self.hud.volume = min(1.0, max(0.0, rel))
-                pg.mixer.music.set_volume(self.hud.volume)
+                AUDIO.set_volume(self.hud.volume)
             if self.back_rect.collidepoint(mx, my):
                 return "Back"
         return None
@@ -718,152 +2990,637 @@ class SettingsMenu:
 # =====================
 # タイトル画面
 # =====================
-def draw_title():
-    screen.blit(TITLE_BG, (0, 0))
+TITLE_LAYER = MenuLayer()
+
 
-    overlay = pg.Surface((WIDTH, HEIGHT))
-    overlay.set_alpha(120)
-    overlay.fill((0, 0, 0))
-    screen.blit(overlay, (0, 0))
+def draw_title():
+    """タイトル画面を描き、更新範囲を返す（一度描いたら変わらない）"""
+    def build_base():
+        base = menu_base(title_background())
+        base.blit(dim_overlay(120), (0, 0))
 
-    title = FONT_BIG.render("コウカファイター", True, (255, 255, 255))
-    guide = FONT_MED.render("ENTERキーでスタート", True, (230, 230, 230))
+        title = render_text(FONT_BIG, "コウカファイター", (255, 255, 255))
+        guide = render_text(FONT_MED, "ENTERキーでスタート", (230, 230, 230))
+        base.blit(title, (WIDTH // 2 - title.get_width() // 2, 220))
+        base.blit(guide, (WIDTH // 2 - guide.get_width() // 2, 330))
+        return base
 
-    screen.blit(title, (WIDTH // 2 - title.get_width() // 2, 220))
-    screen.blit(guide, (WIDTH // 2 - guide.get_width() // 2, 330))
+    return TITLE_LAYER.draw(screen, TITLE_BG_FILE, build_base)
 
 
 # =====================
 # バトル選択画面
 # =====================
+# 選択肢の枠の範囲だけ描き直す
+SELECT_LAYER = MenuLayer(pg.Rect(340, 170, 320, 80 * (len(STAGES) + 1)))
+
+
 def draw_select(selected):
-    if selected < len(STAGES):
-        screen.blit(STAGES[selected]["bg"], (0, 0))
-    else:
-        screen.blit(STAGES[0]["bg"], (0, 0))
+    """
+    ステージ選択画面を描き、更新範囲を返す。
+    背景がまだ読み込み中なら単色で出しておき、届いたら描き直す。
+    """
+    LOADER.poll()
+    index = selected if selected < len(STAGES) else 0
+    bg = ASSETS.peek(STAGES[index]["file"], (WIDTH, HEIGHT), alpha=False)
+    if bg is None:
+        preload_stage(index)
+        bg = STAGE_PLACEHOLDER_COLOR
+
+    def build_base():
+        if isinstance(bg, pg.Surface):
+            base = menu_base(bg)
+        else:
+            base = pg.Surface((WIDTH, HEIGHT))
+            base.fill(bg)
+        base.blit(dim_overlay(150), (0, 0))
+
+        title = render_text(FONT_BIG, "バトルステージ選択", (255, 255, 255))
+        base.blit(title, (WIDTH // 2 - title.get_width() // 2, 60))
+
+        guide = render_text(FONT_MED, "↑↓で選択  ENTERで決定", (220, 220, 220))
+        base.blit(guide, (WIDTH // 2 - guide.get_width() // 2, 500))
+        return base
+
+    def draw_options(screen):
+        names = [stage["name"] for stage in STAGES] + ["ゲーム終了"]
+        for i, name in enumerate(names):
+            color = (255, 255, 0) if i == selected else (200, 200, 200)
+            label = render_text(FONT_MED, name, color)
+            rect = pg.Rect(350, 180 + i * 80, 300, 50)
+            pg.draw.rect(screen, color, rect, 2)
+            screen.blit(label, (rect.centerx - label.get_width() // 2,
+                                rect.centery - label.get_height() // 2))
+
+    return SELECT_LAYER.draw(screen, bg, build_base, selected, draw_options)
+
+
+# =====================
+# 火花（パーティクル）
+# =====================
+# 当たりの種類ごとの火花 (数, 速さ, 寿命フレーム, 色)
+SPARK_STYLES = {
+    "punch": (10, 4.0, 14, ((255, 240, 160), (255, 200, 60))),
+    "kick": (16, 5.0, 18, ((255, 220, 120), (255, 140, 40))),
+    "projectile": (24, 6.0, 22, ((160, 220, 255), (80, 160, 255), (255, 255, 255))),
+    "guard": (8, 3.0, 10, ((200, 230, 255), (140, 180, 255))),
+    "throw": (20, 3.5, 26, ((255, 255, 255), (200, 200, 200))),
+}
+PARTICLE_GRAVITY = 0.35
+PARTICLE_SIZE = 3
+# 飛ぶ向き（cos, sin）の表。乱数の代わりに順番に使う
+SPARK_DIRECTIONS = 64
+
+
+class ParticleSystem:
+    """
+    当たったときの火花。
+
+    粒ごとに Sprite を作らず、位置・速度・残り寿命・色を最大数ぶんの array に持つ。
+    生きている粒は先頭の count 個に詰めてあり、消えた粒は末尾の粒と入れ替える。
+    配列は最初に全部作るので、出したり消したりしても新しいオブジェクトは作らない
+    （最大数を超えた分は出さずに dropped に数える）。
+    見た目だけのもので、BattleSim の状態（save_state）には含めない。
+    """
+
+    def __init__(self, capacity: int = 512, seed: int = 0) -> None:
+        self.capacity = capacity
+        self.x = array("f", bytes(4 * capacity))
+        self.y = array("f", bytes(4 * capacity))
+        self.vx = array("f", bytes(4 * capacity))
+        self.vy = array("f", bytes(4 * capacity))
+        self.life = array("H", bytes(2 * capacity))
+        self.color = array("B", bytes(capacity))  # palette の添字
+        self.count = 0
+        self.dropped = 0
+        self.version = 0  # 絵が変わるたびに増える（BattleRenderer のキー）
+
+        self.palette = []
+        self.styles = {}
+        for name, (n, speed, life, colors) in SPARK_STYLES.items():
+            self.styles[name] = (n, speed, life, len(self.palette), len(colors))
+            self.palette.extend(colors)
+        rng = random.Random(seed)
+        angles = [2 * math.pi * (i + rng.random()) / SPARK_DIRECTIONS for i in range(SPARK_DIRECTIONS)]
+        rng.shuffle(angles)
+        self.cos = array("f", [math.cos(a) for a in angles])
+        self.sin = array("f", [math.sin(a) for a in angles])
+        self.spread = array("f", [0.4 + 0.6 * rng.random() for _ in range(SPARK_DIRECTIONS)])
+        self.cursor = 0
+        self.rect = pg.Rect(0, 0, PARTICLE_SIZE, PARTICLE_SIZE)
+        self.bounds = pg.Rect(0, 0, 0, 0)
+
+    def clear(self) -> None:
+        if self.count:
+            self.version += 1
+        self.count = 0
+
+    def emit(self, style: str, x: float, y: float) -> None:
+        """(x, y) から style の火花を飛ばす"""
+        n, speed, life, color0, colors = self.styles[style]
+        free = self.capacity - self.count
+        if n > free:
+            self.dropped += n - free
+            n = free
+        i = self.count
+        cursor = self.cursor
+        for k in range(n):
+            d = (cursor + k) % SPARK_DIRECTIONS
+            s = speed * self.spread[d]
+            self.x[i] = x
+            self.y[i] = y
+            self.vx[i] = self.cos[d] * s
+            self.vy[i] = self.sin[d] * s - speed * 0.5
+            self.life[i] = life - (k & 3)
+            self.color[i] = color0 + k % colors
+            i += 1
+        self.cursor = (cursor + n) % SPARK_DIRECTIONS
+        if n:
+            # update() の前に描いても収まるように、出した場所を囲む矩形に入れる
+            b = self.bounds
+            px, py = int(x), int(y)
+            if not self.count:
+                b.x, b.y = px, py
+                b.width = b.height = PARTICLE_SIZE
+            else:
+                left, top = min(b.x, px), min(b.y, py)
+                b.width = max(b.right, px + PARTICLE_SIZE) - left
+                b.height = max(b.bottom, py + PARTICLE_SIZE) - top
+                b.x, b.y = left, top
+            self.version += 1
+        self.count = i
+
+    def emit_battle_events(self, sim: "BattleSim") -> None:
+        """BattleSim.step の直後に呼んで、このフレームの当たりの場所から火花を出す"""
+        for _, defender, source, _, (x, y) in sim.collisions.hits:
+            if source == "throw":
+                self.emit("throw", x, y)
+            elif defender.is_guarding:
+                self.emit("guard", x, y)
+            elif source in SPARK_STYLES:
+                self.emit(source, x, y)
+            else:
+                self.emit("projectile", x, y)
+
+    def update(self) -> None:
+        """全部の粒を1フレーム進め、寿命が尽きた粒を消す（生きている粒を囲む矩形も求める）"""
+        if not self.count:
+            return
+        x, y, vx, vy, life, color = self.x, self.y, self.vx, self.vy, self.life, self.color
+        floor = FLOOR
+        left = top = float("inf")
+        right = bottom = float("-inf")
+        i = 0
+        n = self.count
+        while i < n:
+            if life[i] <= 1:
+                # 末尾の粒をここに移す
+                n -= 1
+                x[i] = x[n]
+                y[i] = y[n]
+                vx[i] = vx[n]
+                vy[i] = vy[n]
+                life[i] = life[n]
+                color[i] = color[n]
+                continue
+            life[i] -= 1
+            px = x[i] + vx[i]
+            py = y[i] + vy[i]
+            vy[i] += PARTICLE_GRAVITY
+            if py > floor:
+                py = floor
+                vy[i] *= -0.4
+            x[i] = px
+            y[i] = py
+            if px < left:
+                left = px
+            if px > right:
+                right = px
+            if py < top:
+                top = py
+            if py > bottom:
+                bottom = py
+            i += 1
+        self.count = n
+        self.version += 1
+        if n:
+            b = self.bounds
+            b.x = int(left)
+            b.y = int(top)
+            b.width = int(right) - b.x + PARTICLE_SIZE
+            b.height = int(bottom) - b.y + PARTICLE_SIZE
+
+    def bounding_rect(self) -> pg.Rect | None:
+        """生きている粒を囲む矩形（粒がなければ None、update() のときの位置）"""
+        return self.bounds if self.count else None
+
+    def draw(self, screen: pg.Surface, scale: float = 1.0) -> None:
+        """粒を screen に描く（scale は内部解像度の倍率）"""
+        r = self.rect
+        r.width = r.height = max(1, round(PARTICLE_SIZE * scale))
+        x, y, color, palette = self.x, self.y, self.color, self.palette
+        for i in range(self.count):
+            r.x = int(x[i] * scale)
+            r.y = int(y[i] * scale)
+            screen.fill(palette[color[i]], r)
+
+
+# =====================
+# バトル画面
+# =====================
+def draw_energy(screen, fighter, x, y=45, width=300):
+    pg.draw.rect(screen, (100, 100, 100), (x, y, width, 12))
+    pg.draw.rect(screen, (0, 150, 255), (x, y, width / 100 * max(0, fighter.energy), 12))
+    pg.draw.rect(screen, (255, 255, 255), (x, y, width, 12), 1)
+
+
+# チームの色（3人以上のときの名前の表示）
+TEAM_COLORS = ((255, 90, 90), (90, 160, 255), (255, 220, 60), (120, 230, 120),
+               (230, 120, 255), (255, 160, 60), (80, 230, 230), (230, 230, 230))
+
+
+def status_bar_layout(n: int) -> list[tuple[int, int, int]]:
+    """
+    ファイターごとの HP・エネルギーバーの (x, y, 幅)。
+    2人なら左右の端に 300 ずつ。3人以上はタイマーの下に 1段4人までを等分して並べ、
+    5人以上は2段にする（右のポーズボタンにかからないように右端を空ける）。
+    """
+    if n == 2:
+        return [(50, 20, 300), (WIDTH - 350, 20, 300)]
+    cols = min(n, 4)
+    left, right, gap = 50, WIDTH - 130, 40
+    width = (right - left - gap * (cols - 1)) // cols
+    return [(left + (i % cols) * (width + gap), 60 + (i // cols) * 50, width) for i in range(n)]
+
+
+def battle_items(sim, hud, extra=()):
+    """
+    背景より手前に描くものを描画順に (範囲, 内容のキー, 描画) のリストで返す。
+    キーが同じで範囲も同じなら、前のフレームと同じ絵になる。
+
+    Args:
+        extra: 最後に重ねる (Surface, 左上座標) の並び（決着の表示など）
+    """
+    items = []
+    # HPバー・エネルギーバー（並べ方は人数で変わる）
+    layout = status_bar_layout(len(sim.fighters))
+    for f, (x, y, w) in zip(sim.fighters, layout):
+        items.append((pg.Rect(x, y, w, 20), ("hp", w, f.hp),
+                      lambda screen, f=f, x=x, y=y, w=w: draw_hp(screen, f, x, y, w)))
+    for f, (x, y, w) in zip(sim.fighters, layout):
+        items.append((pg.Rect(x, y + 25, w, 12), ("energy", w, int(w / 100 * max(0, f.energy))),
+                      lambda screen, f=f, x=x, y=y, w=w: draw_energy(screen, f, x, y + 25, w)))
+
+    # ファイター・飛び道具（攻撃判定は見えないので描かない）
+    for f in sim.fighters:
+        image = f.image
+        items.append((image.get_rect(topleft=f.rect.topleft), image, image))
+    if len(sim.fighters) > 2:
+        # 3人以上は、バーと頭の上に誰なのかを出す
+        for i, (f, (x, y, w)) in enumerate(zip(sim.fighters, layout)):
+            label = render_text(FONT_SMALL, f"P{i + 1}", TEAM_COLORS[f.team % len(TEAM_COLORS)])
+            items.append((label.get_rect(topright=(x - 4, y)), label, label))
+            items.append((label.get_rect(midbottom=f.rect.midtop), label, label))
+    for proj in sim.projectiles:
+        items.append((proj.image.get_rect(topleft=proj.rect.topleft), proj.image, proj.image))
+
+    # HUD
+    items.extend(hud.top_items())
+    items.append((pg.Rect(0, HEIGHT - 60, WIDTH, 60), "controls", hud.draw_bottom_controls))
+
+    for surface, pos in extra:
+        items.append((surface.get_rect(topleft=pos), surface, surface))
+    return items
+
+
+def draw_items(screen, items):
+    for rect, _, draw in items:
+        if isinstance(draw, pg.Surface):
+            screen.blit(draw, rect)
+        else:
+            draw(screen)
 
-    overlay = pg.Surface((WIDTH, HEIGHT))
-    overlay.set_alpha(150)
-    overlay.fill((0, 0, 0))
-    screen.blit(overlay, (0, 0))
 
-    title = FONT_BIG.render("バトルステージ選択", True, (255, 255, 255))
-    screen.blit(title, (WIDTH // 2 - title.get_width() // 2, 60))
+BATTLE_BACKGROUNDS = {}
 
-    for i, stage in enumerate(STAGES):
-        color = (255, 255, 0) if i == selected else (200, 200, 200)
-        label = FONT_MED.render(stage["name"], True, color)
-        rect = pg.Rect(350, 180 + i * 80, 300, 50)
-        pg.draw.rect(screen, color, rect, 2)
-        screen.blit(label, (rect.centerx - label.get_width() // 2,
-                            rect.centery - label.get_height() // 2))
 
-    quit_index = len(STAGES)
-    color = (255, 255, 0) if quit_index == selected else (200, 200, 200)
-    label = FONT_MED.render("ゲーム終了", True, color)
-    rect = pg.Rect(350, 180 + quit_index * 80, 300, 50)
-    pg.draw.rect(screen, color, rect, 2)
-    screen.blit(label, (rect.centerx - label.get_width() // 2,
-                        rect.centery - label.get_height() // 2))
+def battle_background(stage_bg):
+    """ステージ背景に床を描き込んだ背景（ステージごとに1枚作って使い回す）"""
+    background = BATTLE_BACKGROUNDS.get(stage_bg)
+    if background is None:
+        background = stage_bg.copy()
+        pg.draw.rect(background, (80, 160, 80), (0, FLOOR, WIDTH, HEIGHT))
+        BATTLE_BACKGROUNDS[stage_bg] = background
+    return background
 
-    guide = FONT_MED.render("↑↓で選択  ENTERで決定", True, (220, 220, 220))
-    screen.blit(guide, (WIDTH // 2 - guide.get_width() // 2, 500))
+
+def draw_battle(screen, sim, hud, stage_bg, extra=()):
+    """ステージ・ファイター・飛び道具・HUDを描画"""
+    screen.blit(battle_background(stage_bg), (0, 0))
+    draw_items(screen, battle_items(sim, hud, extra))
+
+
+class BattleRenderer:
+    """
+    バトル画面を差分だけ描き直す。
+
+    前のフレームから絵が変わったもの（キーか範囲が違うもの）と、それに重なるものだけ
+    背景を戻して描き直し、描き直した範囲を返す。pg.display.update() にその範囲を渡せば、
+    ソフトウェア描画でも画面全体を毎フレーム送らずにすむ。
+    dirty=False なら毎フレーム全体を描き直す。
+    view を渡すと、その内部解像度で描く（screen には view.battle_target を渡す）。
+    particles（ParticleSystem）を渡すと、火花をまとめて1つの範囲として一番手前に描く。
+    """
+
+    def __init__(self, dirty: bool = True, view: RenderView | None = None) -> None:
+        self.dirty = dirty
+        self.view = view if view is not None and view.scaled else None
+        self.prev = None  # 前のフレームの {(キー, 範囲): 範囲}
+        self.background = None
+        self.profiler = None  # FrameProfiler を入れると段階ごとに計測する
+
+    def invalidate(self) -> None:
+        """次のフレームは全体を描き直す（メニューから戻ったときなど）"""
+        self.prev = None
+
+    def particle_item(self, particles: ParticleSystem) -> tuple:
+        """火花全体を (範囲, キー, 描画) にする（粒が動くたびにキーが変わる）"""
+        bounds = particles.bounding_rect()
+        if self.view is None:
+            rect, scale = pg.Rect(bounds), 1.0
+        else:
+            rect, scale = self.view.rect(bounds), self.view.scale
+        return rect, ("particles", particles.version), lambda screen: particles.draw(screen, scale)
+
+    def draw(self, screen, sim, hud, stage_bg, extra=(), particles=None) -> list[pg.Rect]:
+        """描画して、更新が必要な範囲を返す"""
+        prof = self.profiler
+        background = battle_background(stage_bg)
+        items = battle_items(sim, hud, extra)
+        if self.view is not None:
+            background = self.view.image(background)
+            items = self.view.items(items)
+        if particles is not None and particles.count:
+            items.append(self.particle_item(particles))
+        screen_rect = screen.get_rect()
+        if prof is not None:
+            prof.lap("hud_text")
+
+        if not self.dirty or self.prev is None or background is not self.background:
+            self.background = background
+            return self.redraw_all(screen, background, items)
+
+        current = {(key, tuple(rect)) for rect, key, _ in items}
+        dirty = [pg.Rect(r) for key, r in self.prev - current]
+        redraw = [False] * len(items)
+        for i, (rect, key, _) in enumerate(items):
+            if (key, tuple(rect)) not in self.prev:
+                dirty.append(rect)
+                redraw[i] = True
+        if not dirty:
+            self.prev = current
+            return []
+
+        # 描き直す範囲に重なるものも描き直す（新しく加えた範囲に重なるものを、なくなるまで探す）
+        limit_area = screen_rect.width * screen_rect.height * DIRTY_MAX_AREA
+        area = sum(rect.width * rect.height for rect in dirty)
+        added = list(dirty)
+        while added:
+            if len(dirty) > DIRTY_MAX_RECTS or area > limit_area:
+                return self.redraw_all(screen, background, items)
+            # まだ描き直さないものは、前に加えた範囲とは重ならないと分かっている
+            found = []
+            for i, (rect, _, _) in enumerate(items):
+                if not redraw[i] and rect.collidelist(added) != -1:
+                    redraw[i] = True
+                    found.append(rect)
+                    area += rect.width * rect.height
+            dirty += found
+            added = found
+        self.prev = current
+
+        for rect in dirty:
+            screen.blit(background, rect, rect)
+        if prof is not None:
+            prof.lap("background")
+        draw_items(screen, [item for item, flag in zip(items, redraw) if flag])
+        if prof is not None:
+            prof.lap("blit")
+        return [rect.clip(screen_rect) for rect in dirty]
+
+    def redraw_all(self, screen, background, items) -> list[pg.Rect]:
+        """全体を描き直す"""
+        prof = self.profiler
+        screen.blit(background, (0, 0))
+        if prof is not None:
+            prof.lap("background")
+        draw_items(screen, items)
+        self.prev = {(key, tuple(rect)) for rect, key, _ in items}
+        if prof is not None:
+            prof.lap("blit")
+        return [screen.get_rect()]
+
+
+# =====================
+# 操作キー設定
+# =====================
+P1_KEYS = {
+    "left": pg.K_a,
+    "right": pg.K_d,
+    "jump": pg.K_w,
+    "down": pg.K_s,
+    "punch": pg.K_c,
+    "kick": pg.K_v,
+    "beam": pg.K_g,
+    "bomb": pg.K_h,
+    "throw": pg.K_t,
+}
+
+P2_KEYS = {
+    "left": pg.K_LEFT,
+    "right": pg.K_RIGHT,
+    "jump": pg.K_UP,
+    "down": pg.K_DOWN,
+    "punch": pg.K_PERIOD,
+    "kick": pg.K_SLASH,
+    "beam": pg.K_COLON,
+    "bomb": pg.K_SEMICOLON,
+    "throw": pg.K_RIGHTBRACKET,
+}
 
 
 # =====================
 # メイン処理
 # =====================
+def fighters_from_env() -> tuple[list[Fighter], tuple[int, ...] | None]:
+    """
+    環境変数から対戦するファイターを作る。
+        KOUKATON_FIGHTERS=3〜8: 人数（P3 以降は CPU が操作する）
+        KOUKATON_TEAMS=0,0,1,1: ファイターごとのチーム番号（省略時は個人戦）
+
+    Returns:
+        (Fighter のリスト, チーム番号（個人戦なら None）)
+    """
+    try:
+        n = int(os.environ.get("KOUKATON_FIGHTERS", "2"))
+    except ValueError:
+        n = 2
+    if not 2 <= n <= MAX_FIGHTERS:
+        print(f"[battle] KOUKATON_FIGHTERS must be 2 to {MAX_FIGHTERS}, using 2")
+        n = 2
+    teams = None
+    spec = os.environ.get("KOUKATON_TEAMS")
+    if spec:
+        try:
+            teams = tuple(int(t) for t in spec.split(","))
+        except ValueError:
+            teams = ()
+        if len(teams) != n or len(set(teams)) < 2:
+            print(f"[battle] KOUKATON_TEAMS needs {n} team numbers with at least 2 teams, ignored")
+            teams = None
+    keys = (P1_KEYS, P2_KEYS)
+    names = ("man", "woman")
+    return [Fighter(0, keys[i] if i < 2 else {}, names[i % 2]) for i in range(n)], teams
+
+
 def main() -> None:
     """ゲームのメインループ"""
+    # cpu.py はこのモジュールを import するので、使うときに読む
+    import cpu
+    STARTUP.mark("import")
+    # KOUKATON_RENDER_SCALE=0.5 / 0.75 で内部の描画解像度を下げる
+    init_app(render_view_from_env())
     game_state = TITLE
     selected_stage = 0
     current_stage = 0
 
-    # スプライトグループ
-    attacks = pg.sprite.Group()
-    projectiles = pg.sprite.Group()
-
-    # プレイヤー作成
-    p1 = Fighter(200, {
-        "left": pg.K_a,
-        "right": pg.K_d,
-        "jump": pg.K_w,
-        "down": pg.K_s,
-        "punch": pg.K_c,
-        "kick": pg.K_v,
-        "beam": pg.K_g,
-        "bomb": pg.K_h,
-        "throw": pg.K_t,
-    }, "man")
-
-    p2 = Fighter(700, {
-        "left": pg.K_LEFT,
-        "right": pg.K_RIGHT,
-        "jump": pg.K_UP,
-        "down": pg.K_DOWN,
-        "punch": pg.K_PERIOD,
-        "kick": pg.K_SLASH,
-        "beam": pg.K_COLON,
-        "bomb": pg.K_SEMICOLON,
-        "throw": pg.K_RIGHTBRACKET,
-    }, "woman")
-
-    fighters = [p1, p2]
+    # まずタイトル画面を出してから、残りの準備をする
+    pg.display.update(draw_title())
+    STARTUP.mark("title screen")
+
+    # プレイヤー作成（KOUKATON_FIGHTERS / KOUKATON_TEAMS で3人以上・チーム戦）
+    fighters, teams = fighters_from_env()
+    sim = BattleSim(*fighters, teams=teams)
+    sim.reset()
+    char_names = [f.char_name for f in fighters]
+
+    # KOUKATON_CPU=1 / 2 でそのプレイヤーを CPU にする。P3 以降はいつも CPU
+    # （KOUKATON_CPU_PROCESS=1 なら P3 以降も別プロセスで探索する）
+    cpus = [cpu.cpu_class_from_env()(i, char_names, cpu.cpu_level_from_env(), teams=sim.teams)
+            for i in range(2, len(fighters))]
+    env_cpu = cpu.cpu_from_env(char_names, sim.teams)
+    if env_cpu:
+        cpus.insert(0, env_cpu)
+    # 同じプロセスの CPU は1ステップあたりの探索時間を分け合う
+    cpus = cpu.CpuGroup(cpus)
 
     # HUD とメニュー
-    hud = HUD()
+    hud = HUD([sim.team_label(t) for t in dict.fromkeys(sim.teams)], len(fighters))
     pause_menu = PauseMenu(hud)
     settings_menu = SettingsMenu(hud)
 
+    # 対戦で使う画像を先に読み込んでおく
+    preload_assets()
+    STARTUP.mark("preload assets")
+
     # 初期BGM
     safe_load_and_play_bgm(MENU_BGM, hud.volume)
+    STARTUP.mark("menu bgm")
+    if os.environ.get("KOUKATON_STARTUP_TIMING") == "1":
+        print(STARTUP.report())
+        print(ASSETS.report())
 
     running = True
 
-    # 操作説明
-    p1_keys_text = "P1: A/D=移動 W=ジャンプ S=しゃがみ C=パンチ V=キック G=手裏剣 H=螺旋丸 T=投げ"
-    p2_keys_text = "P2: ←/→=移動 ↑=ジャンプ ↓=しゃがみ .=パンチ /=キック :=手裏剣 ;=螺旋丸 ]=投げ"
-
     battle_surface = None
 
-    while running:
-        dt_ms = clock.tick(60)
-        dt = dt_ms / 1000.0
+    # バトル画面は変わったところだけ描き直す
+    battle_renderer = BattleRenderer(DIRTY_RECTS, VIEW)
+    particles = ParticleSystem()
+    prev_state = game_state
+
+    # 固定ステップ用の蓄積時間と、キー入力（逆引き表とプレイヤーごとの入力バッファ）
+    accumulator = 0.0
+    keymap = KeyMap([f.keys for f in sim.fighters])
+    input_buffers = [InputBuffer() for _ in sim.fighters]
+    result_timer = 0
+    result_label = winner = ""
+
+    # 対戦ごとの入力を replays/ に記録する
+    replay = None
+
+    # 段階ごとの処理時間（KOUKATON_PROFILE=1 か F3 で計測開始、F3 で表示切り替え）
+    profiler = None
 
-        key_lst = pg.key.get_pressed()
+    def start_profiler():
+        prof = FrameProfiler()
+        sim.profiler = battle_renderer.profiler = prof
+        return prof
+
+    if os.environ.get("KOUKATON_PROFILE") == "1":
+        profiler = start_profiler()
+
+    # 表示した画面を captures/ に録画する（KOUKATON_CAPTURE=raw / png / video か F9 で開始、F9 で終了）
+    capture = capture_from_env(pg.display.get_surface())
+    # F9 で止めた録画も含めて、終了前に書き出しが終わるのを待つ
+    captures = [capture] if capture else []
+
+    while running:
+        frame_ms = clock.tick(FPS)
+        if profiler is not None:
+            profiler.begin_frame()
 
         for event in pg.event.get():
+            event = VIEW.map_event(event)
             if event.type == pg.QUIT:
                 running = False
 
+            # 押しっぱなしの状態はどの画面でも追いかけておく
+            keymap.handle_event(event)
+
+            if event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                if profiler is None:
+                    profiler = start_profiler()
+                profiler.overlay = not profiler.overlay
+            if event.type == pg.KEYDOWN and event.key == pg.K_F9:
+                if capture is None:
+                    capture = capture_from_env(pg.display.get_surface(), "raw")
+                    if capture:
+                        captures.append(capture)
+                else:
+                    capture.close()
+                    capture = None
+
             # ===== タイトル =====
             if game_state == TITLE:
                 if event.type == pg.KEYDOWN and event.key == pg.K_RETURN:
                     game_state = SELECT
+                    preload_stage(selected_stage)
 
             # ===== バトル選択 =====
             elif game_state == SELECT:
                 if event.type == pg.KEYDOWN:
                     if event.key == pg.K_UP:
                         selected_stage = (selected_stage - 1) % (len(STAGES) + 1)
+                        preload_stage(selected_stage)
                     elif event.key == pg.K_DOWN:
                         selected_stage = (selected_stage + 1) % (len(STAGES) + 1)
+                        preload_stage(selected_stage)
                     elif event.key == pg.K_RETURN:
                         if selected_stage < len(STAGES):
                             game_state = BATTLE
                             current_stage = selected_stage
-                            hud.match_time = MATCH_TIME
-                            hud.last_time_check = pg.time.get_ticks()
-                            p1.hp = 100
-                            p2.hp = 100
-                            p1.energy = 100
-                            p2.energy = 100
-                            p1.rect.bottomleft = (200, FLOOR)
-                            p2.rect.bottomleft = (700, FLOOR)
-                            p1.facing = 1
-                            p2.facing = -1
-                            attacks.empty()
-                            projectiles.empty()
+                            # 縮小した背景を対戦前に作っておく
+                            VIEW.image(battle_background(stage_background(current_stage)))
+                            sim.reset()
+                            particles.clear()
+                            hud.update_time(sim.frame)
+                            accumulator = 0.0
+                            keymap.clear_pressed()
+                            for buf in input_buffers:
+                                buf.reset()
+                            cpus.reset()
+                            replay = open_replay_writer(sim, current_stage)
                             safe_load_and_play_bgm(BATTLE_BGM, hud.volume)
                         else:
                             running = False
@@ -871,45 +3628,18 @@ def main() -> None:
             # ===== バトル中の入力 =====
             elif game_state == BATTLE:
                 if event.type == pg.KEYDOWN:
-                    # パンチ・キック
-                    for f in fighters:
-                        if event.key == f.keys["punch"]:
-                            f.do_attack("punch", attacks)
-                        if event.key == f.keys["kick"]:
-                            f.do_attack("kick", attacks)
-
-                    # 飛び道具
-                    if event.key == p1.keys["beam"] and p1.energy >= 20:
-                        projectiles.add(Projectile(p1, "beam"))
-                        p1.energy -= 20
-                    if event.key == p1.keys["bomb"] and p1.energy >= 30:
-                        projectiles.add(Projectile(p1, "bomb"))
-                        p1.energy -= 30
-
-                    if event.key == p2.keys["beam"] and p2.energy >= 20:
-                        projectiles.add(Projectile(p2, "beam"))
-                        p2.energy -= 20
-                    if event.key == p2.keys["bomb"] and p2.energy >= 30:
-                        projectiles.add(Projectile(p2, "bomb"))
-                        p2.energy -= 30
-
-                    # 投げ技
-                    if event.key == p1.keys["throw"]:
-                        try_throw(p1, p2)
-                    if event.key == p2.keys["throw"]:
-                        try_throw(p2, p1)
-
+                    # 攻撃・飛び道具・投げは keymap から入力バッファを通してシミュレーションへ
                     # ESCキーでポーズ
                     if event.key == pg.K_ESCAPE:
                         game_state = PAUSED
-                        battle_surface = screen.copy()
+                        battle_surface = VIEW.snapshot()
 
                 # ポーズボタンクリック
                 elif event.type == pg.MOUSEBUTTONDOWN and event.button == 1:
                     mx, my = event.pos
                     if hud.pause_rect.collidepoint(mx, my):
                         game_state = PAUSED
-                        battle_surface = screen.copy()
+                        battle_surface = VIEW.snapshot()
 
             # ===== ポーズ中の入力 =====
             elif game_state == PAUSED:
@@ -920,6 +3650,9 @@ def main() -> None:
                     game_state = SETTINGS
                 elif result == "Quit":
                     game_state = SELECT
+                    if replay:
+                        replay.close()
+                        replay = None
                     safe_load_and_play_bgm(MENU_BGM, hud.volume)
 
             # ===== 設定画面の入力 =====
@@ -928,172 +3661,140 @@ def main() -> None:
                 if result == "Back":
                     game_state = PAUSED
 
-        # ===== 描画・更新 =====
+        if game_state != BATTLE:
+            # メニューでの操作を対戦の入力にしない
+            keymap.clear_pressed()
+        if profiler is not None:
+            profiler.lap("events")
+
+        # ===== 固定ステップ更新 =====
+        # 描画の速さに関係なく、シミュレーションは 1/60 秒単位で進める
+        if game_state in (BATTLE, RESULT):
+            accumulator += frame_ms
+
+        steps = 0
+        while game_state in (BATTLE, RESULT) and accumulator >= STEP_MS:
+            if steps == MAX_STEPS_PER_FRAME:
+                # 追いつけない分は捨てる（処理落ち時は描画を間引く）
+                accumulator = 0.0
+                break
+            accumulator -= STEP_MS
+            steps += 1
+
+            if game_state == BATTLE:
+                inputs = tuple(
+                    buf.feed(*keymap.state(i), f)
+                    for i, (buf, f) in enumerate(zip(input_buffers, sim.fighters))
+                )
+                if cpus:
+                    inputs = cpus.act(sim, inputs)
+                if replay:
+                    replay.record(inputs)
+                sim.step(inputs)
+                AUDIO.play_battle_events(sim)
+                particles.emit_battle_events(sim)
+                keymap.clear_pressed()
+                hud.update_time(sim.frame)
+
+                # 勝利判定
+                if sim.is_over():
+                    winner = sim.winner()
+                    hud.add_win(winner)
+                    result_label = "K.O." if sim.is_ko() else "Time Up"
+                    result_timer = RESULT_FRAMES
+                    game_state = RESULT
+                    if replay:
+                        replay.close()
+                        replay = None
+            else:
+                result_timer -= 1
+                if result_timer <= 0:
+                    sim.clear_objects()
+                    particles.clear()
+                    game_state = SELECT
+                    safe_load_and_play_bgm(MENU_BGM, hud.volume)
+            # 決着のあとも火花は消えるまで動かす
+            particles.update()
+
+        # ===== 描画 =====
+        # None のときは画面全体を更新する
+        dirty_rects = None
+        if game_state in (BATTLE, RESULT) and prev_state not in (BATTLE, RESULT):
+            battle_renderer.invalidate()
+        show_profile = profiler is not None and profiler.overlay
+        if game_state != prev_state or show_profile:
+            # メニューの上に計測値を重ねている間は毎フレーム描き直す
+            for layer in (TITLE_LAYER, SELECT_LAYER, pause_menu.layer, settings_menu.layer):
+                layer.invalidate()
+        prev_state = game_state
+        profile_item = (profiler.overlay_item(),) if show_profile else ()
+
         if game_state == TITLE:
-            draw_title()
+            dirty_rects = draw_title()
 
         elif game_state == SELECT:
-            draw_select(selected_stage)
+            dirty_rects = draw_select(selected_stage)
 
         elif game_state == BATTLE:
-            # ステージ背景描画
-            screen.blit(STAGES[current_stage]["bg"], (0, 0))
-
-            # 床描画
-            pg.draw.rect(screen, (80, 160, 80), (0, FLOOR, WIDTH, HEIGHT))
-
-            # 時間更新
-            hud.update_time()
-
-            # ファイター更新
-            p1.update(key_lst, p2)
-            p2.update(key_lst, p1)
-
-            attacks.update()
-            projectiles.update()
-
-            # 飛び道具融合判定
-            proj_list = list(projectiles)
-            for i in range(len(proj_list)):
-                for j in range(i + 1, len(proj_list)):
-                    p1_proj = proj_list[i]
-                    p2_proj = proj_list[j]
-
-                    if (p1_proj.owner == p2_proj.owner and
-                        {p1_proj.kind, p2_proj.kind} == {"beam", "bomb"} and
-                        pg.sprite.collide_rect(p1_proj, p2_proj)):
-
-                        x = (p1_proj.rect.centerx + p2_proj.rect.centerx) // 2
-                        y = (p1_proj.rect.centery + p2_proj.rect.centery) // 2
-
-                        p1_proj.kill()
-                        p2_proj.kill()
-
-                        new_proj = Projectile(p1_proj.owner, "rasensyuriken")
-                        new_proj.rect.center = (x, y)
-                        new_proj.hitbox.center = (x, y)
-                        projectiles.add(new_proj)
-                        break
-
-            # 攻撃判定
-            for atk in attacks:
-                for f in fighters:
-                    if f == atk.owner:
-                        continue
-
-                    hit = False
-                    damage = atk.damage
-
-                    # 防御中は軽減
-                    if f.is_guarding:
-                        damage = damage // 3
-
-                    if atk.rect.colliderect(f.hurtbox):
-                        hit = True
-                    elif f.attack_hurtbox and atk.rect.colliderect(f.attack_hurtbox):
-                        hit = True
-
-                    if hit:
-                        f.hp -= damage
-                        apply_knockback(f, atk.owner, damage)
-                        atk.kill()
-                        break
-
-            # 飛び道具とファイターの衝突判定
-            for proj in projectiles:
-                for f in fighters:
-                    if f != proj.owner and proj.hitbox.colliderect(f.hurtbox):
-                        damage = proj.damage
-                        if f.is_guarding:
-                            damage = damage // 3
-                        f.hp -= damage
-                        apply_knockback(f, proj.owner, damage)
-                        proj.kill()
-                        break
-
-            # HPバーの描画
-            draw_hp(screen, p1, 50)
-            draw_hp(screen, p2, WIDTH - 350)
-            
-            # エネルギーバーの描画
-            pg.draw.rect(screen, (100, 100, 100), (50, 45, 300, 12))
-            energy_width1 = 3 * max(0, p1.energy)
-            pg.draw.rect(screen, (0, 150, 255), (50, 45, energy_width1, 12))
-            pg.draw.rect(screen, (255, 255, 255), (50, 45, 300, 12), 1)
-            
-            pg.draw.rect(screen, (100, 100, 100), (WIDTH - 350, 45, 300, 12))
-            energy_width2 = 3 * max(0, p2.energy)
-            pg.draw.rect(screen, (0, 150, 255), (WIDTH - 350, 45, energy_width2, 12))
-            pg.draw.rect(screen, (255, 255, 255), (WIDTH - 350, 45, 300, 12), 1)
-
-            # エネルギーバーの描画
-            pg.draw.rect(screen, (100, 100, 100), (50, 45, 300, 12))
-            energy_width1 = 3 * max(0, p1.energy)
-            pg.draw.rect(screen, (0, 150, 255), (50, 45, energy_width1, 12))
-            pg.draw.rect(screen, (255, 255, 255), (50, 45, 300, 12), 1)
-
-            pg.draw.rect(screen, (100, 100, 100), (WIDTH - 350, 45, 300, 12))
-            energy_width2 = 3 * max(0, p2.energy)
-            pg.draw.rect(screen, (0, 150, 255), (WIDTH - 350, 45, energy_width2, 12))
-            pg.draw.rect(screen, (255, 255, 255), (WIDTH - 350, 45, 300, 12), 1)
-
-            # ファイター描画
-            for f in fighters:
-                screen.blit(f.image, f.rect)
-
-            # 攻撃描画
-            attacks.draw(screen)
-
-            # 飛び道具描画
-            for proj in projectiles:
-                screen.blit(proj.image, proj.rect)
-
-            # HUD描画
-            hud.draw_top(screen)
-            hud.draw_bottom_controls(screen, p1_keys_text, p2_keys_text)
-
-            # 勝利判定
-            if hud.match_time <= 0 or p1.hp <= 0 or p2.hp <= 0:
-                # 勝者判定
-                if p1.hp > p2.hp:
-                    winner = "P1"
-                    hud.p1_wins += 1
-                elif p2.hp > p1.hp:
-                    winner = "P2"
-                    hud.p2_wins += 1
-                else:
-                    winner = "Draw"
-
-                # 表示
-                result_text = FONT_BIG.render("K.O." if (p1.hp <= 0 or p2.hp <= 0) else "Time Up", True, (255, 255, 0))
-                screen.blit(result_text, (WIDTH // 2 - result_text.get_width() // 2, HEIGHT // 2 - 40))
-                winner_text = FONT_MED.render(f"Winner: {winner}", True, (255, 255, 255))
-                screen.blit(winner_text, (WIDTH // 2 - winner_text.get_width() // 2, HEIGHT // 2 + 30))
-                pg.display.update()
-                pg.time.delay(2000)
+            dirty_rects = battle_renderer.draw(VIEW.battle_target, sim, hud,
+                                               stage_background(current_stage), profile_item, particles)
 
-                attacks.empty()
-                projectiles.empty()
-
-                game_state = SELECT
-                safe_load_and_play_bgm(MENU_BGM, hud.volume)
+        elif game_state == RESULT:
+            result_text = render_text(FONT_BIG, result_label, (255, 255, 0))
+            winner_text = render_text(FONT_MED, f"Winner: {winner}", (255, 255, 255))
+            dirty_rects = battle_renderer.draw(VIEW.battle_target, sim, hud, stage_background(current_stage), (
+                (result_text, (WIDTH // 2 - result_text.get_width() // 2, HEIGHT // 2 - 40)),
+                (winner_text, (WIDTH // 2 - winner_text.get_width() // 2, HEIGHT // 2 + 30)),
+            ) + profile_item, particles)
 
         elif game_state == PAUSED:
-            if battle_surface:
-                screen.blit(battle_surface, (0, 0))
-            pause_menu.draw(screen)
+            dirty_rects = pause_menu.draw(screen, battle_surface)
 
         elif game_state == SETTINGS:
-            if battle_surface:
-                screen.blit(battle_surface, (0, 0))
-            settings_menu.draw(screen)
+            dirty_rects = settings_menu.draw(screen, battle_surface)
 
-        pg.display.update()
+        if profiler is not None:
+            if game_state not in (BATTLE, RESULT):
+                for surface, pos in profile_item:
+                    screen.blit(surface, pos)
+                profiler.lap("menu")
 
+        if game_state in (BATTLE, RESULT):
+            dirty_rects = VIEW.present_battle(dirty_rects)
+        else:
+            dirty_rects = VIEW.present_menu(dirty_rects)
+        if dirty_rects is None:
+            pg.display.update()
+        else:
+            pg.display.update(dirty_rects)
+        if capture is not None:
+            capture.capture(pg.display.get_surface())
+
+        if profiler is not None:
+            profiler.lap("display")
+            profiler.end_frame()
+
+    if replay:
+        replay.close()
+    for c in captures:
+        c.join()
+    cpus.close()
+    if profiler is not None and profiler.count:
+        path = os.path.join(PROFILE_DIR, time.strftime("frames-%Y%m%d-%H%M%S.csv"))
+        try:
+            rows = profiler.write_csv(path)
+            print(f"[profile] {rows} frames -> {path}")
+        except OSError as e:
+            print(f"[profile error] {path} : {e}")
+    if os.environ.get("KOUKATON_STARTUP_TIMING") == "1":
+        print(LOADER.report())
+        print(AUDIO.report())
     pg.quit()
     sys.exit()
 
 if __name__ == "__main__":
+    # cpu.py などが import kakutou_koukaton したとき、もう一度読み込まずにこのモジュールを使わせる
+    sys.modules.setdefault("kakutou_koukaton", sys.modules[__name__])
     main()
     pg.quit()
     sys.exit()
\ No newline at end of file
@@ -0,0 +1,471 @@
+"""
+ロールバック方式のネット対戦（UDP）。
+
+各フレームの入力だけを送り合い、相手の入力が届いていないフレームは予測で進める。
+予測が外れていたら、そのフレームのスナップショットに戻して現在まで再計算する。
+
+    # 1台で2つ起動して試す
+    python netcode.py --player 1 --port 7001 --peer 127.0.0.1:7002
+    python netcode.py --player 2 --port 7002 --peer 127.0.0.1:7001
+
+    # 画面なしで2セッションを localhost で動かし、結果が一致するか確かめる
+    python netcode.py --selftest --latency 6 --loss 0.1
+"""
+import argparse
+import collections
+import random
+import socket
+import struct
+import sys
+import time
+import zlib
+
+import pygame as pg
+
+import kakutou_koukaton as game
+
+
+# =====================
+# 通信
+# =====================
+PACKET_HELLO = 0
+PACKET_INPUT = 1
+
+# 種類, 受信済みの相手フレーム, チェックサムのフレーム, チェックサム, 先頭フレーム, 入力数
+INPUT_HEADER = struct.Struct("!BiiIiB")
+INPUT_VALUE = struct.Struct("!I")
+MAX_INPUTS_PER_PACKET = 32
+
+
+class UdpTransport:
+    """
+    ノンブロッキングの UDP 送受信。
+    テスト用に遅延（フレーム数）とパケットロスを擬似的に入れられる。
+    """
+
+    def __init__(self, port: int, peer: tuple[str, int], latency_frames: int = 0,
+                 loss: float = 0.0, seed: int | None = None) -> None:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1" if peer[0] in ("127.0.0.1", "localhost") else "", port))
+        self.sock.setblocking(False)
+        self.peer = peer
+        self.latency_frames = latency_frames
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.outbox = collections.deque()  # (送信するティック, データ)
+        self.ticks = 0
+
+    def send(self, data: bytes) -> None:
+        if self.rng.random() < self.loss:
+            return
+        self.outbox.append((self.ticks + self.latency_frames, data))
+        self.flush()
+
+    def flush(self) -> None:
+        """遅延時間が過ぎたパケットを実際に送る"""
+        while self.outbox and self.outbox[0][0] <= self.ticks:
+            _, data = self.outbox.popleft()
+            try:
+                self.sock.sendto(data, self.peer)
+            except OSError:
+                pass
+
+    def tick(self) -> None:
+        self.ticks += 1
+        self.flush()
+
+    def receive(self) -> list[bytes]:
+        packets = []
+        while True:
+            try:
+                data, _ = self.sock.recvfrom(2048)
+            except (BlockingIOError, ConnectionResetError):
+                return packets
+            packets.append(data)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+# =====================
+# 統計
+# =====================
+class NetStats:
+    """ロールバックの深さと再計算時間の記録"""
+
+    def __init__(self, history: int = 600) -> None:
+        self.frames = 0  # 進めたフレーム数
+        self.rollbacks = 0
+        self.max_depth = 0
+        self.stalls = 0
+        self.desyncs = 0
+        self.last_depth = 0
+        self.last_resim_ms = 0.0
+        self.max_resim_ms = 0.0
+        # tick ごとの (ロールバックの深さ, 再計算時間 ms)（相手を待った tick も含む）
+        self.history = collections.deque(maxlen=history)
+
+    def record(self, depth: int, resim_ms: float) -> None:
+        self.last_depth = depth
+        self.last_resim_ms = resim_ms
+        if depth:
+            self.rollbacks += 1
+            self.max_depth = max(self.max_depth, depth)
+            self.max_resim_ms = max(self.max_resim_ms, resim_ms)
+        self.history.append((depth, resim_ms))
+
+    def summary(self) -> str:
+        avg = (sum(d for d, _ in self.history) / len(self.history)) if self.history else 0.0
+        return (f"frames {self.frames}  rollbacks {self.rollbacks}  "
+                f"depth last {self.last_depth} avg {avg:.2f} max {self.max_depth}  "
+                f"resim last {self.last_resim_ms:.2f} ms max {self.max_resim_ms:.2f} ms  "
+                f"stalls {self.stalls}  desyncs {self.desyncs}")
+
+
+# =====================
+# ロールバック
+# =====================
+class RollbackSession:
+    """
+    BattleSim をロールバック方式で進める。
+
+    自分の入力は input_delay フレーム後のフレームに割り当てて送信し、
+    相手の入力が未着のフレームは最後に届いた入力（押しっぱなしのみ）で予測する。
+    """
+
+    def __init__(self, sim: "game.BattleSim", local_index: int, transport: UdpTransport,
+                 input_delay: int = 2, max_rollback: int = 8) -> None:
+        """
+        Args:
+            sim: 進める対戦シミュレーション
+            local_index: 自分が操作するファイターの番号 (0 または 1)
+            transport: 通信
+            input_delay: 自分の入力を遅らせるフレーム数
+            max_rollback: 予測で先行してよい最大フレーム数
+        """
+        self.sim = sim
+        self.local = local_index
+        self.remote = 1 - local_index
+        self.transport = transport
+        self.input_delay = input_delay
+        self.max_rollback = max_rollback
+
+        self.frame = sim.frame
+        self.local_inputs: dict[int, int] = {f: 0 for f in range(self.frame, self.frame + input_delay)}
+        self.remote_inputs: dict[int, int] = {}
+        self.predicted: dict[int, int] = {}
+        self.snapshots: dict[int, bytes] = {}
+        self.remote_confirmed = self.frame - 1  # ここまでの相手入力は全部届いている
+        self.remote_ack = self.frame - 1        # 相手がここまでの自分の入力を受け取った
+        self.checksums: dict[int, int] = {}     # 確定したフレームのチェックサム
+        self.checked_frame = self.frame - 1
+        self.stats = NetStats()
+
+    # ---------------------
+    # 受信
+    # ---------------------
+    def poll(self) -> int | None:
+        """
+        受信したパケットを処理する。
+
+        Returns:
+            予測が外れていた最も古いフレーム（なければ None）
+        """
+        rollback_to = None
+        for data in self.transport.receive():
+            if not data or data[0] != PACKET_INPUT or len(data) < INPUT_HEADER.size:
+                continue
+            _, ack, sum_frame, checksum, start, count = INPUT_HEADER.unpack_from(data, 0)
+            self.remote_ack = max(self.remote_ack, ack)
+            if sum_frame in self.checksums and self.checksums[sum_frame] != checksum:
+                self.stats.desyncs += 1
+
+            for i in range(count):
+                frame = start + i
+                if frame <= self.remote_confirmed or frame in self.remote_inputs:
+                    continue
+                (value,) = INPUT_VALUE.unpack_from(data, INPUT_HEADER.size + i * INPUT_VALUE.size)
+                self.remote_inputs[frame] = value
+                if frame in self.predicted and self.predicted[frame] != value:
+                    rollback_to = frame if rollback_to is None else min(rollback_to, frame)
+
+            while self.remote_confirmed + 1 in self.remote_inputs:
+                self.remote_confirmed += 1
+        return rollback_to
+
+    # ---------------------
+    # 進行
+    # ---------------------
+    def predict(self, frame: int) -> int:
+        """相手の入力を予測する（直前の押しっぱなしが続き、新しい押下はないとみなす）"""
+        last = self.remote_inputs.get(min(frame - 1, self.remote_confirmed))
+        if last is None:
+            return 0
+        return game.PlayerInput.unpack(last).held
+
+    def inputs_for(self, frame: int) -> tuple:
+        """このフレームの2人分の入力（相手は届いていなければ予測）"""
+        remote = self.remote_inputs.get(frame)
+        if remote is None:
+            remote = self.predict(frame)
+            self.predicted[frame] = remote
+        else:
+            self.predicted.pop(frame, None)
+        inputs = [None, None]
+        inputs[self.local] = game.PlayerInput.unpack(self.local_inputs[frame])
+        inputs[self.remote] = game.PlayerInput.unpack(remote)
+        return tuple(inputs)
+
+    def simulate(self, frame: int) -> None:
+        """スナップショットを取ってから1フレーム進める"""
+        self.snapshots[frame] = self.sim.save_state()
+        self.sim.step(self.inputs_for(frame))
+
+    def tick(self, local_input: "game.PlayerInput") -> bool:
+        """
+        1フレーム分の処理（受信・ロールバック・自分の入力の登録・1フレーム進行・送信）。
+
+        Returns:
+            進めたら True、相手を待っている（先行しすぎ）なら False
+        """
+        self.transport.tick()
+
+        # 予測が外れていたら戻って再計算する
+        depth = 0
+        resim_ms = 0.0
+        rollback_to = self.poll()
+        if rollback_to is not None and rollback_to < self.frame:
+            start = time.perf_counter()
+            depth = self.frame - rollback_to
+            self.sim.load_state(self.snapshots[rollback_to])
+            for frame in range(rollback_to, self.frame):
+                self.simulate(frame)
+            resim_ms = (time.perf_counter() - start) * 1000
+
+        self.record_checksums()
+        # 待つことになった tick のロールバックも数える
+        self.stats.record(depth, resim_ms)
+
+        # 相手より先行しすぎたら待つ
+        if self.frame - self.remote_confirmed > self.max_rollback:
+            self.stats.stalls += 1
+            self.send()
+            return False
+
+        self.local_inputs[self.frame + self.input_delay] = local_input.pack()
+        self.simulate(self.frame)
+        self.frame += 1
+        self.stats.frames += 1
+        self.send()
+        self.prune()
+        return True
+
+    def send(self) -> None:
+        """まだ相手に届いていない自分の入力をまとめて送る"""
+        start = max(self.remote_ack + 1, min(self.local_inputs))
+        end = min(max(self.local_inputs) + 1, start + MAX_INPUTS_PER_PACKET)
+        values = [self.local_inputs[f] for f in range(start, end)]
+        sum_frame = self.checked_frame
+        checksum = self.checksums.get(sum_frame, 0)
+        header = INPUT_HEADER.pack(PACKET_INPUT, self.remote_confirmed, sum_frame, checksum,
+                                   start, len(values))
+        self.transport.send(header + b"".join(INPUT_VALUE.pack(v) for v in values))
+
+    def record_checksums(self) -> None:
+        """両者の入力がそろって確定したフレームのチェックサムを記録する"""
+        last = min(self.remote_confirmed + 1, self.frame)
+        for frame in range(self.checked_frame + 1, last + 1):
+            state = self.snapshots.get(frame) if frame < self.frame else self.sim.save_state()
+            if state is not None:
+                self.checksums[frame] = zlib.crc32(state)
+        self.checked_frame = max(self.checked_frame, last)
+
+    def prune(self) -> None:
+        """確定して不要になった古いデータを捨てる"""
+        keep = min(self.remote_confirmed, self.remote_ack) - 1
+        for table in (self.snapshots, self.predicted, self.remote_inputs):
+            for frame in [f for f in table if f < keep]:
+                del table[frame]
+        for frame in [f for f in self.local_inputs if f < keep]:
+            del self.local_inputs[frame]
+        for frame in [f for f in self.checksums if f < self.checked_frame - 600]:
+            del self.checksums[frame]
+
+
+def wait_for_peer(transport: UdpTransport, timeout: float = 30.0) -> bool:
+    """相手から HELLO が届くまで HELLO を送り続ける"""
+    deadline = time.perf_counter() + timeout
+    got = False
+    while time.perf_counter() < deadline:
+        transport.send(bytes([PACKET_HELLO, 1 if got else 0]))
+        for data in transport.receive():
+            if data[:1] == bytes([PACKET_HELLO]):
+                got = True
+                if data[1:2] == b"\x01":
+                    # 相手もこちらを受信済み。念のため数回送ってから始める
+                    for _ in range(3):
+                        transport.send(bytes([PACKET_HELLO, 1]))
+                    return True
+            elif data[:1] == bytes([PACKET_INPUT]):
+                return True
+        transport.tick()
+        time.sleep(0.05)
+    return False
+
+
+def new_sim(headless: bool = False) -> "game.BattleSim":
+    sim = game.BattleSim(game.Fighter(200, game.P1_KEYS, "man", headless=headless),
+                         game.Fighter(700, game.P2_KEYS, "woman", headless=headless))
+    sim.reset()
+    return sim
+
+
+# =====================
+# 動作確認
+# =====================
+def selftest(frames: int, latency: int, loss: float, delay: int, seed: int) -> bool:
+    """
+    localhost の UDP で2つのセッションを交互に進め、確定フレームの状態が一致するか確かめる。
+    """
+    base = 47000 + random.Random(seed).randrange(1000)
+    transports = [
+        UdpTransport(base, ("127.0.0.1", base + 1), latency, loss, seed),
+        UdpTransport(base + 1, ("127.0.0.1", base), latency, loss, seed + 1),
+    ]
+    sessions = [RollbackSession(new_sim(headless=True), i, t, input_delay=delay)
+                for i, t in enumerate(transports)]
+    rngs = [random.Random(seed * 10 + i) for i in range(2)]
+    held = [0, 0]
+
+    while min(s.frame for s in sessions) < frames:
+        for i, session in enumerate(sessions):
+            rng = rngs[i]
+            if rng.random() < 0.1:
+                held[i] = rng.getrandbits(4)
+            pressed = rng.getrandbits(9) if rng.random() < 0.08 else 0
+            session.tick(game.PlayerInput(held[i], pressed))
+        time.sleep(0.0005)
+
+    # 最後の入力が届くまで少し回す
+    for _ in range(200):
+        for session in sessions:
+            session.transport.tick()
+            rollback_to = session.poll()
+            if rollback_to is not None and rollback_to < session.frame:
+                session.sim.load_state(session.snapshots[rollback_to])
+                for frame in range(rollback_to, session.frame):
+                    session.simulate(frame)
+            session.record_checksums()
+            session.send()
+        time.sleep(0.001)
+
+    a, b = (s.checksums for s in sessions)
+    common = sorted(set(a) & set(b))
+    mismatch = [f for f in common if a[f] != b[f]]
+    for i, s in enumerate(sessions):
+        print(f"P{i + 1}: {s.stats.summary()}")
+    print(f"compared {len(common)} confirmed frames, mismatches {len(mismatch)}")
+    for t in transports:
+        t.close()
+    return bool(common) and not mismatch
+
+
+# =====================
+# ネット対戦
+# =====================
+def play(player: int, port: int, peer: tuple[str, int], delay: int, max_rollback: int,
+         stage: int) -> None:
+    """ウィンドウを開いてネット対戦を行う。自分の操作は P1 のキー配置を使う"""
+    local = player - 1
+    transport = UdpTransport(port, peer)
+    game.init_app()
+    pg.display.set_caption(f"こうかとん ファイター (online P{player})")
+    game.preload_assets()
+    print(f"waiting for peer {peer[0]}:{peer[1]} ...")
+    if not wait_for_peer(transport):
+        print("peer did not answer")
+        return
+
+    sim = new_sim()
+    session = RollbackSession(sim, local, transport, delay, max_rollback)
+    hud = game.HUD()
+    stage_bg = game.stage_background(stage)
+    accumulator = 0.0
+    keymap = game.KeyMap([game.P1_KEYS])
+    input_buffer = game.InputBuffer()
+    pending = None  # 待たされて、まだ受け付けられていない入力
+    result_timer = None
+
+    running = True
+    while running:
+        frame_ms = game.clock.tick(game.FPS)
+        accumulator += frame_ms
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+                running = False
+            keymap.handle_event(event)
+
+        steps = 0
+        while accumulator >= game.STEP_MS and steps < game.MAX_STEPS_PER_FRAME:
+            accumulator -= game.STEP_MS
+            steps += 1
+            if result_timer is not None:
+                result_timer -= 1
+                continue
+            if pending is None:
+                pending = input_buffer.feed(*keymap.state(0), sim.fighters[local])
+                keymap.clear_pressed()
+            if session.tick(pending):
+                pending = None
+            if sim.is_over() and sim.frame <= session.remote_confirmed + 1:
+                result_timer = game.RESULT_FRAMES
+        if steps == game.MAX_STEPS_PER_FRAME:
+            accumulator = 0.0
+        if result_timer is not None and result_timer <= 0:
+            running = False
+
+        hud.update_time(sim.frame)
+        game.draw_battle(game.screen, sim, hud, stage_bg)
+        stats = session.stats
+        line = (f"rollback {stats.last_depth} (max {stats.max_depth})  "
+                f"resim {stats.last_resim_ms:.2f} ms  delay {delay}  stalls {stats.stalls}")
+        game.screen.blit(game.render_text(game.FONT_SMALL, line, (255, 255, 0)), (10, 110))
+        if result_timer is not None:
+            label = "K.O." if sim.is_ko() else "Time Up"
+            text = game.render_text(game.FONT_BIG, label, (255, 255, 0))
+            game.screen.blit(text, (game.WIDTH // 2 - text.get_width() // 2, game.HEIGHT // 2 - 40))
+            text = game.render_text(game.FONT_MED, f"Winner: {sim.winner()}", (255, 255, 255))
+            game.screen.blit(text, (game.WIDTH // 2 - text.get_width() // 2, game.HEIGHT // 2 + 30))
+        pg.display.update()
+
+    print(session.stats.summary())
+    transport.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ロールバック方式のネット対戦")
+    parser.add_argument("--player", type=int, choices=(1, 2), default=1)
+    parser.add_argument("--port", type=int, default=7001, help="自分の UDP ポート")
+    parser.add_argument("--peer", default="127.0.0.1:7002", help="相手の ホスト:ポート")
+    parser.add_argument("--delay", type=int, default=2, help="入力遅延フレーム数")
+    parser.add_argument("--max-rollback", type=int, default=8)
+    parser.add_argument("--stage", type=int, default=0)
+    parser.add_argument("--selftest", action="store_true",
+                        help="画面なしで2セッションを動かして一致を確かめる")
+    parser.add_argument("--frames", type=int, default=1800)
+    parser.add_argument("--latency", type=int, default=4, help="selftest の擬似遅延(フレーム)")
+    parser.add_argument("--loss", type=float, default=0.05, help="selftest の擬似パケットロス率")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.selftest:
+        ok = selftest(args.frames, args.latency, args.loss, args.delay, args.seed)
+        sys.exit(0 if ok else 1)
+
+    host, port = args.peer.rsplit(":", 1)
+    play(args.player, args.port, (host, int(port)), args.delay, args.max_rollback, args.stage)
+    pg.quit()
+
+
+if __name__ == "__main__":
+    main()
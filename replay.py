@@ -0,0 +1,175 @@
+"""
+リプレイの再生。
+
+    python replay.py                      # replays/ の一番新しいリプレイを再生
+    python replay.py replays/xxx.kkr      # 指定したリプレイを再生
+    python replay.py --info xxx.kkr       # サイズなどを表示
+    python replay.py --check xxx.kkr      # シークと通し再生が一致するか確かめる（画面なし）
+
+再生中の操作:
+    SPACE 一時停止 / ←→ 5秒戻る・進む / , . 1フレーム戻る・進む（一時停止中）
+    ↑↓ 再生速度 / 0-9 その割合の位置へ / ESC 終了
+"""
+import argparse
+import glob
+import os
+import random
+import sys
+import time
+
+import pygame as pg
+
+import kakutou_koukaton as game
+
+
+SPEEDS = (0.25, 0.5, 1.0, 2.0, 4.0)
+SEEK_FRAMES = 5 * game.FPS
+
+
+def latest_replay() -> str | None:
+    files = sorted(glob.glob(os.path.join(game.REPLAY_DIR, "*.kkr")))
+    return files[-1] if files else None
+
+
+def new_sim(reader: game.ReplayReader, headless: bool = False) -> game.BattleSim:
+    p1_name, p2_name = reader.char_names
+    sim = game.BattleSim(game.Fighter(200, game.P1_KEYS, p1_name, headless=headless),
+                         game.Fighter(700, game.P2_KEYS, p2_name, headless=headless),
+                         match_frames=reader.match_frames)
+    sim.reset()
+    return sim
+
+
+def info(reader: game.ReplayReader) -> None:
+    size = os.path.getsize(reader.path)
+    frames = max(reader.frames, 1)
+    print(f"{reader.path}")
+    print(f"  characters   {reader.char_names[0]} vs {reader.char_names[1]}  stage {reader.stage}")
+    print(f"  frames       {reader.frames} ({reader.frames / game.FPS:.1f} s)")
+    print(f"  keyframes    {len(reader.blocks)} (every {reader.keyframe_interval} frames)")
+    print(f"  size         {size} bytes ({size / frames:.2f} bytes/frame)")
+
+
+def check(reader: game.ReplayReader, samples: int = 50, seed: int = 0) -> bool:
+    """通し再生した各フレームの状態と、シークで作った状態を比べる"""
+    sim = new_sim(reader, headless=True)
+    reader.seek(sim, 0)
+    states = [sim.save_state()]
+    while reader.step(sim):
+        states.append(sim.save_state())
+
+    rng = random.Random(seed)
+    targets = [0, reader.frames] + [rng.randrange(reader.frames + 1) for _ in range(samples)]
+    worst = 0.0
+    ok = True
+    for frame in targets:
+        start = time.perf_counter()
+        reader.seek(sim, frame)
+        worst = max(worst, time.perf_counter() - start)
+        if sim.save_state() != states[frame]:
+            print(f"mismatch at frame {frame}")
+            ok = False
+    print(f"checked {len(targets)} seeks over {reader.frames} frames, "
+          f"slowest seek {worst * 1000:.2f} ms, {'ok' if ok else 'NG'}")
+    return ok
+
+
+def draw_timeline(screen: pg.Surface, frame: int, total: int, speed: float, paused: bool) -> None:
+    """画面下部に再生位置のバーと状態を描く"""
+    bar = pg.Rect(20, game.HEIGHT - 90, game.WIDTH - 40, 12)
+    pg.draw.rect(screen, (60, 60, 60), bar)
+    if total:
+        filled = bar.copy()
+        filled.width = bar.width * frame // total
+        pg.draw.rect(screen, (255, 200, 0), filled)
+    state = "PAUSE" if paused else f"x{speed:g}"
+    label = game.render_text(
+        game.FONT_SMALL,
+        f"REPLAY {frame / game.FPS:6.1f} / {total / game.FPS:.1f} s  {state}",
+        (255, 255, 255))
+    screen.blit(label, (bar.x, bar.y - label.get_height() - 4))
+
+
+def play(reader: game.ReplayReader) -> None:
+    game.init_app()
+    pg.display.set_caption("こうかとん ファイター (replay)")
+    game.preload_assets(reader.char_names)
+    sim = new_sim(reader)
+    reader.seek(sim, 0)
+    hud = game.HUD()
+    stage_bg = game.stage_background(min(reader.stage, len(game.STAGES) - 1))
+
+    speed_index = SPEEDS.index(1.0)
+    paused = False
+    accumulator = 0.0
+    running = True
+    while running:
+        accumulator += game.clock.tick(game.FPS) * SPEEDS[speed_index]
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+                running = False
+            elif event.type == pg.KEYDOWN:
+                if event.key == pg.K_ESCAPE:
+                    running = False
+                elif event.key == pg.K_SPACE:
+                    paused = not paused
+                elif event.key == pg.K_LEFT:
+                    reader.seek(sim, sim.frame - SEEK_FRAMES)
+                elif event.key == pg.K_RIGHT:
+                    reader.seek(sim, sim.frame + SEEK_FRAMES)
+                elif event.key == pg.K_COMMA and paused:
+                    reader.seek(sim, sim.frame - 1)
+                elif event.key == pg.K_PERIOD and paused:
+                    reader.step(sim)
+                elif event.key == pg.K_UP:
+                    speed_index = min(speed_index + 1, len(SPEEDS) - 1)
+                elif event.key == pg.K_DOWN:
+                    speed_index = max(speed_index - 1, 0)
+                elif pg.K_0 <= event.key <= pg.K_9:
+                    reader.seek(sim, reader.frames * (event.key - pg.K_0) // 10)
+
+        if paused:
+            accumulator = 0.0
+        steps = 0
+        while accumulator >= game.STEP_MS:
+            if steps == game.MAX_STEPS_PER_FRAME * 4:
+                accumulator = 0.0
+                break
+            accumulator -= game.STEP_MS
+            steps += 1
+            if not reader.step(sim):
+                paused = True
+                accumulator = 0.0
+
+        hud.update_time(sim.frame)
+        game.draw_battle(game.screen, sim, hud, stage_bg)
+        draw_timeline(game.screen, sim.frame, reader.frames, SPEEDS[speed_index], paused)
+        pg.display.update()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="リプレイの再生")
+    parser.add_argument("path", nargs="?", help="リプレイファイル（省略時は replays/ の最新）")
+    parser.add_argument("--info", action="store_true", help="サイズなどを表示して終了")
+    parser.add_argument("--check", action="store_true", help="シークの結果を確かめて終了")
+    args = parser.parse_args()
+
+    path = args.path or latest_replay()
+    if path is None:
+        print(f"no replay found in {game.REPLAY_DIR}/")
+        sys.exit(1)
+    reader = game.ReplayReader(path)
+    try:
+        if args.info or args.check:
+            info(reader)
+            if args.check and not check(reader):
+                sys.exit(1)
+        else:
+            play(reader)
+    finally:
+        reader.close()
+    pg.quit()
+
+
+if __name__ == "__main__":
+    main()
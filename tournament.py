@@ -0,0 +1,318 @@
+"""
+CPU 同士の自動対戦で技の性能を調整するためのトーナメント。
+
+技データ（BASE_MOVES）の値を組み合わせて変えながら、各組み合わせで CPU 同士の試合を
+プロセスプールで並列に行い、勝率・平均試合時間・技ごとのダメージ・K.O. と時間切れの数をまとめる。
+試合の結果は終わった順に JSON Lines で書き出すので、途中で止めても --resume で続きから再開できる。
+
+    python tournament.py --matches 20
+    python tournament.py --grid punch.damage=4,5,6 --grid beam.energy=15,20,25 --output sweep.jsonl
+    python tournament.py --grid bomb.speed=6,8,10 --level normal --workers 8
+    python tournament.py --grid 'punch.hitbox=[[[40,20,70,60]], [[40,20,90,60]]]'
+"""
+import argparse
+import copy
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import cpu
+import kakutou_koukaton as game
+
+
+# 途中でプロセスごと落ちた試合を何回までやり直すか
+MAX_RETRIES = 2
+
+# 変える前のキャラクターごとの技データ
+DEFAULT_CHARACTER_MOVES = copy.deepcopy(game.CHARACTER_MOVES)
+
+# 試合の結果に書いておく、試合の条件（--resume ではこれが今の試合と同じ結果だけを使う）
+JOB_PARAMS = ("overrides", "seed", "level", "rollouts", "match_frames", "characters")
+
+
+# =====================
+# パラメータの組み合わせ
+# =====================
+def parse_grid(specs: list[str]) -> list[tuple[str, str, list]]:
+    """
+    "技.項目=値,値,..." の並びを [(技, 項目, [値, ...]), ...] にする。
+    値は JSON として読む（数値ならそのまま数値になる）。
+    "技.項目=[値, 値, ...]" のように右辺全体を JSON の配列で書くと、判定のリストのような
+    カンマを含む値も書ける。
+    """
+    grid = []
+    for spec in specs:
+        key, sep, values = spec.partition("=")
+        move, dot, field = key.partition(".")
+        if not sep or not dot or not values:
+            raise SystemExit(f"bad --grid {spec!r} (expected move.field=v1,v2,... or move.field=[v1, v2, ...])")
+        if move not in game.BASE_MOVES:
+            raise SystemExit(f"unknown move {move!r} (choose from {', '.join(game.BASE_MOVES)})")
+        if field not in game.BASE_MOVES[move]:
+            raise SystemExit(f"unknown field {field!r} for {move} "
+                             f"(choose from {', '.join(game.BASE_MOVES[move])})")
+        try:
+            if values.lstrip().startswith("["):
+                parsed = json.loads(values)
+            else:
+                parsed = [json.loads(v) for v in values.split(",")]
+        except json.JSONDecodeError as e:
+            raise SystemExit(f"bad --grid {spec!r}: {e}")
+        if not parsed:
+            raise SystemExit(f"bad --grid {spec!r}: no values")
+        grid.append((move, field, parsed))
+    return grid
+
+
+def configs(grid: list[tuple[str, str, list]]) -> list[dict]:
+    """パラメータの全組み合わせ。各要素は {技: {項目: 値}}（grid が空なら今の値のまま1つ）"""
+    result = []
+    for values in itertools.product(*(vals for _, _, vals in grid)):
+        overrides: dict[str, dict] = {}
+        for (move, field, _), value in zip(grid, values):
+            overrides.setdefault(move, {})[field] = value
+        result.append(overrides)
+    return result
+
+
+def config_label(overrides: dict) -> str:
+    parts = [f"{move}.{field}={value}"
+             for move, fields in sorted(overrides.items()) for field, value in sorted(fields.items())]
+    return " ".join(parts) or "(default)"
+
+
+# =====================
+# 1試合（ワーカープロセスで実行）
+# =====================
+def apply_overrides(char_names, overrides: dict) -> None:
+    """両キャラクターの技データを元の値から変えて、技の表を作り直させる"""
+    for name in char_names:
+        moves = copy.deepcopy(DEFAULT_CHARACTER_MOVES.get(name, {}))
+        for move, fields in overrides.items():
+            moves.setdefault(move, {}).update(fields)
+        game.CHARACTER_MOVES[name] = moves
+    game.MOVE_TABLES.clear()
+
+
+def play_match(job: dict) -> dict:
+    """
+    CPU 同士で1試合行い、結果を返す。
+
+    Args:
+        job: config（設定番号）, match（試合番号）, overrides, seed, level, rollouts,
+             match_frames, characters
+    """
+    chars = job["characters"]
+    apply_overrides(chars, job["overrides"])
+    sim = game.BattleSim(game.Fighter(200, {}, chars[0], headless=True),
+                         game.Fighter(700, {}, chars[1], headless=True),
+                         match_frames=job["match_frames"])
+    sim.reset()
+    cpus = [cpu.CpuPlayer(i, chars, job["level"], seed=job["seed"] * 2 + i,
+                           rollouts_per_frame=job["rollouts"])
+            for i in range(2)]
+
+    damage = [Counter(), Counter()]  # 与えた側ごとの 技 -> ダメージ
+    inputs = (game.PlayerInput(), game.PlayerInput())
+    start = time.perf_counter()
+    while not sim.is_over():
+        inputs = (cpus[0].act(sim, inputs[1]), cpus[1].act(sim, inputs[0]))
+        sim.step(inputs)
+        for attacker, _, source, amount, _ in sim.collisions.hits:
+            damage[sim.fighters.index(attacker)][source] += amount
+
+    return {
+        "config": job["config"],
+        "match": job["match"],
+        **{key: job[key] for key in JOB_PARAMS},
+        "winner": sim.winner(),
+        "ko": sim.is_ko(),
+        "frames": sim.frame,
+        "hp": [f.hp for f in sim.fighters],
+        "damage": [dict(d) for d in damage],
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+# =====================
+# 実行
+# =====================
+def run_jobs(jobs: list[dict], workers: int, on_result) -> None:
+    """
+    jobs をプロセスプールで実行し、終わった順に on_result(結果) を呼ぶ。
+    試合中の例外はその試合のエラーとして記録し、ワーカーが落ちてプールが壊れたら
+    新しいプールで残りをやり直す（同じ試合が MAX_RETRIES 回を超えて巻き込まれたらエラーにする）。
+    """
+    pending = {(job["config"], job["match"]): job for job in jobs}
+    retries = Counter()
+    while pending:
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(play_match, job): key for key, job in pending.items()}
+                for future in as_completed(futures):
+                    key = futures[future]
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        result = {"config": key[0], "match": key[1], "error": repr(e)}
+                    del pending[key]
+                    on_result(result)
+        except BrokenProcessPool:
+            print(f"[tournament] a worker crashed, retrying {len(pending)} matches", file=sys.stderr)
+            for key in list(pending):
+                retries[key] += 1
+                if retries[key] > MAX_RETRIES:
+                    del pending[key]
+                    on_result({"config": key[0], "match": key[1], "error": "worker crashed"})
+
+
+def job_params(record: dict) -> str:
+    """試合の条件を比べられる形にする（JSON に書いて読んだ値と比べるので JSON の文字列にする）"""
+    return json.dumps([record.get(key) for key in JOB_PARAMS], sort_keys=True)
+
+
+def load_done(path: str, jobs: list[dict]) -> dict[tuple[int, int], dict]:
+    """
+    前回の出力から、終わっている試合を読む。エラーの試合と、条件（技の値・キャラクター・
+    強さなど）が今の同じ番号の試合と違う結果は使わずにやり直す。
+    """
+    expected = {(job["config"], job["match"]): job_params(job) for job in jobs}
+    done = {}
+    stale = 0
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 書きかけの行
+                if "match" not in record or "error" in record:
+                    continue
+                key = (record["config"], record["match"])
+                if expected.get(key) == job_params(record):
+                    done[key] = record
+                else:
+                    stale += 1
+    except FileNotFoundError:
+        pass
+    if stale:
+        print(f"[tournament] ignored {stale} results played with different parameters", file=sys.stderr)
+    return done
+
+
+def summarize(results: list[dict], overrides: list[dict]) -> list[dict]:
+    """設定ごとに勝率・平均試合時間・技ごとのダメージ・K.O./時間切れの数をまとめる"""
+    by_config = defaultdict(list)
+    for r in results:
+        by_config[r["config"]].append(r)
+
+    summary = []
+    for i, over in enumerate(overrides):
+        rows = [r for r in by_config[i] if "error" not in r]
+        n = len(rows)
+        wins = Counter(r["winner"] for r in rows)
+        damage = [Counter(), Counter()]
+        for r in rows:
+            for side in (0, 1):
+                damage[side].update(r["damage"][side])
+        summary.append({
+            "config": i,
+            "overrides": over,
+            "matches": n,
+            "errors": len(by_config[i]) - n,
+            "p1_win_rate": round(wins["P1"] / n, 3) if n else None,
+            "p2_win_rate": round(wins["P2"] / n, 3) if n else None,
+            "draw_rate": round(wins["Draw"] / n, 3) if n else None,
+            "avg_seconds": round(sum(r["frames"] for r in rows) / n / game.FPS, 2) if n else None,
+            "kos": sum(r["ko"] for r in rows),
+            "time_ups": sum(not r["ko"] for r in rows),
+            # 1試合あたりの、技ごとのダメージ（両者の合計）
+            "damage_per_match": {k: round(v / n, 2) for k, v in
+                                 sorted((damage[0] + damage[1]).items())} if n else {},
+        })
+    return summary
+
+
+def print_summary(summary: list[dict]) -> None:
+    for s in summary:
+        print(f"[{s['config']}] {config_label(s['overrides'])}", file=sys.stderr)
+        if not s["matches"]:
+            print(f"    no results ({s['errors']} errors)", file=sys.stderr)
+            continue
+        damage = "  ".join(f"{k} {v}" for k, v in s["damage_per_match"].items())
+        print(f"    {s['matches']} matches  P1 {s['p1_win_rate']:.0%}  P2 {s['p2_win_rate']:.0%}"
+              f"  draw {s['draw_rate']:.0%}  avg {s['avg_seconds']:.1f} s"
+              f"  KO {s['kos']} / time up {s['time_ups']}  errors {s['errors']}", file=sys.stderr)
+        print(f"    damage/match  {damage}", file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="CPU 同士の自動対戦によるバランス調整")
+    parser.add_argument("--grid", action="append", default=[],
+                        help="変える値 move.field=v1,v2,...（複数指定で全組み合わせ）")
+    parser.add_argument("--matches", type=int, default=10, help="1つの設定あたりの試合数")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--level", choices=list(cpu.CPU_LEVELS), default="easy", help="CPU の強さ")
+    parser.add_argument("--rollouts", type=int, default=2,
+                        help="CPU が1フレームに行う試し読みの回数（時間ではなく回数で区切るので結果を再現できる）")
+    parser.add_argument("--match-seconds", type=int, default=game.MATCH_TIME)
+    parser.add_argument("--characters", nargs=2, default=["man", "woman"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="tournament.jsonl",
+                        help="試合ごとの結果を書き足していく JSON Lines")
+    parser.add_argument("--resume", action="store_true",
+                        help="--output にある試合は飛ばす（条件が違う試合の結果はやり直す）")
+    parser.add_argument("--summary", help="まとめの JSON を書き出すファイル")
+    args = parser.parse_args()
+
+    overrides = configs(parse_grid(args.grid))
+    # 技の表にできない値（フレームごとの判定の数が合わないなど）は始める前に弾く
+    for over in overrides:
+        apply_overrides(args.characters, over)
+        try:
+            for name in args.characters:
+                game.move_table(name)
+        except (ValueError, TypeError) as e:
+            raise SystemExit(f"bad values {config_label(over)}: {e}")
+    jobs = [{
+        "config": c, "match": m, "overrides": over,
+        "seed": args.seed + m, "level": args.level, "rollouts": args.rollouts,
+        "match_frames": args.match_seconds * game.FPS, "characters": args.characters,
+    } for c, over in enumerate(overrides) for m in range(args.matches)]
+
+    done = load_done(args.output, jobs) if args.resume else {}
+    results = list(done.values())
+    todo = [job for job in jobs if (job["config"], job["match"]) not in done]
+    print(f"{len(overrides)} configs x {args.matches} matches, {len(todo)} to play "
+          f"on {args.workers} workers", file=sys.stderr)
+
+    start = time.perf_counter()
+    with open(args.output, "a" if args.resume else "w", encoding="utf-8") as out:
+        def on_result(result: dict) -> None:
+            results.append(result)
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            state = result.get("error") or f"{result['winner']} {'KO' if result['ko'] else 'time up'}"
+            print(f"  [{len(results) - len(done)}/{len(todo)}] config {result['config']} "
+                  f"match {result['match']}: {state}", file=sys.stderr)
+
+        run_jobs(todo, args.workers, on_result)
+
+    summary = summarize(results, overrides)
+    print_summary(summary)
+    print(f"done in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()